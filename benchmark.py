@@ -0,0 +1,169 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+from dcp import (BatchResponseHandler, ColumnarResponseHandler, DcpClient,
+                 ResponseHandler)
+from dcp.mock_cluster import MockCluster
+
+
+class CountingHandler(ResponseHandler):
+
+    def __init__(self):
+        ResponseHandler.__init__(self)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def mutation(self, response):
+        self.lock.acquire()
+        self.count += 1
+        self.lock.release()
+
+    def deletion(self, response):
+        self.lock.acquire()
+        self.count += 1
+        self.lock.release()
+
+    def marker(self, response):
+        pass
+
+    def stream_end(self, response):
+        pass
+
+
+class CountingBatchHandler(BatchResponseHandler):
+
+    def __init__(self):
+        BatchResponseHandler.__init__(self)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def batch(self, events):
+        n = 0
+        for event in events:
+            if 'by_seqno' in event:
+                n += 1
+        self.lock.acquire()
+        self.count += n
+        self.lock.release()
+
+
+class CountingColumnarHandler(ColumnarResponseHandler):
+
+    def __init__(self):
+        ColumnarResponseHandler.__init__(self)
+        self.count = 0
+
+    def mutations(self, batch):
+        self.count += len(batch)
+
+    def deletion(self, response):
+        self.count += 1
+
+    def marker(self, response):
+        pass
+
+    def stream_end(self, response):
+        pass
+
+
+HANDLERS = {'plain': CountingHandler, 'batch': CountingBatchHandler,
+            'columnar': CountingColumnarHandler}
+
+# Runs the mock cluster in its own process so generating the streams does
+# not compete with the client for the interpreter lock
+def serve(pipe, options):
+    cluster = MockCluster(**options)
+    pipe.send(cluster.start())
+    pipe.recv()
+    cluster.stop()
+
+
+def run(args, rest_port):
+    handler = HANDLERS[args.handler]()
+    client = DcpClient(connection_buffer_size=args.connection_buffer_size,
+                       dispatch_workers=args.dispatch_workers,
+                       connections_per_node=args.connections_per_node,
+                       metrics=True)
+    client.connect('127.0.0.1', rest_port, 'default', 'Administrator',
+                   'password', handler)
+
+    cpu = os.times()
+    start = time.time()
+    results = client.add_streams([(vb, 0, 0, args.items, 0, 0, 0) for
+                                  vb in range(args.vbuckets)])
+    opened = time.time()
+    while handler.has_active_streams():
+        time.sleep(.001)
+    elapsed = time.time() - start
+    cpu = [after - before for before, after in zip(cpu, os.times())]
+
+    failed = [vb for vb, result in results.items() if result['status'] != 0]
+    snapshot = client.metrics.snapshot()
+    client.close()
+
+    received = sum([conn['bytes_read'] for conn in
+                    snapshot['connections'].values()])
+    return {'events': handler.count,
+            'failed_streams': len(failed),
+            'seconds': elapsed,
+            'events_per_sec': handler.count / elapsed,
+            'bytes_per_sec': received / elapsed,
+            'stream_open_ms': (opened - start) * 1000,
+            'cpu_seconds': cpu[0] + cpu[1],
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures DcpClient throughput against a mock cluster')
+    parser.add_argument('--nodes', type=int, default=1)
+    parser.add_argument('--vbuckets', type=int, default=64)
+    parser.add_argument('--items', type=int, default=10000,
+                        help='items per vbucket')
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--handler', choices=sorted(HANDLERS),
+                        default='plain')
+    parser.add_argument('--dispatch-workers', type=int, default=None)
+    parser.add_argument('--connections-per-node', type=int, default=1)
+    parser.add_argument('--connection-buffer-size', type=int, default=None)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results of every run as JSON')
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, {
+        'nodes': args.nodes, 'vbuckets': args.vbuckets, 'items': args.items,
+        'value_size': args.value_size}))
+    server.daemon = True
+    server.start()
+    rest_port = parent.recv()
+
+    runs = list()
+    try:
+        for i in range(args.runs):
+            runs.append(run(args, rest_port))
+    finally:
+        parent.send('stop')
+        server.join()
+
+    if args.json:
+        print json.dumps(runs, indent=2, sort_keys=True)
+        return
+
+    print '%4s %10s %12s %10s %10s %8s %10s' % ('run', 'events', 'events/s',
+                                               'MB/s', 'open ms', 'cpu s',
+                                               'rss MB')
+    for i, result in enumerate(runs):
+        print '%4d %10d %12.0f %10.1f %10.1f %8.2f %10.1f' % (
+            i, result['events'], result['events_per_sec'],
+            result['bytes_per_sec'] / 1048576, result['stream_open_ms'],
+            result['cpu_seconds'], result['max_rss_kb'] / 1024.0)
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,218 @@
 
+import logging
 import operation
 import threading
 import time
 import uuid
 
+from capture import CaptureWriter, Replay
+from checkpoint import (CheckpointStore, FileCheckpointStore,
+                        SQLiteCheckpointStore)
 from cluster import RestClient
-from connection import ConnectionManager
-from constants import FLAG_OPEN_PRODUCER
-from dcp_exception import ConnectedException
-from operation import (CountdownLatch, Control, OpenConnection, SaslPlain,
+from connection import MAX_READ_SIZE, READ_SIZE, ConnectionManager
+from constants import (ERR_NOT_MY_VBUCKET, ERR_ROLLBACK, FEATURE_DATATYPE,
+                       FEATURE_JSON, FEATURE_SNAPPY, FLAG_OPEN_PRODUCER,
+                       SUCCESS)
+from dcp_exception import ConnectedException, TimeoutException
+from dispatch import Dispatcher
+from handler import (BatchResponseHandler, ColumnarResponseHandler,
+                     QueueHandler, ResponseHandler)
+from process_pool import ProcessPoolClient
+from events import snappy
+from filter import KeyFilter
+from metrics import Metrics
+from operation import (CountdownLatch, Control, Hello, SaslPlain,
                        StreamRequest)
+from reactor import Reactor
+from reconnect import Reconnector
+from topology import MAX_ATTEMPTS, RETRY_DELAY, TopologyManager
 
-class ResponseHandler():
-
-    def __init__(self):
-        self.active_streams = 0
-
-    def mutation(self, response):
-        raise NotImplementedError("Subclass must implement abstract method")
-
-    def deletion(self, response):
-        raise NotImplementedError("Subclass must implement abstract method")
-
-    def marker(self, response):
-        raise NotImplementedError("Subclass must implement abstract method")
-
-    def stream_end(self, response):
-        raise NotImplementedError("Subclass must implement abstract method")
-
-    def has_active_streams(self):
-        assert self.active_streams >= 0
-        return self.active_streams != 0
-
-    def _incr_active_streams(self):
-        self.active_streams += 1
-
-    def _decr_active_streams(self):
-        self.active_streams -= 1
+# Noop intervals without a packet after which a connection is treated as lost
+IDLE_NOOPS = 3
 
 class DcpClient(object):
 
-    def __init__(self, priority="medium"):
+    def __init__(self, priority="medium", read_size=READ_SIZE,
+                 max_read_size=MAX_READ_SIZE, rcvbuf=None,
+                 connection_buffer_size=None, dispatch_workers=None,
+                 dispatch_queue_size=1024, connections_per_node=1,
+                 follow_topology=False, checkpoints=None, compression=False,
+                 key_filter=None, metrics=False, timeout=None, capture=None,
+                 coalesce_buffer_size=None, noop_interval=None,
+                 idle_timeout=None, reconnect=False, reactor=None,
+                 config_cache=None):
         self.lock = threading.Lock()
         self.rest = None
         self.connection = None
         self.priority = priority
+        self.read_size = read_size
+        self.max_read_size = max_read_size
+        self.rcvbuf = rcvbuf
+        self.connection_buffer_size = connection_buffer_size
+        self.dispatch_workers = dispatch_workers
+        self.dispatch_queue_size = dispatch_queue_size
+        self.dispatcher = None
+        self.connections_per_node = connections_per_node
+        self.follow_topology = follow_topology
+        self.topology = None
+        self.checkpoints = checkpoints
+        self.compression = compression
+        self.key_filter = key_filter
+        self.enable_metrics = metrics
+        self.metrics = None
+        self.timeout = timeout
+        self.capture = capture
+        self.coalesce_buffer_size = coalesce_buffer_size
+        self.noop_interval = noop_interval
+        self.idle_timeout = idle_timeout
+        self.reconnect = reconnect
+        self.reconnector = None
+        self.reactor = reactor
+        self.config_cache = config_cache
 
     # Returns true is connections are successful
     def connect(self, host, port, bucket, user, pwd, handler):
+        # Options are checked before anything is locked or started
+        if isinstance(handler, ColumnarResponseHandler):
+            # Columnar batches are built and delivered on the I/O thread
+            if self.dispatch_workers is not None:
+                raise ValueError("Columnar handlers run on the I/O thread")
+            # Streams resume from the checkpoint store, which records the
+            # progress of every event delivered to the handler
+            if self.checkpoints is not None:
+                raise ValueError("Columnar handlers cannot be checkpointed")
+            if self.coalesce_buffer_size is not None:
+                raise ValueError("Columnar handlers cannot be coalesced")
+
         # Runs open connection on each node and sends control commands
         self.lock.acquire()
         if self.connection is not None:
             raise ConnectedException("Connection already established")
 
-        self.rest = RestClient(host, port, user, pwd)
-        self.rest.update()
-        cluster_config = self.rest.get_nodes()
-        bucket_config = self.rest.get_bucket(bucket)
+        # A single bucket config names the nodes as well, so one request is
+        # enough to connect
+        self.rest = RestClient(host, port, user, pwd, self.config_cache)
+        cluster_config, bucket_config = self.rest.refresh_bucket(bucket)
         bucket_password = bucket_config['password'].encode('ascii')
 
-        self.connection = ConnectionManager(handler)
+        # Run handler callbacks on worker threads instead of the I/O thread
+        if self.dispatch_workers is not None:
+            self.dispatcher = Dispatcher(handler, self.dispatch_workers,
+                                         self.dispatch_queue_size)
+            self.dispatcher.checkpoints = self.checkpoints
+
+        # Clients given the same reactor share its event loop threads
+        self.connection = ConnectionManager(handler, self.read_size,
+                                            self.max_read_size, self.rcvbuf,
+                                            self.dispatcher,
+                                            self.connections_per_node,
+                                            self.reactor)
+        self.connection.checkpoints = self.checkpoints
+        self.connection.key_filter = self.key_filter
+        # Fail requests that get no response instead of waiting forever
+        self.connection.op_timeout = self.timeout
+        # Record the raw streams so they can be replayed offline
+        self.connection.capture = self.capture
+        # Only deliver the last event for each key in a snapshot
+        self.connection.coalesce_buffer_size = self.coalesce_buffer_size
+        # Treat connections that hear nothing for idle_timeout seconds as
+        # lost. With noops the server is never quiet for longer than the
+        # noop interval, so by default a few missed noops mean a dead node.
+        idle_timeout = self.idle_timeout
+        if idle_timeout is None and self.noop_interval is not None:
+            idle_timeout = IDLE_NOOPS * self.noop_interval
+        self.connection.idle_timeout = idle_timeout
+
+        # Record histograms of frame sizes, callback times and the I/O loop
+        if self.enable_metrics:
+            self.metrics = Metrics(self.connection)
+            self.connection.metrics = self.metrics
+            if self.dispatcher is not None:
+                self.dispatcher.metrics = self.metrics
         self.connection.connect(cluster_config, bucket_config)
 
+        self.bucket = bucket
+        self.bucket_password = bucket_password
+        self.name = 'py_dcp:' + str(uuid.uuid4())[0:7] + str(uuid.uuid4())[0:7]
+        self._setup_connections(self.connection.connections)
+
+        # Reopen streams on their new node when vbuckets move
+        if self.follow_topology:
+            self.topology = TopologyManager(self, bucket)
+
+        # Reconnect lost connections and reopen their streams
+        if self.reconnect:
+            self.reconnector = Reconnector(self)
+
+        self.lock.release()
+
+    # Authenticates and opens connections and sends the control messages.
+    # Also called for the connections to nodes that join the cluster.
+    def _setup_connections(self, connections):
+        # Ask for compressed values, which are only decompressed when a
+        # handler reads them
+        if self.compression:
+            features = [FEATURE_DATATYPE, FEATURE_JSON]
+            if snappy is not None:
+                features.append(FEATURE_SNAPPY)
+            else:
+                logging.warning('python-snappy is not installed, values will '
+                                'not be compressed')
+            latch = CountdownLatch(len(connections))
+            op = Hello('py_dcp', features, latch)
+            self.connection.add_operation_all(op, connections)
+            accepted = op.get_result()
+            if snappy is not None and FEATURE_SNAPPY not in accepted:
+                logging.info('Server did not enable compressed values')
+
         # Send the sasl auth message
-        latch = CountdownLatch(len(self.rest.get_nodes()))
-        op = SaslPlain(bucket, bucket_password, latch)
-        self.connection.add_operation_all(op)
+        latch = CountdownLatch(len(connections))
+        op = SaslPlain(self.bucket, self.bucket_password, latch)
+        self.connection.add_operation_all(op, connections)
         # Todo: Check the value of get_result
 
         # Send the open connection message
-        name = 'py_dcp:' + str(uuid.uuid4())[0:7] + str(uuid.uuid4())[0:7]
-        latch = CountdownLatch(len(self.rest.get_nodes()))
-        op = OpenConnection(FLAG_OPEN_PRODUCER, name, latch)
-        self.connection.add_operation_all(op)
+        latch = CountdownLatch(len(connections))
+        self.connection.open_connections(FLAG_OPEN_PRODUCER, self.name, latch,
+                                         connections)
         # Todo: Check the value of get_result
-        op.get_result()
+        latch.await()
 
         # Send the set priority control message
-        latch = CountdownLatch(len(self.rest.get_nodes()))
+        latch = CountdownLatch(len(connections))
         op = Control("set_priority", self.priority, latch)
-        self.connection.add_operation_all(op)
+        self.connection.add_operation_all(op, connections)
         # Todo: Check the value of get_result
 
-        # Todo: Add the ability to send control messages
+        # Enable flow control so the server stops sending once a connection
+        # has this many unacknowledged bytes outstanding
+        if self.connection_buffer_size is not None:
+            latch = CountdownLatch(len(connections))
+            op = Control("connection_buffer_size",
+                         str(self.connection_buffer_size), latch)
+            self.connection.add_operation_all(op, connections)
+            if op.get_result():
+                self.connection.set_flow_control(self.connection_buffer_size,
+                                                 connections)
+            else:
+                logging.warning('Flow control is not supported by the server')
 
-        self.lock.release()
+        # Have the server send a noop whenever a connection has been quiet
+        # for noop_interval seconds, so a dead node can be told apart from
+        # one with nothing to send
+        if self.noop_interval is not None:
+            latch = CountdownLatch(len(connections))
+            op = Control("enable_noop", "true", latch)
+            self.connection.add_operation_all(op, connections)
+            enabled = op.get_result()
+            latch = CountdownLatch(len(connections))
+            op = Control("set_noop_interval", str(int(self.noop_interval)),
+                         latch)
+            self.connection.add_operation_all(op, connections)
+            if not enabled or not op.get_result():
+                logging.warning('Noops are not supported by the server')
+
+        # Todo: Add the ability to send control messages
 
     # Returns true if the stream is successfully created
     def add_stream(self, vbucket, flags, start_seqno, end_seqno, vb_uuid,
@@ -93,14 +221,25 @@ class DcpClient(object):
         if self.connection is None:
             raise ConnectedException("Not connected")
 
-        latch = CountdownLatch()
-        op = StreamRequest(vbucket, flags, start_seqno, end_seqno, vb_uuid,
-                           snap_start, snap_end, latch)
-        self.connection.add_operation(op, vbucket)
-        ret = op.get_result()
+        results = self._request_streams([(vbucket, flags, start_seqno,
+                                          end_seqno, vb_uuid, snap_start,
+                                          snap_end)])
+
+        self.lock.release()
+        return results[vbucket]
+
+    # Opens many streams at once. Each spec is a tuple of the add_stream
+    # arguments. The stream requests for each node are sent in a single write
+    # and the results are returned in a dict keyed by vbucket.
+    def add_streams(self, specs):
+        self.lock.acquire()
+        if self.connection is None:
+            raise ConnectedException("Not connected")
+
+        results = self._request_streams(specs)
 
         self.lock.release()
-        return ret
+        return results
 
     # Returns true if the stream is closed successfully
     def close_stream(self):
@@ -110,9 +249,72 @@ class DcpClient(object):
         raise NotImplementedError("Not impemented yet")
         self.lock.release()
 
+    # Sends the stream requests and waits for their results. When following
+    # the topology, requests rejected with NOT_MY_VBUCKET are sent again once
+    # the cluster map has been refreshed. With a checkpoint store, streams
+    # start from their stored checkpoint and are sent again from the seqno
+    # the server gives when it asks for a rollback. The handler is told about
+    # every stream that still failed.
+    def _request_streams(self, specs):
+        results = dict()
+        attempts = 0
+        while len(specs) > 0:
+            if self.checkpoints is not None:
+                specs = [self.checkpoints.resume_spec(spec) for spec in specs]
+
+            latch = CountdownLatch(len(specs))
+            ops = list()
+            for spec in specs:
+                ops.append(StreamRequest(*(tuple(spec) + (latch,))))
+            self.connection.add_operations(ops)
+            latch.await()
+
+            retry = list()
+            moved = False
+            for op, spec in zip(ops, specs):
+                results[op.vbucket] = op.result
+                status = op.result['status']
+                if status == ERR_NOT_MY_VBUCKET and self.topology is not None:
+                    retry.append(spec)
+                    moved = True
+                elif status == ERR_ROLLBACK and self.checkpoints is not None:
+                    seqno = op.result['rollback_seqno']
+                    self.checkpoints.rollback(op.vbucket, op.vb_uuid, seqno)
+                    self.connection.handler.rollback(op.vbucket, seqno)
+                    retry.append(spec)
+
+            attempts += 1
+            if attempts >= MAX_ATTEMPTS:
+                break
+            if moved:
+                time.sleep(RETRY_DELAY)
+                self.topology.refresh()
+            specs = retry
+
+        handler = self.connection.handler
+        for vbucket, result in results.items():
+            if result['status'] != SUCCESS:
+                handler.stream_failed(vbucket, result['status'])
+        return results
+
     def close(self):
         self.lock.acquire()
+        if self.reconnector is not None:
+            self.reconnector.close()
+            self.reconnector = None
+        if self.topology is not None:
+            self.topology.close()
+            self.topology = None
+        # Workers still acknowledge what they run through the event loop
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+            self.dispatcher = None
         self.connection.close()
+        if self.checkpoints is not None:
+            self.checkpoints.flush()
+        if self.capture is not None:
+            self.capture.close()
+        self.rest.close()
         self.client = None
         self.nodes = None
         self.buckets = None
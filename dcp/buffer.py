@@ -0,0 +1,108 @@
+
+from codec import HEADER
+from constants import HEADER_LEN
+
+class ReadBuffer(object):
+
+    # Bytes are appended at wpos and frames are consumed from rpos. Consumed
+    # space is only reclaimed when an append would run past the end of the
+    # buffer, so the pending bytes are moved at most once per wrap.
+    def __init__(self, size=65536):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.rpos = 0
+        self.wpos = 0
+
+    def __len__(self):
+        return self.wpos - self.rpos
+
+    def write(self, data):
+        size = len(data)
+        self.reserve(size)
+        self.buf[self.wpos:self.wpos + size] = data
+        self.wpos += size
+
+    def reserve(self, size):
+        if self.rpos == self.wpos:
+            self.rpos = self.wpos = 0
+        if self.wpos + size <= len(self.buf):
+            return
+
+        pending = self.wpos - self.rpos
+        capacity = len(self.buf)
+        while capacity < pending + size:
+            capacity *= 2
+
+        if capacity == len(self.buf):
+            self.buf[0:pending] = self.view[self.rpos:self.wpos].tobytes()
+        else:
+            buf = bytearray(capacity)
+            buf[0:pending] = self.view[self.rpos:self.wpos]
+            self.buf = buf
+            self.view = memoryview(buf)
+        self.rpos = 0
+        self.wpos = pending
+
+    # Yields (header, offset) for each complete frame in the buffer, where
+    # header is the unpacked packet header and offset is the position of the
+    # frame in self.buf. Frames are only valid until the next write.
+    def frames(self):
+        buf = self.buf
+        while self.wpos - self.rpos >= HEADER_LEN:
+            header = HEADER.unpack_from(buf, self.rpos)
+            start = self.rpos
+            end = start + HEADER_LEN + header[6]
+            if end > self.wpos:
+                break
+            self.rpos = end
+            yield header, start
+
+
+class WriteBuffer(object):
+
+    # Operations are packed in place at wpos and sends consume from rpos, so
+    # a partial send leaves the unsent bytes where they are. Sent space is
+    # reclaimed once everything has gone out, or when packing would run past
+    # the end of the buffer, so the unsent bytes are moved at most once per
+    # wrap.
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.rpos = 0
+        self.wpos = 0
+
+    def __len__(self):
+        return self.wpos - self.rpos
+
+    # Makes room for size bytes after the unsent bytes and returns the offset
+    # to pack them at
+    def reserve(self, size):
+        if self.wpos + size > len(self.buf):
+            pending = self.wpos - self.rpos
+            capacity = len(self.buf)
+            while capacity < pending + size:
+                capacity *= 2
+            if capacity == len(self.buf):
+                self.buf[0:pending] = self.buf[self.rpos:self.wpos]
+            else:
+                buf = bytearray(capacity)
+                buf[0:pending] = self.buf[self.rpos:self.wpos]
+                self.buf = buf
+            self.rpos = 0
+            self.wpos = pending
+        offset = self.wpos
+        self.wpos += size
+        return offset
+
+    # Drops everything reserved from offset on, so bytes that could not be
+    # packed are never sent
+    def truncate(self, offset):
+        self.wpos = offset
+
+    # The unsent bytes, without copying them
+    def pending(self):
+        return buffer(self.buf, self.rpos, self.wpos - self.rpos)
+
+    def consume(self, size):
+        self.rpos += size
+        if self.rpos == self.wpos:
+            self.rpos = self.wpos = 0
@@ -0,0 +1,192 @@
+
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+
+from connection import DcpConnection
+from constants import CMD_STREAM_REQ, SUCCESS
+
+# Maximum size of a capture segment before a new one is started
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+SEGMENT_MAGIC = 'DCPCAP01'
+SEGMENT_PATTERN = 'segment-%08d.dcp'
+
+# Every record is a header of type, node, timestamp and length followed by
+# length bytes. A node record names the connection that a node number
+# stands for and a data record holds bytes read from that connection.
+RECORD = struct.Struct(">BHdI")
+RECORD_NODE = 0
+RECORD_DATA = 1
+
+class CaptureWriter(object):
+
+    # Appends everything read from the connections of a client to segment
+    # files in directory, so a stream can be replayed later without going
+    # back to the cluster. The bytes are recorded as they come off the socket,
+    # before any decoding, each read tagged with its connection and the time
+    # it was read. Segments are started once the current one reaches
+    # segment_size, and each one names the connections it holds reads from
+    # so that it can be read on its own.
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.nodes = dict()
+        self.file = None
+        self.size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Segments left by an earlier capture are kept
+        self.segment = 0
+        segments = segment_files(directory)
+        if len(segments) > 0:
+            self.segment = _segment_index(segments[-1]) + 1
+        self._start_segment()
+
+    # Records bytes read from conn, which may be any string or buffer
+    def record(self, conn, data):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if self.file is None:
+                return
+            name = '%s/%d' % (conn.hostname, conn.index)
+            node = self.nodes.get(name)
+            if node is None:
+                node = len(self.nodes)
+                self.nodes[name] = node
+                self._write(RECORD_NODE, node, now, name)
+            if self.size + RECORD.size + len(data) > self.segment_size:
+                self._start_segment()
+            self._write(RECORD_DATA, node, now, data)
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        if self.file is not None:
+            self.file.flush()
+        self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+    def _start_segment(self):
+        if self.file is not None:
+            self.file.close()
+        path = os.path.join(self.directory, SEGMENT_PATTERN % self.segment)
+        self.segment += 1
+        self.file = open(path, 'wb')
+        self.file.write(SEGMENT_MAGIC)
+        self.size = len(SEGMENT_MAGIC)
+        now = time.time()
+        for name, node in sorted(self.nodes.items(), key=lambda n: n[1]):
+            self._write(RECORD_NODE, node, now, name)
+
+    def _write(self, kind, node, timestamp, data):
+        self.file.write(RECORD.pack(kind, node, timestamp, len(data)))
+        self.file.write(data)
+        self.size += RECORD.size + len(data)
+
+
+class Replay(object):
+
+    # Feeds the reads recorded by a CaptureWriter through the same decoding
+    # as a live connection and on to handler, on the calling thread. Each
+    # recorded connection gets a DcpConnection without a socket, so frames
+    # split between reads are put back together as they were live.
+    #
+    # By default the reads are replayed as fast as they can be decoded. With
+    # speed set, they are spaced out as they were recorded, speed times as
+    # fast. Streams count as active from their stream request response to
+    # their stream end, so has_active_streams() works as it does live.
+    def __init__(self, directory, handler, speed=None, key_filter=None):
+        self.directory = directory
+        self.handler = handler
+        self.speed = speed
+        self.key_filter = key_filter
+        self.connections = dict()
+
+    # Replays every segment in order and returns the number of reads replayed
+    def run(self):
+        reads = 0
+        started = None
+        first = None
+        for path in segment_files(self.directory):
+            f = open(path, 'rb')
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            try:
+                if data[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+                    raise ValueError('Not a capture segment: %s' % path)
+                pos = len(SEGMENT_MAGIC)
+                end = len(data)
+                while pos + RECORD.size <= end:
+                    kind, node, timestamp, length = \
+                        RECORD.unpack_from(data, pos)
+                    pos += RECORD.size
+                    if pos + length > end:
+                        break
+                    if kind == RECORD_NODE:
+                        self._add_connection(node, data[pos:pos + length])
+                    elif kind == RECORD_DATA:
+                        if self.speed is not None:
+                            if started is None:
+                                started = time.time()
+                                first = timestamp
+                            delay = started + (timestamp - first) / \
+                                self.speed - time.time()
+                            if delay > 0:
+                                time.sleep(delay)
+                        self.connections[node].bytes_read(
+                            buffer(data, pos, length))
+                        reads += 1
+                    pos += length
+            finally:
+                data.close()
+        self.handler.flush(True)
+        return reads
+
+    def _add_connection(self, node, name):
+        if node in self.connections:
+            return
+        hostname, index = name.rsplit('/', 1)
+        host, port = hostname.rsplit(':', 1)
+        conn = _ReplayConnection(host, int(port), self.handler)
+        conn.index = int(index)
+        conn.key_filter = self.key_filter
+        self.connections[node] = conn
+
+
+class _ReplayConnection(DcpConnection):
+
+    # No operations are sent on a replayed connection, so stream request
+    # responses are matched by their status alone
+    def _handle_response(self, opcode, keylen, extlen, status, opaque, cas,
+                         pos, bodylen):
+        if opcode == CMD_STREAM_REQ and status == SUCCESS:
+            self.handler._incr_active_streams()
+
+    def _stream_end(self, response):
+        self.handler.stream_end(response)
+        if self.handler.active_streams > 0:
+            self.handler._decr_active_streams()
+
+
+def segment_files(directory):
+    return sorted(glob.glob(os.path.join(directory, 'segment-*.dcp')))
+
+def _segment_index(path):
+    return int(os.path.basename(path)[len('segment-'):-len('.dcp')])
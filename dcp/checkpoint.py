@@ -0,0 +1,222 @@
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from streams import resume_snapshot
+
+# Seconds between writes of changed checkpoints
+FLUSH_INTERVAL = 1.0
+
+class CheckpointStore(object):
+
+    # Remembers how far each vbucket has been streamed so a client can resume
+    # after a restart. A checkpoint is a (vb_uuid, seqno, snap_start,
+    # snap_end) tuple, recorded once the handler has been given the event and
+    # the handler's flush() has returned. Changed checkpoints are kept in
+    # memory and written together every flush_interval seconds by a
+    # background thread, so the cost of syncing to disk is shared by all of
+    # the events in between.
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.checkpoints = dict()
+        for vbucket, checkpoint in self._load().items():
+            self.checkpoints[vbucket] = list(checkpoint)
+        self.dirty = set()
+
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._run)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def get(self, vbucket):
+        self.lock.acquire()
+        checkpoint = self.checkpoints.get(vbucket)
+        self.lock.release()
+        if checkpoint is None:
+            return None
+        return tuple(checkpoint)
+
+    # Returns the add_stream arguments of spec with the start of the stream
+    # replaced by the stored checkpoint, if there is one
+    def resume_spec(self, spec):
+        vbucket, flags, start_seqno, end_seqno = spec[:4]
+        checkpoint = self.get(vbucket)
+        if checkpoint is None:
+            return tuple(spec)
+        vb_uuid, seqno, snap_start, snap_end = checkpoint
+        snap_start, snap_end = resume_snapshot(seqno, snap_start, snap_end)
+        return (vbucket, flags, seqno, end_seqno, vb_uuid, snap_start,
+                snap_end)
+
+    # Called when a stream is opened. A stream that continues one that moved
+    # to another node keeps its progress and only takes the new vb_uuid.
+    def opened(self, vbucket, vb_uuid, seqno, snap_start, snap_end,
+               resume=False):
+        self.lock.acquire()
+        checkpoint = self.checkpoints.get(vbucket)
+        if resume and checkpoint is not None:
+            checkpoint[0] = vb_uuid
+        else:
+            self.checkpoints[vbucket] = [vb_uuid, seqno, snap_start, snap_end]
+        self.dirty.add(vbucket)
+        self.lock.release()
+
+    # Moves a vbucket back to the seqno the server asked it to roll back to
+    def rollback(self, vbucket, vb_uuid, seqno):
+        if seqno == 0:
+            vb_uuid = 0
+        self.lock.acquire()
+        self.checkpoints[vbucket] = [vb_uuid, seqno, seqno, seqno]
+        self.dirty.add(vbucket)
+        self.lock.release()
+
+    # Records the progress made by events the handler has processed. Events
+    # for vbuckets that were not opened through the client are ignored.
+    def record(self, events):
+        self.lock.acquire()
+        for event in events:
+            vbucket = event['vbucket']
+            checkpoint = self.checkpoints.get(vbucket)
+            if checkpoint is None:
+                continue
+            if 'by_seqno' in event:
+                checkpoint[1] = event['by_seqno']
+            elif 'snap_start' in event:
+                checkpoint[2] = event['snap_start']
+                checkpoint[3] = event['snap_end']
+            else:
+                continue
+            self.dirty.add(vbucket)
+        self.lock.release()
+
+    # Writes every changed checkpoint
+    def flush(self):
+        self.write_lock.acquire()
+        try:
+            self.lock.acquire()
+            dirty = dict()
+            for vbucket in self.dirty:
+                dirty[vbucket] = tuple(self.checkpoints[vbucket])
+            checkpoints = dict([(vbucket, tuple(checkpoint)) for
+                                vbucket, checkpoint in
+                                self.checkpoints.items()])
+            self.dirty = set()
+            self.lock.release()
+
+            if len(dirty) > 0:
+                self._write(checkpoints, dirty)
+        finally:
+            self.write_lock.release()
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+
+    # Returns the stored checkpoints as a dict keyed by vbucket
+    def _load(self):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    # Makes the changed checkpoints durable. checkpoints holds all of them.
+    def _write(self, checkpoints, dirty):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    def _run(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Unable to write checkpoints')
+
+
+class FileCheckpointStore(CheckpointStore):
+
+    # Keeps the checkpoints in a JSON file. Every flush writes a new file,
+    # syncs it and renames it over the old one, so a crash leaves either the
+    # old or the new checkpoints.
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        CheckpointStore.__init__(self, flush_interval)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return dict()
+        f = open(self.path)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        return dict([(int(vbucket), checkpoint) for
+                     vbucket, checkpoint in data.items()])
+
+    def _write(self, checkpoints, dirty):
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(checkpoints, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+
+    # Keeps the checkpoints in a SQLite table, one row per vbucket. Each
+    # flush updates the changed rows in a single transaction. Several
+    # clients can share a database by using a different table each.
+    def __init__(self, path, table='checkpoints',
+                 flush_interval=FLUSH_INTERVAL):
+        self.table = table
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA synchronous = FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s (vbucket INTEGER '
+                        'PRIMARY KEY, vb_uuid INTEGER, seqno INTEGER, '
+                        'snap_start INTEGER, snap_end INTEGER)' % table)
+        self.db.commit()
+        CheckpointStore.__init__(self, flush_interval)
+
+    def close(self):
+        CheckpointStore.close(self)
+        self.db.close()
+
+    def _load(self):
+        checkpoints = dict()
+        rows = self.db.execute('SELECT vbucket, vb_uuid, seqno, snap_start, '
+                               'snap_end FROM %s' % self.table)
+        for row in rows:
+            checkpoints[row[0]] = [self._from_db(value) for value in row[1:]]
+        return checkpoints
+
+    def _write(self, checkpoints, dirty):
+        rows = list()
+        for vbucket, checkpoint in dirty.items():
+            rows.append((vbucket,) +
+                        tuple([self._to_db(value) for value in checkpoint]))
+        self.db.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?)'
+                            % self.table, rows)
+        self.db.commit()
+
+    # SQLite integers are signed 64 bit, so vb_uuids and seqnos above 2^63
+    # are stored as their two's complement
+    def _to_db(self, value):
+        if value >= 1 << 63:
+            return value - (1 << 64)
+        return value
+
+    def _from_db(self, value):
+        if value < 0:
+            return value + (1 << 64)
+        return value
@@ -1,20 +1,34 @@
-
+import json
+import os
 import requests
 
 class RestClient(object):
 
-    def __init__(self, host, port, username, password):
+    # Talks to the REST API of a node over one pooled HTTP session. Bucket
+    # configs are fetched one bucket at a time and revalidated with the ETag
+    # of the last response, and a config is only parsed again when its rev
+    # changes. With cache_dir set, the last config of every bucket is kept on
+    # disk, so a later client revalidates it instead of downloading it again.
+    def __init__(self, host, port, username, password, cache_dir=None):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.cache_dir = cache_dir
+
+        self.session = requests.Session()
+        self.session.auth = (username, password)
 
         self.nodes = None
         self.buckets = None
 
+        # Bucket name to the ETag of the last config fetched for it, and that
+        # config
+        self.etags = dict()
+        self.configs = dict()
+
     def update(self):
         self._get_nodes()
-        self._get_buckets
 
     def get_nodes(self):
         if self.nodes is None:
@@ -22,44 +36,141 @@ class RestClient(object):
         return self.nodes
 
     def get_bucket(self, bucket):
-        if self.buckets is None:
-            self._get_buckets()
+        if self.buckets is None or bucket not in self.buckets:
+            self.refresh_bucket(bucket)
         return self.buckets[bucket]
 
+    # Fetches the latest config of a single bucket, along with the nodes that
+    # serve it
+    def refresh_bucket(self, bucket):
+        if bucket not in self.configs:
+            self._load_cache(bucket)
+
+        headers = dict()
+        etag = self.etags.get(bucket)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        r = self.session.get(self._url('pools/default/buckets/' + bucket),
+                             headers=headers)
+        if r.status_code == requests.codes.not_modified:
+            return self._update_bucket(self.configs[bucket])
+        r.raise_for_status()
+
+        data = r.json()
+        etag = r.headers.get('ETag')
+        if etag is not None and etag != self.etags.get(bucket):
+            self.etags[bucket] = etag
+            self.configs[bucket] = data
+            self._save_cache(bucket, etag, data)
+        return self._update_bucket(data)
+
+    # Yields (nodes, bucket config) each time the cluster pushes a new config
+    # for the bucket. Blocks until the server closes the stream.
+    def stream_bucket(self, bucket):
+        r = self.session.get(self._url('pools/default/bucketsStreaming/' +
+                                       bucket), stream=True)
+        r.raise_for_status()
+
+        pending = ''
+        for chunk in r.iter_content(chunk_size=None):
+            pending += chunk
+            while '\n\n\n\n' in pending:
+                config, pending = pending.split('\n\n\n\n', 1)
+                if config.strip():
+                    yield self._update_bucket(json.loads(config))
+
+    def close(self):
+        self.session.close()
+
     def _get_nodes(self):
-        nodes = dict()
         data = self._request('pools/default')
-        for node in data['nodes']:
+        self.nodes = self._parse_nodes(data['nodes'])
+
+    # Configs with the rev of the one already parsed for the bucket reuse it
+    def _update_bucket(self, data):
+        name = data['name']
+        rev = data.get('rev', 0)
+        if self.buckets is None:
+            self.buckets = dict()
+        config = self.buckets.get(name)
+        if config is None or rev == 0 or config['rev'] != rev:
+            config = self._parse_bucket(data)
+            self.buckets[name] = config
+            self.nodes = self._parse_nodes(data['nodes'])
+        return self.nodes, config
+
+    def _parse_nodes(self, data):
+        nodes = dict()
+        for node in data:
             name = node['hostname'].encode('ascii')
             nodes[name] = dict()
             nodes[name]['host'] = name.split(':')[0]
             nodes[name]['rest_port'] = int(name.split(':')[1])
             nodes[name]['data_port'] = node['ports']['direct']
             nodes[name]['proxy_port'] = node['ports']['proxy']
-        self.nodes = nodes
-
-    def _get_buckets(self):
-        buckets = dict()
-        data = self._request('pools/default/buckets')
-        for bucket in data:
-            name = bucket['name']
-            buckets[name] = dict()
-            buckets[name]['password'] = bucket['saslPassword']
-
-            vbid = 0
-            map = dict()
-            nodes = bucket['vBucketServerMap']['serverList']
-            vbmap = bucket['vBucketServerMap']['vBucketMap']
-            for vbucket in vbmap:
+        return nodes
+
+    def _parse_bucket(self, bucket):
+        config = dict()
+        config['password'] = bucket['saslPassword']
+        config['rev'] = bucket.get('rev', 0)
+
+        vbid = 0
+        map = dict()
+        nodes = bucket['vBucketServerMap']['serverList']
+        vbmap = bucket['vBucketServerMap']['vBucketMap']
+        for vbucket in vbmap:
+            # A vbucket without an active copy has a master index of -1
+            if vbucket[0] >= 0:
                 map[vbid] = nodes[vbucket[0]].encode('ascii')
-                vbid += 1
-            buckets[name]['vbmap'] = map
+            vbid += 1
+        config['vbmap'] = map
+        return config
+
+    # A cached config is only used after the server confirms it with its
+    # ETag, so a stale cache costs a full fetch and nothing else
+    def _load_cache(self, bucket):
+        path = self._cache_path(bucket)
+        if path is None or not os.path.exists(path):
+            return
+        f = open(path)
+        try:
+            cached = json.load(f)
+        except ValueError:
+            return
+        finally:
+            f.close()
+        if cached.get('etag') is not None:
+            self.etags[bucket] = cached['etag']
+            self.configs[bucket] = cached['config']
+
+    # The config holds the bucket password, so the cache is only readable by
+    # its owner
+    def _save_cache(self, bucket, etag, data):
+        path = self._cache_path(bucket)
+        if path is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp = path + '.tmp'
+        f = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                              0600), 'w')
+        try:
+            json.dump({'etag': etag, 'config': data}, f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
 
-        self.buckets = buckets
+    def _cache_path(self, bucket):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, '%s-%d-%s.json' %
+                            (self.host, self.port, bucket))
+
+    def _url(self, api):
+        return 'http://%s:%d/%s' % (self.host, self.port, api)
 
     def _request(self, api):
-        url = 'http://%s:%d/%s' % (self.host, self.port, api)
-        r = requests.get(url, auth=(self.username, self.password))
+        r = self.session.get(self._url(api))
         r.raise_for_status()
         return r.json()
-
@@ -0,0 +1,85 @@
+
+from events import Deletion, Mutation
+
+class Coalescer(object):
+
+    # Holds back the mutations, deletions and expirations of each snapshot
+    # and passes on only the last one for every key once the snapshot is
+    # complete, in seqno order. A snapshot is complete when its snap_end
+    # seqno arrives, when the next marker for the vbucket arrives or when the
+    # stream ends.
+    #
+    # Held events count towards max_bytes by the size of their frames. Once
+    # an event takes the total over max_bytes, the snapshot it belongs to is
+    # passed on as it stands and the rest of that snapshot goes straight
+    # through. The body length of every event held back is passed to held,
+    # and held events are passed to deliver with a size of 0.
+    def __init__(self, deliver, held, max_bytes):
+        self.deliver = deliver
+        self.held = held
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.snapshots = dict()
+
+    # Completes the current snapshot of vbucket and starts holding back the
+    # events of the next one
+    def marker(self, vbucket, snap_end):
+        self.flush(vbucket)
+        self.snapshots[vbucket] = _Snapshot(snap_end)
+
+    # Returns False if the event is not held back and must be delivered now
+    def add(self, callback, bodylen, event):
+        if not isinstance(event, (Mutation, Deletion)):
+            return False
+        snapshot = self.snapshots.get(event.vbucket)
+        if snapshot is None:
+            return False
+
+        size = len(event.frame)
+        replaced = snapshot.events.get(event.key)
+        snapshot.events[event.key] = (callback, event)
+        snapshot.size += size
+        self.size += size
+        if replaced is not None:
+            old_size = len(replaced[1].frame)
+            snapshot.size -= old_size
+            self.size -= old_size
+        self.held(bodylen)
+
+        if event.by_seqno >= snapshot.snap_end or self.size > self.max_bytes:
+            self.flush(event.vbucket)
+        return True
+
+    # Completes the snapshot of vbucket if seqno is its last, for events
+    # that are not delivered at all
+    def seqno(self, vbucket, seqno):
+        snapshot = self.snapshots.get(vbucket)
+        if snapshot is not None and seqno >= snapshot.snap_end:
+            self.flush(vbucket)
+
+    # Delivers the held events of vbucket. Later events for it are delivered
+    # as they arrive until its next marker.
+    def flush(self, vbucket):
+        snapshot = self.snapshots.pop(vbucket, None)
+        if snapshot is None:
+            return
+        self.size -= snapshot.size
+        events = snapshot.events.values()
+        events.sort(key=lambda held: held[1].by_seqno)
+        for callback, event in events:
+            self.deliver(callback, 0, event)
+
+    # Delivers the held events of every vbucket
+    def flush_all(self):
+        for vbucket in self.snapshots.keys():
+            self.flush(vbucket)
+
+
+class _Snapshot(object):
+
+    __slots__ = ('snap_end', 'events', 'size')
+
+    def __init__(self, snap_end):
+        self.snap_end = snap_end
+        self.events = dict()
+        self.size = 0
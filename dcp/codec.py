@@ -0,0 +1,28 @@
+
+import struct
+
+from constants import PKT_HEADER_FMT
+
+# Precompiled structs for the packet header and the extras of each DCP
+# packet, so formats are parsed once instead of on every pack and unpack
+
+HEADER = struct.Struct(PKT_HEADER_FMT)
+
+# Request extras
+OPEN_EXTRAS = struct.Struct(">II")
+STREAM_REQ_EXTRAS = struct.Struct(">IIQQQQQ")
+BUFFER_ACK_EXTRAS = struct.Struct(">I")
+
+# Extras of the packets sent by the producer
+MUTATION_EXTRAS = struct.Struct(">QQIIIHB")
+DELETION_EXTRAS = struct.Struct(">QQH")
+EXPIRATION_EXTRAS = DELETION_EXTRAS
+MARKER_EXTRAS = struct.Struct(">QQI")
+STREAM_END_EXTRAS = struct.Struct(">I")
+
+# Response bodies
+FAILOVER_ENTRY = struct.Struct(">QQ")
+SEQNO = struct.Struct(">Q")
+
+# Leading seqno of mutation, deletion and expiration extras
+BY_SEQNO = SEQNO
@@ -0,0 +1,147 @@
+
+import array
+import struct
+
+from constants import DATATYPE_SNAPPY, HEADER_LEN
+from events import decompress
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A mutation record is the packet header followed by the mutation extras,
+# copied verbatim from the frame
+RECORD = struct.Struct(">BBHBBHIIQQQIIIHB")
+RECORD_LEN = RECORD.size
+MUTATION_EXTLEN = RECORD_LEN - HEADER_LEN
+
+RECORD_FIELDS = ('magic', 'opcode', 'key_length', 'extlen', 'datatype',
+                 'vbucket', 'bodylen', 'opaque', 'cas', 'by_seqno',
+                 'rev_seqno', 'flags', 'expiration', 'lock_time',
+                 'ext_meta_len', 'nru')
+
+COLUMNS = ('vbucket', 'by_seqno', 'rev_seqno', 'flags', 'expiration',
+           'lock_time', 'nru', 'datatype', 'key_length', 'value_length')
+
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([('magic', 'u1'), ('opcode', 'u1'),
+                                ('key_length', '>u2'), ('extlen', 'u1'),
+                                ('datatype', 'u1'), ('vbucket', '>u2'),
+                                ('bodylen', '>u4'), ('opaque', '>u4'),
+                                ('cas', '>u8'), ('by_seqno', '>u8'),
+                                ('rev_seqno', '>u8'), ('flags', '>u4'),
+                                ('expiration', '>u4'), ('lock_time', '>u4'),
+                                ('ext_meta_len', '>u2'), ('nru', 'u1')])
+
+# array has no 64-bit typecode on Python 2, so seqnos use unsigned long where
+# it is 64 bits wide and fall back to double otherwise
+SEQNO_TYPECODE = 'L' if array.array('L').itemsize == 8 else 'd'
+
+TYPECODES = {'vbucket': 'H', 'by_seqno': SEQNO_TYPECODE,
+             'rev_seqno': SEQNO_TYPECODE, 'flags': 'I', 'expiration': 'I',
+             'lock_time': 'I', 'nru': 'B', 'datatype': 'B', 'key_length': 'I',
+             'value_length': 'I', 'key_offset': 'I', 'value_offset': 'I'}
+
+class MutationBatch(object):
+
+    # Holds the metadata of many mutations without creating an object per
+    # mutation. Decoding a mutation only copies its header and extras into
+    # self.records and its key into self.data. Values stay in the buffer the
+    # frames were read into, self.values, and are only valid until the batch
+    # has been delivered, unless copy_values is set, in which case they are
+    # copied into self.data after their keys. The columns are built from
+    # those buffers on demand, with NumPy when it is installed.
+    def __init__(self, copy_values=False):
+        self.copy_values = copy_values
+        self.records = bytearray()
+        self.data = bytearray()
+        self.values = self.data
+        self.offsets = array.array('I')
+        self.value_offsets = array.array('I')
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, view, start, keylen, extlen, bodylen):
+        assert extlen == MUTATION_EXTLEN
+        self.records += view[start:start + RECORD_LEN]
+        key = start + RECORD_LEN
+        self.offsets.append(len(self.data))
+        if self.copy_values:
+            self.value_offsets.append(len(self.data) + keylen)
+            self.data += view[key:start + HEADER_LEN + bodylen]
+        else:
+            self.values = view
+            self.value_offsets.append(key + keylen)
+            self.data += view[key:key + keylen]
+        self.count += 1
+
+    # Returns a dict of column name to column. The columns are NumPy arrays
+    # when NumPy is installed and array.array objects otherwise. key_offset
+    # indexes into self.data and value_offset into self.values.
+    def columns(self):
+        if numpy is not None:
+            return self._numpy_columns()
+
+        records = [RECORD.unpack_from(self.records, i * RECORD_LEN) for i in
+                   xrange(self.count)]
+        fields = dict(zip(RECORD_FIELDS, zip(*records) or
+                          [()] * len(RECORD_FIELDS)))
+        columns = dict()
+        for name in COLUMNS[:-1]:
+            columns[name] = array.array(TYPECODES[name], fields[name])
+        columns['value_length'] = array.array('I', [
+            bodylen - MUTATION_EXTLEN - keylen for bodylen, keylen in
+            zip(fields['bodylen'], fields['key_length'])])
+        columns['key_offset'] = array.array('I', self.offsets)
+        columns['value_offset'] = array.array('I', self.value_offsets)
+        return columns
+
+    # Returns a dict of vbucket to the number of mutations in the batch and
+    # the seqno of the last one
+    def progress(self):
+        progress = dict()
+        if numpy is not None:
+            records = numpy.frombuffer(self.records, RECORD_DTYPE, self.count)
+            vbuckets, last, counts = numpy.unique(records['vbucket'][::-1],
+                                                  return_index=True,
+                                                  return_counts=True)
+            seqnos = records['by_seqno'][::-1][last]
+            for vbucket, count, seqno in zip(vbuckets, counts, seqnos):
+                progress[int(vbucket)] = (int(count), int(seqno))
+            return progress
+
+        for i in xrange(self.count):
+            fields = RECORD.unpack_from(self.records, i * RECORD_LEN)
+            count = progress.get(fields[5], (0, 0))[0]
+            progress[fields[5]] = (count + 1, fields[9])
+        return progress
+
+    def key(self, i):
+        start = self.offsets[i]
+        keylen = RECORD.unpack_from(self.records, i * RECORD_LEN)[2]
+        return str(self.data[start:start + keylen])
+
+    # Compressed values are decompressed on every call
+    def value(self, i):
+        start = self.value_offsets[i]
+        fields = RECORD.unpack_from(self.records, i * RECORD_LEN)
+        end = start + fields[6] - MUTATION_EXTLEN - fields[2]
+        value = memoryview(self.values)[start:end]
+        if fields[4] & DATATYPE_SNAPPY:
+            return decompress(value)
+        return value
+
+    def _numpy_columns(self):
+        records = numpy.frombuffer(self.records, RECORD_DTYPE, self.count)
+        columns = dict()
+        for name in COLUMNS[:-1]:
+            columns[name] = records[name]
+        key_length = records['key_length'].astype('u4')
+        columns['value_length'] = records['bodylen'] - MUTATION_EXTLEN - \
+            key_length
+        columns['key_offset'] = numpy.frombuffer(self.offsets, 'u4')
+        columns['value_offset'] = numpy.frombuffer(self.value_offsets, 'u4')
+        return columns
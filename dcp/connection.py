@@ -1,224 +1,958 @@
+import errno
 import logging
-import select
 import socket
-import struct
 import threading
 import time
 
-from constants import (HEADER_LEN, PKT_HEADER_FMT, CMD_OPEN, CMD_STREAM_REQ,
-                       CMD_MUTATION, CMD_DELETION, CMD_SASL_AUTH,
-                       CMD_SNAPSHOT_MARKER, CMD_STREAM_END, RES_MAGIC, SUCCESS)
-
-class ConnectionManager(threading.Thread):
-
-    def __init__(self, handler):
-        threading.Thread.__init__(self)
+from buffer import ReadBuffer, WriteBuffer
+from coalesce import Coalescer
+from codec import (BY_SEQNO, DELETION_EXTRAS, EXPIRATION_EXTRAS,
+                   MARKER_EXTRAS, MUTATION_EXTRAS, STREAM_END_EXTRAS)
+from columns import MutationBatch
+from constants import (HEADER_LEN, CMD_STREAM_REQ, CMD_MUTATION,
+                       CMD_DELETION, CMD_EXPIRATION, CMD_SNAPSHOT_MARKER,
+                       CMD_STATS, CMD_STREAM_END, CMD_NOOP, RES_MAGIC,
+                       SUCCESS, ERR_ECLIENT, ERR_NOT_MY_VBUCKET,
+                       STREAM_END_STATE_CHANGED, STREAM_END_DISCONNECTED)
+from events import (Deletion, Expiration, Mutation, SnapshotMarker,
+                    StreamEnd)
+from handler import ColumnarResponseHandler
+from operation import BufferAck, CloseStream, NoopResponse, OpenConnection
+from reactor import Reactor
+from streams import StreamState
+
+# Socket reads start at READ_SIZE bytes and double up to MAX_READ_SIZE while
+# the socket keeps filling them
+READ_SIZE = 65536
+MAX_READ_SIZE = 4194304
+
+# With flow control enabled, consumed bytes are acknowledged once they reach
+# this fraction of the connection buffer size
+BUFFER_ACK_RATIO = 0.2
+
+# Seconds between checks for operations that have passed their deadline and
+# connections that have gone quiet
+CHECK_INTERVAL = 0.1
+
+class ConnectionManager(object):
+
+    # Holds the connections and streams of one client. Their I/O runs on an
+    # event loop of reactor, which may be shared with other clients, or of a
+    # reactor of the manager's own.
+    def __init__(self, handler, read_size=READ_SIZE,
+                 max_read_size=MAX_READ_SIZE, rcvbuf=None, dispatcher=None,
+                 connections_per_node=1, reactor=None):
         self.handler = handler
+        self.connections_per_node = connections_per_node
+        self.dispatcher = dispatcher
+        self.reads_paused = False
+        self.read_size = read_size
+        self.max_read_size = max_read_size
+        self.rcvbuf = rcvbuf
         self.cluster_config = None
         self.bucket_config = None
 
         self.connections = list()
-        self.readers = list()
-        self.writers = list()
-
-        self.daemon = True
-        self.running = True
-        self.start()
+        self.connections_by_host = dict()
+        # Connections to close and streams to end on the I/O thread
+        self.lock = threading.Lock()
+        self.closing = set()
+        # Streams to end because their connection could not be restored
+        self.failed = set()
+
+        # Progress of every open stream keyed by vbucket. Set a topology
+        # manager to have streams follow their vbuckets between nodes.
+        self.streams = dict()
+        self.topology = None
+
+        # Set a checkpoint store to record the progress of delivered events
+        self.checkpoints = None
+
+        # Set a key filter to drop events in the decode path
+        self.key_filter = None
+
+        # Set a Metrics object to record histograms of the I/O loop
+        self.metrics = None
+
+        # Seconds an operation may wait for its response before it fails
+        self.op_timeout = None
+        self.check_at = 0
+
+        # Seconds a connection may go without receiving anything before it is
+        # treated as lost. Only useful with noops enabled, since the server
+        # is otherwise quiet while there is nothing to stream.
+        self.idle_timeout = None
+
+        # Set a Reconnector to restore lost connections and their streams.
+        # Otherwise the streams of a lost connection are ended.
+        self.reconnector = None
+
+        # Set a CaptureWriter to record everything read from the connections
+        self.capture = None
+
+        # Set to the bytes each connection may hold back to only deliver the
+        # last event for every key in a snapshot
+        self.coalesce_buffer_size = None
+
+        self.owns_reactor = reactor is None
+        if reactor is None:
+            reactor = Reactor()
+        self.reactor = reactor
+        self.loop = reactor.register(self)
+        if dispatcher is not None:
+            dispatcher.on_resume = self.wakeup
 
     def connect(self, cluster_config, bucket_config):
         self.cluster_config = cluster_config
         self.bucket_config = bucket_config
         for name, node in cluster_config.items():
-            conn = DcpConnection(node['host'], node['data_port'], self.handler)
-            conn.connect()
-            self.readers.append(conn.socket)
-            self.connections.append(conn)
+            self._connect_node(node)
+
+    # Switches to a new cluster map. Connections are opened to nodes that
+    # joined and passed to setup, which must authenticate and open them,
+    # before the new vbucket map is used. Connections to nodes that left are
+    # closed.
+    def update_topology(self, cluster_config, bucket_config, setup):
+        added = list()
+        hostnames = set()
+        for name, node in cluster_config.items():
+            hostname = node['host'] + ':' + str(node['data_port'])
+            hostnames.add(hostname)
+            if hostname not in self.connections_by_host:
+                added.extend(self._connect_node(node))
+        if len(added) > 0:
+            setup(added)
+
+        self.cluster_config = cluster_config
+        self.bucket_config = bucket_config
+
+        for hostname, conns in self.connections_by_host.items():
+            if hostname not in hostnames:
+                del self.connections_by_host[hostname]
+                self.lock.acquire()
+                self.closing.update(conns)
+                self.lock.release()
+        self.wakeup()
+
+    # Sends an OpenConnection on every connection. Connections to the same
+    # node need distinct names, so with several connections per node each
+    # name gets the connection index appended.
+    def open_connections(self, flags, name, latch, connections=None):
+        if connections is None:
+            connections = self.connections
+        ops = list()
+        for connection in connections:
+            if self.connections_per_node > 1:
+                op = OpenConnection(flags, '%s:%d' % (name, connection.index),
+                                    latch)
+            else:
+                op = OpenConnection(flags, name, latch)
+            connection.write(op)
+            self.schedule_write(connection)
+            ops.append(op)
+        return ops
 
     def add_operation(self, operation, vbucket):
-        host = self.bucket_config['vbmap'][vbucket]
-        conn = self._get_connection_by_host(host)
+        conn = self._get_connection(vbucket)
 
         if conn is None:
             logging.warning('Trying to send op, but cannot find connection')
+            operation.network_error()
         else:
-            conn.write(operation)
-            self.writers.append(conn.socket)
             if operation.opcode is CMD_STREAM_REQ:
-                self.handler._incr_active_streams()
-
-    def add_operation_all(self, operation):
-        for connection in self.connections:
+                self._track_stream(operation, conn)
+            conn.write(operation)
+            self.schedule_write(conn)
+
+    # Sends operations for many vbuckets, batching all of the operations for
+    # a node into a single write
+    def add_operations(self, operations):
+        batches = dict()
+        for operation in operations:
+            conn = self._get_connection(operation.vbucket)
+            if conn is None:
+                logging.warning('Trying to send op, but cannot find connection')
+                operation.network_error()
+                if operation.opcode is CMD_STREAM_REQ and operation.resume:
+                    if not self.stream_failed(operation, ERR_NOT_MY_VBUCKET):
+                        self.handler._decr_active_streams()
+                continue
+            batches.setdefault(conn, list()).append(operation)
+
+        for conn, batch in batches.items():
+            for operation in batch:
+                if operation.opcode is CMD_STREAM_REQ:
+                    self._track_stream(operation, conn)
+            conn.write_all(batch)
+            self.schedule_write(conn)
+
+    # Called from the I/O thread when a stream request fails. Returns True if
+    # the request is going to be retried.
+    def stream_failed(self, operation, status):
+        if self.reconnector is not None and \
+                self.reconnector.stream_failed(operation, status):
+            return True
+        if self.topology is not None and \
+                self.topology.stream_failed(operation, status):
+            return True
+        self.streams.pop(operation.vbucket, None)
+        return False
+
+    # Called from the I/O thread when a stream ends. Returns True if the
+    # stream is going to be reopened, in which case the end is not delivered.
+    def stream_ended(self, vbucket, flags):
+        if self.topology is not None and \
+                flags == STREAM_END_STATE_CHANGED and \
+                self.topology.stream_moved(vbucket):
+            return True
+        self.streams.pop(vbucket, None)
+        return False
+
+    def add_operation_all(self, operation, connections=None):
+        if connections is None:
+            connections = self.connections
+        for connection in connections:
             connection.write(operation)
-            self.writers.append(connection.socket)
-
-    def run(self):
-        bytes_read = ''
-        while self.running:
-            r_ready, w_ready, errors = select.select(self.readers,
-                                                     self.writers,
-                                                     [], .25) # Add better timeout
-            
-            for reader in r_ready:
-                data = reader.recv(1024)
-
-                conn = self._get_connection_by_socket(reader)
-
-                if conn is None:
-                    logging.warn('Read response, but can\'t find a connection')
-                    self.readers.remove(reader)
-
-                if len(data) == 0:
-                    logging .info('Connection lost')
-                    #logger.info("Connection lost for %s:%d", conn.host, conn.port)
-                    #self._connection_lost()
-                else:
-                    conn.bytes_read(data)
-
-            for writer in w_ready:
-                conn = self._get_connection_by_socket(writer)
-                if conn is None:
-                    logging.warn('Cannot write response, no connection')
-                else:
-                    conn.socket_write()
-                self.writers.remove(writer)
+            self.schedule_write(connection)
+
+    def set_flow_control(self, buffer_size, connections=None):
+        if connections is None:
+            connections = self.connections
+        for connection in connections:
+            connection.set_flow_control(buffer_size)
+
+    # Returns the vbuckets with open streams that were requested on conn.
+    # They stay with conn after its node leaves the vbucket map.
+    def streams_on(self, conn):
+        return [vbucket for vbucket, state in self.streams.items() if
+                state.connection is conn]
+
+    # Streams that were open on a node which has left the cluster are
+    # reopened on the new owner of their vbucket when following the
+    # topology, and ended with STREAM_END_DISCONNECTED otherwise
+    def streams_moved(self, vbuckets):
+        ended = [vbucket for vbucket in vbuckets if self.topology is None or
+                 not self.topology.stream_moved(vbucket)]
+        if len(ended) > 0:
+            self.end_streams(ended)
+
+    # Ends the streams of vbuckets with STREAM_END_DISCONNECTED, on the I/O
+    # thread
+    def end_streams(self, vbuckets):
+        self.lock.acquire()
+        self.failed.update(vbuckets)
+        self.lock.release()
+        self.wakeup()
+
+    # Opens a connection in place of conn, which was lost, and returns it.
+    # Returns None if the node cannot be reached or has left the cluster.
+    # The streams of conn move to the new connection straight away, so they
+    # are found on it if it is lost as well before they are reopened.
+    def reconnect(self, conn):
+        new = DcpConnection(conn.host, conn.port, self.handler,
+                            self.read_size, self.max_read_size, self.rcvbuf,
+                            self)
+        new.index = conn.index
+        new.connect()
+        if new.socket is None:
+            return None
+        conns = self.connections_by_host.get(conn.hostname)
+        if conns is None or conn not in conns:
+            new.close()
+            return None
+        conns[conns.index(conn)] = new
+        for state in self.streams.values():
+            if state.connection is conn:
+                state.connection = new
+        if conn in self.connections:
+            self.connections.remove(conn)
+        self.connections.append(new)
+        self.loop.add(new)
+        return new
+
+    def wakeup(self):
+        self.loop.wakeup()
+
+    # Called by the event loop before it polls
+    def _before_poll(self):
+        if self.dispatcher is not None:
+            self._update_reads()
+
+    # Called by the event loop after the ready connections have been read
+    # and written
+    def _after_poll(self):
+        if len(self.closing) > 0:
+            self.lock.acquire()
+            closing, self.closing = self.closing, set()
+            self.lock.release()
+            for conn in closing:
+                self._close_connection(conn)
+
+        if len(self.failed) > 0:
+            self.lock.acquire()
+            failed, self.failed = self.failed, set()
+            self.lock.release()
+            for vbucket in failed:
+                self._end_stream(vbucket)
+
+        if self.dispatcher is None:
+            self.handler.flush()
+
+        if self.op_timeout is not None or self.idle_timeout is not None:
+            self._check_connections()
 
     def close(self):
-        self.running = False
-        self.join()
+        self.reactor.unregister(self)
         for conn in self.connections:
             conn.close()
+        if self.owns_reactor:
+            self.reactor.close()
         self.connections = None
-        self.readers = list()
-        self.writers = list()
-
-    def _get_connection_by_host(self, host):
-        for conn in self.connections:
-            if conn.compare_by_host(host):
-                return conn
-        return None
+        self.connections_by_host = dict()
+
+    def _connect_node(self, node):
+        added = list()
+        for index in range(self.connections_per_node):
+            conn = DcpConnection(node['host'], node['data_port'],
+                                 self.handler, self.read_size,
+                                 self.max_read_size, self.rcvbuf, self)
+            conn.index = index
+            conn.connect()
+            if conn.socket is None:
+                logging.warning('Unable to connect to %s', conn.hostname)
+                continue
+            self.connections.append(conn)
+            self.connections_by_host.setdefault(conn.hostname,
+                                                list()).append(conn)
+            self.loop.add(conn)
+            added.append(conn)
+        return added
+
+    # A stream request that is retried after a move keeps its existing state
+    # and still counts as an active stream
+    def _track_stream(self, operation, conn):
+        if operation.resume:
+            state = self.streams.get(operation.vbucket)
+            if state is not None:
+                state.connection = conn
+            return
+        state = StreamState(operation.vbucket, operation.flags,
+                            operation.start_seqno, operation.end_seqno,
+                            operation.vb_uuid, operation.snap_start,
+                            operation.snap_end)
+        state.connection = conn
+        self.streams[operation.vbucket] = state
+        self.handler._incr_active_streams()
+
+    # vbuckets are sharded across the connections to their node
+    def _get_connection(self, vbucket):
+        host = self.bucket_config['vbmap'].get(vbucket)
+        conns = self.connections_by_host.get(host)
+        if not conns:
+            return None
+        return conns[vbucket % len(conns)]
+
+    def schedule_write(self, conn):
+        self.loop.schedule_write(conn)
+
+    # Stops polling sockets for reads while the dispatcher is paused so the
+    # server is pushed back on instead of filling the dispatch queues. Time
+    # spent paused does not count towards the idle timeout.
+    def _update_reads(self):
+        paused = self.dispatcher.is_paused()
+        if paused == self.reads_paused:
+            return
+        self.reads_paused = paused
+        now = time.time()
+        for conn in list(self.connections):
+            if not paused:
+                conn.last_read = now
+            self.loop.modify(conn)
+
+    def _close_connection(self, conn):
+        self._connection_lost(conn)
+        if conn in self.connections:
+            self.connections.remove(conn)
+
+    # A lost connection is closed, its pending operations fail and the events
+    # it held back are delivered. If its node is still part of the cluster,
+    # the reconnector takes over its streams, or without one they are ended.
+    # Streams of a node that has left the cluster move to the new owners of
+    # their vbuckets.
+    def _connection_lost(self, conn):
+        if conn.closed:
+            return
+        self.loop.remove(conn)
+        conn.close()
+        conn.fail_ops()
+        conn.flush_held()
+
+        if conn not in self.connections_by_host.get(conn.hostname, ()):
+            self.streams_moved(self.streams_on(conn))
+            return
+        if self.reconnector is not None:
+            self.reconnector.connection_lost(conn)
+        else:
+            for vbucket in self.streams_on(conn):
+                self._end_stream(vbucket)
+
+    def _end_stream(self, vbucket):
+        conn = self._get_connection(vbucket)
+        if conn is not None:
+            conn.end_stream(vbucket, STREAM_END_DISCONNECTED)
+            return
+        if self.streams.pop(vbucket, None) is None:
+            return
+        response = StreamEnd(vbucket, STREAM_END_DISCONNECTED)
+        if self.handler.dict_events:
+            response = response.to_dict()
+        self.handler.stream_end(response)
+        self.handler._decr_active_streams()
 
-    def _get_connection_by_socket(self, socket):
-        for conn in self.connections:
-            if conn.compare_by_socket(socket):
-                return conn
-        return None
+    # Checks a few times a second for operations that have passed their
+    # deadline and connections that have been quiet for too long. Nothing is
+    # read while reads are paused, so connections are not idle then.
+    def _check_connections(self):
+        now = time.time()
+        if now < self.check_at:
+            return
+        self.check_at = now + CHECK_INTERVAL
+        for conn in list(self.connections):
+            if conn.closed:
+                continue
+            if self.op_timeout is not None:
+                conn.expire_ops(now)
+            if self.idle_timeout is not None and not self.reads_paused and \
+                    now - conn.last_read > self.idle_timeout:
+                logging.warning('Nothing received from %s for %.1f seconds',
+                                conn.hostname, now - conn.last_read)
+                self._connection_lost(conn)
 
 class DcpConnection(object):
 
-    def __init__(self, host, port, handler):
+    def __init__(self, host, port, handler, read_size=READ_SIZE,
+                 max_read_size=MAX_READ_SIZE, rcvbuf=None, manager=None):
         self.host = host
         self.port = port
+        self.hostname = host + ':' + str(port)
+        self.index = 0
         self.handler = handler
-        self.toRead = ''
-        self.toWrite = ''
+        self.min_read_size = read_size
+        self.read_size = read_size
+        self.max_read_size = max_read_size
+        self.rcvbuf = rcvbuf
+        self.manager = manager
+        self.dispatcher = None
+        self.streams = dict()
+        self.checkpoints = None
+        self.key_filter = None
+        self.metrics = None
+        self.op_timeout = None
+        self.capture = None
+        self.coalescer = None
+        if manager is not None:
+            self.dispatcher = manager.dispatcher
+            self.streams = manager.streams
+            self.checkpoints = manager.checkpoints
+            self.key_filter = manager.key_filter
+            self.metrics = manager.metrics
+            self.op_timeout = manager.op_timeout
+            self.capture = manager.capture
+            if manager.coalesce_buffer_size is not None:
+                self.coalescer = Coalescer(self._deliver_now, self._held,
+                                           manager.coalesce_buffer_size)
+        self.delivered = list()
+        self.filtered = 0
+
+        # Counters reported by Metrics
+        self.reads = 0
+        self.bytes_received = 0
+        self.frames = 0
+        self.writes = 0
+        self.bytes_sent = 0
+        self.acked = 0
+        self.columns = None
+        if isinstance(handler, ColumnarResponseHandler):
+            self.columns = MutationBatch(handler.copy_values)
+        self.buffer_size = None
+        self.ack_threshold = 0
+        self.unacked = 0
+        self.ackLock = threading.Lock()
+        self.toRead = ReadBuffer()
+        self.toWrite = WriteBuffer()
         self.socket = None
+        self.closed = False
+        self.last_read = time.time()
         self.writeLock = threading.Lock()
-        self.ops = list()
+        # Operations waiting for a response, by opaque
+        self.ops = dict()
+
+        # Decoders for the packets the producer sends, by opcode
+        self.decoders = {CMD_MUTATION: self._handle_mutation,
+                         CMD_DELETION: self._handle_deletion,
+                         CMD_EXPIRATION: self._handle_expiration,
+                         CMD_SNAPSHOT_MARKER: self._handle_marker,
+                         CMD_STREAM_END: self._handle_stream_end}
 
     def connect(self):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.rcvbuf is not None:
+                # Must be set before connecting for the window scale to apply
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                       self.rcvbuf)
             self.socket.connect((self.host, self.port))
+            self.socket.setblocking(0)
+            self.last_read = time.time()
         except Exception, e:
             self.socket = None
 
     def compare_by_host(self, hostname):
-        name = self.host + ':' + str(self.port)
-        return name == hostname
+        return self.hostname == hostname
 
     def compare_by_socket(self, socket):
         return self.socket == socket
 
+    # Reads everything available on the socket straight into the read buffer
+    # and processes the complete frames. Returns False if the peer closed the
+    # connection.
+    def socket_read(self):
+        toRead = self.toRead
+        budget = self.max_read_size * 2
+        first = True
+        while budget > 0:
+            size = self.read_size
+            toRead.reserve(size)
+            try:
+                read = self.socket.recv_into(toRead.view[toRead.wpos:], size)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            if read == 0:
+                self._process_frames()
+                return False
+            if self.capture is not None:
+                self.capture.record(self, toRead.view[toRead.wpos:
+                                                      toRead.wpos + read])
+            toRead.wpos += read
+            budget -= read
+            self.reads += 1
+            self.bytes_received += read
+
+            if read == size:
+                self.read_size = min(size * 2, self.max_read_size)
+            elif first and read < size / 4:
+                self.read_size = max(size / 2, self.min_read_size)
+            first = False
+
+        if not first:
+            self.last_read = time.time()
+        self._process_frames()
+        return True
+
     def bytes_read(self, bytes):
-        self.toRead += bytes
+        if self.capture is not None:
+            self.capture.record(self, bytes)
+        self.toRead.write(bytes)
+        self._process_frames()
+
+    def set_flow_control(self, buffer_size):
+        self.ackLock.acquire()
+        self.buffer_size = buffer_size
+        if buffer_size is not None:
+            self.ack_threshold = int(buffer_size * BUFFER_ACK_RATIO)
+        self.unacked = 0
+        self.ackLock.release()
+
+    # Counts stream bytes the handler is done with and sends a buffer ack
+    # once they cross the ack threshold
+    def bytes_consumed(self, size):
+        if self.buffer_size is None:
+            return
+        self.ackLock.acquire()
+        self.unacked += size
+        if self.unacked < self.ack_threshold:
+            self.ackLock.release()
+            return
+        unacked = self.unacked
+        self.unacked = 0
+        self.acked += unacked
+        self.ackLock.release()
 
-        while len(self.toRead) >= HEADER_LEN:
+        self.writeLock.acquire()
+        try:
+            self._encode([BufferAck(unacked)])
+        finally:
+            self.writeLock.release()
+        if self.manager is not None:
+            self.manager.schedule_write(self)
+
+    def _process_frames(self):
+        buf = self.toRead.buf
+        decoders = self.decoders
+        metrics = self.metrics
+        consumed = 0
+        frames = 0
+        for header, pos in self.toRead.frames():
             magic, opcode, keylen, extlen, dt, status, bodylen, opaque, cas = \
-                struct.unpack(PKT_HEADER_FMT, self.toRead[0:HEADER_LEN])
-            
-            if len(self.toRead) < (HEADER_LEN + bodylen):
-                break
-                
-            body = self.toRead[HEADER_LEN:HEADER_LEN + bodylen]
-            packet = self.toRead[0:HEADER_LEN + bodylen]
-            self.toRead = self.toRead[HEADER_LEN+bodylen:]
-
-            if opcode in [CMD_OPEN, CMD_STREAM_REQ, CMD_SASL_AUTH]:
-                if opcode is CMD_STREAM_REQ and status is not SUCCESS:
-                    self.handler._decr_active_streams()
-
-                for oper in self.ops:
-                    if oper.opaque == opaque:
-                        oper.add_response(opcode, keylen, extlen,
-                                          status, cas, body)
-            elif opcode is CMD_MUTATION:
-                self._handle_mutation(keylen, extlen, status, cas, body)
-            elif opcode is CMD_DELETION:
-                self._handle_deletion(keylen, extlen, status, cas, body)
-            elif opcode is CMD_SNAPSHOT_MARKER:
-                self._handle_marker(extlen, status, body)
-            elif opcode is CMD_STREAM_END:
-                self._handle_stream_end(extlen, status, body)
-            else:
+                header
+            pos += HEADER_LEN
+            frames += 1
+            if metrics is not None:
+                metrics.frame_bytes.observe(HEADER_LEN + bodylen)
+
+            if magic == RES_MAGIC:
+                self._handle_response(opcode, keylen, extlen, status, opaque,
+                                      cas, pos, bodylen)
+                continue
+            # Noops are answered straight away and are not flow controlled
+            if opcode == CMD_NOOP:
+                self._handle_noop(opaque)
+                continue
+            decoder = decoders.get(opcode)
+            if decoder is not None and (self.manager is None or
+                                        status in self.streams):
+                if self.dispatcher is None:
+                    consumed += HEADER_LEN + bodylen
+                decoder(keylen, extlen, status, cas, buf, pos, bodylen)
+                continue
+            # Unknown opcodes and events for a stream that is not open, such
+            # as one whose request timed out before the server answered, are
+            # dropped and acknowledged straight away
+            if decoder is None:
                 logging.warn('Unknown Op: %d %d' % (opcode, status))
+            consumed += HEADER_LEN + bodylen
+
+        self.frames += frames
+        if self.columns is not None and len(self.columns) > 0:
+            self._flush_columns()
+        # Events are only checkpointed once the handler has processed them,
+        # so a handler that batches them must pass them on first
+        self.handler.flush(len(self.delivered) > 0)
+        if self.filtered > 0:
+            consumed += self.filtered
+            self.filtered = 0
+        if len(self.delivered) > 0:
+            self.checkpoints.record(self.delivered)
+            self.delivered = list()
+        if consumed > 0:
+            self.bytes_consumed(consumed)
 
     def write(self, op):
+        if self.closed:
+            self._fail_op(op)
+            return False
         self.writeLock.acquire()
-        regSocket = len(self.toWrite) == 0
-        self.toWrite += op.bytes()
-        self.ops.append(op)
-        self.writeLock.release()
+        try:
+            regSocket = len(self.toWrite) == 0
+            self._encode([op])
+            self._add_pending([op])
+        finally:
+            self.writeLock.release()
         return regSocket
 
+    def write_all(self, ops):
+        if self.closed:
+            for op in ops:
+                self._fail_op(op)
+            return False
+        self.writeLock.acquire()
+        try:
+            regSocket = len(self.toWrite) == 0
+            self._encode(ops)
+            self._add_pending(ops)
+        finally:
+            self.writeLock.release()
+        return regSocket
+
+    def _add_pending(self, ops):
+        deadline = None
+        if self.op_timeout is not None:
+            deadline = time.time() + self.op_timeout
+        for op in ops:
+            if deadline is not None and op.deadline is None:
+                op.deadline = deadline
+            self.ops[op.opaque] = op
+
+    # Fails operations whose deadline has passed. The server may still open
+    # a stream whose request timed out, so it is asked to close it again.
+    def expire_ops(self, now):
+        for opaque, op in self.ops.items():
+            if op.deadline is not None and op.deadline <= now:
+                logging.warning('Operation 0x%02x timed out on %s', op.opcode,
+                                self.hostname)
+                self._fail_op(self.ops.pop(opaque))
+                if op.opcode is CMD_STREAM_REQ:
+                    self.write(CloseStream(op.vbucket))
+                    if self.manager is not None:
+                        self.manager.schedule_write(self)
+
+    # Fails every pending operation, once the connection is gone
+    def fail_ops(self):
+        ops, self.ops = self.ops, dict()
+        for op in ops.values():
+            self._fail_op(op)
+
+    def _fail_op(self, op):
+        op.network_error()
+        if op.opcode is CMD_STREAM_REQ:
+            self._stream_response(op, ERR_ECLIENT)
+
+    # Packs ops in a single pass straight into the output buffer. If an op
+    # fails to pack, everything reserved for ops is dropped again, so the
+    # server never sees a partial packet. The caller must hold writeLock.
+    def _encode(self, ops):
+        toWrite = self.toWrite
+        start = toWrite.reserve(sum([op.size() for op in ops]))
+        offset = start
+        try:
+            for op in ops:
+                offset = op.encode_into(toWrite.buf, offset)
+        except Exception:
+            toWrite.truncate(start)
+            raise
+
+    # Sends as much of the queued output as the kernel takes. Everything
+    # queued since the last call goes out together, and whatever the kernel
+    # does not take stays queued until the socket is writable again.
     def socket_write(self):
         self.writeLock.acquire()
-        # Assume we can always write since writes are rare
-        # This may need to be fixed in the future
-        self.socket.send(self.toWrite)
-        self.toWrite = ''
-        self.writeLock.release()
+        try:
+            toWrite = self.toWrite
+            while len(toWrite) > 0:
+                try:
+                    sent = self.socket.send(toWrite.pending())
+                except socket.error, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                toWrite.consume(sent)
+                self.writes += 1
+                self.bytes_sent += sent
+        finally:
+            self.writeLock.release()
 
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
         self.socket.close()
 
-    def _handle_mutation(self, keylen, extlen, status, cas, body):
+    def _handle_response(self, opcode, keylen, extlen, status, opaque, cas,
+                         pos, bodylen):
+        oper = self.ops.get(opaque)
+        if oper is None:
+            return
+        # Stats come as one response per stat, ended by one with no key
+        if opcode != CMD_STATS or keylen == 0:
+            del self.ops[opaque]
+        body = self.toRead.view[pos:pos + bodylen].tobytes()
+        oper.add_response(opcode, keylen, extlen, status, cas, body)
+        if opcode is CMD_STREAM_REQ:
+            self._stream_response(oper, status)
+
+    def _handle_noop(self, opaque):
+        self.writeLock.acquire()
+        try:
+            self._encode([NoopResponse(opaque)])
+        finally:
+            self.writeLock.release()
+        if self.manager is not None:
+            self.manager.schedule_write(self)
+
+    def _handle_mutation(self, keylen, extlen, status, cas, buf, pos, bodylen):
+        if self.key_filter is not None and not \
+                self.key_filter.match(buf[pos + extlen:pos + extlen + keylen]):
+            self._filtered(status, buf, pos, bodylen)
+            return
+
+        # Columnar batches skip per-mutation work and record stream progress
+        # once per batch
+        if self.columns is not None:
+            self.columns.append(self.toRead.view, pos - HEADER_LEN, keylen,
+                                extlen, bodylen)
+            if len(self.columns) >= self.handler.max_batch_size:
+                self._flush_columns()
+            return
+
         assert extlen == 31
         by_seqno, rev_seqno, flags, exp, lock_time, ext_meta_len, nru = \
-            struct.unpack(">QQIIIHB", body[0:extlen])
-        key = body[extlen:extlen+keylen]
-        value = body[extlen+keylen:]
-        self.handler.mutation({'vbucket': status,
-                               'by_seqno': by_seqno,
-                               'rev_seqno': rev_seqno,
-                               'flags': flags,
-                               'expiration': exp,
-                               'lock_time': lock_time,
-                               'nru': nru,
-                               'key': key})#,
-                               #'value': value})
-
-    def _handle_deletion(self, keylen, extlen, status, cas, body):
+            MUTATION_EXTRAS.unpack_from(buf, pos)
+        state = self.streams.get(status)
+        if state is not None:
+            state.seqno = by_seqno
+            state.events += 1
+        frame = self.toRead.view[pos - HEADER_LEN:pos + bodylen].tobytes()
+        self._deliver(self.handler.mutation, bodylen,
+                      Mutation(status, by_seqno, rev_seqno, flags, exp,
+                               lock_time, nru, frame, extlen, keylen))
+
+    def _handle_deletion(self, keylen, extlen, status, cas, buf, pos, bodylen):
+        if self.key_filter is not None and not \
+                self.key_filter.match(buf[pos + extlen:pos + extlen + keylen]):
+            self._filtered(status, buf, pos, bodylen)
+            return
+
+        assert extlen == 18
+        by_seqno, rev_seqno, ext_meta_len = \
+            DELETION_EXTRAS.unpack_from(buf, pos)
+        state = self.streams.get(status)
+        if state is not None:
+            state.seqno = by_seqno
+            state.events += 1
+        frame = self.toRead.view[pos - HEADER_LEN:pos + bodylen].tobytes()
+        self._deliver(self.handler.deletion, bodylen,
+                      Deletion(status, by_seqno, rev_seqno, frame, extlen,
+                               keylen))
+
+    def _handle_expiration(self, keylen, extlen, status, cas, buf, pos,
+                           bodylen):
+        if self.key_filter is not None and not \
+                self.key_filter.match(buf[pos + extlen:pos + extlen + keylen]):
+            self._filtered(status, buf, pos, bodylen)
+            return
+
         assert extlen == 18
         by_seqno, rev_seqno, ext_meta_len = \
-            struct.unpack(">QQH", body[0:extlen])
-        key = body[extlen:extlen+keylen]
-        self.handler.deletion({'vbucket': status,
-                               'by_seqno': by_seqno,
-                               'rev_seqno': rev_seqno,
-                               'key': key})
-
-    def _handle_marker(self, extlen, status, body):
+            EXPIRATION_EXTRAS.unpack_from(buf, pos)
+        state = self.streams.get(status)
+        if state is not None:
+            state.seqno = by_seqno
+            state.events += 1
+        frame = self.toRead.view[pos - HEADER_LEN:pos + bodylen].tobytes()
+        self._deliver(self.handler.expiration, bodylen,
+                      Expiration(status, by_seqno, rev_seqno, frame, extlen,
+                                 keylen))
+
+    def _handle_marker(self, keylen, extlen, status, cas, buf, pos, bodylen):
         assert extlen == 20
         snap_start, snap_end, snap_type = \
-            struct.unpack(">QQI", body[0:extlen])
-        self.handler.marker({'vbucket': status,
-                             'snap_start': snap_start,
-                             'snap_end': snap_end,
-                             'snap_type': snap_type})
-
-    def _handle_stream_end(self, extlen, status, body):
+            MARKER_EXTRAS.unpack_from(buf, pos)
+        state = self.streams.get(status)
+        if state is not None:
+            state.snap_start = snap_start
+            state.snap_end = snap_end
+        if self.coalescer is not None:
+            self.coalescer.marker(status, snap_end)
+        self._deliver(self.handler.marker, bodylen,
+                      SnapshotMarker(status, snap_start, snap_end, snap_type))
+
+    def _handle_stream_end(self, keylen, extlen, status, cas, buf, pos,
+                           bodylen):
         assert extlen == 4
-        flags = struct.unpack(">I", body[0:extlen])[0]
-        self.handler.stream_end({'vbucket': status,
-                                 'flags': flags})
+        flags = STREAM_END_EXTRAS.unpack_from(buf, pos)[0]
+        if self.coalescer is not None:
+            self.coalescer.flush(status)
+        if self.manager is not None and \
+                self.manager.stream_ended(status, flags):
+            # Without a dispatcher the frame is already counted as consumed
+            if self.dispatcher is not None:
+                self.bytes_consumed(HEADER_LEN + bodylen)
+            return
+        self._deliver(self._stream_end, bodylen, StreamEnd(status, flags))
+
+    # Delivers the events held back to be coalesced once the connection is
+    # lost. The progress of its streams already includes them, so they would
+    # be skipped when the streams are reopened.
+    def flush_held(self):
+        if self.coalescer is None:
+            return
+        self.coalescer.flush_all()
+        self.handler.flush(len(self.delivered) > 0)
+        if len(self.delivered) > 0:
+            self.checkpoints.record(self.delivered)
+            self.delivered = list()
+
+    # Ends a stream the server can no longer end, because its connection was
+    # lost. Events held back for it are delivered first.
+    def end_stream(self, vbucket, flags):
+        if self.streams.pop(vbucket, None) is None:
+            return
+        if self.coalescer is not None:
+            self.coalescer.flush(vbucket)
+        self._deliver(self._stream_end, 0, StreamEnd(vbucket, flags))
+
+    # Events that do not match the key filter still move the stream forward,
+    # and with a dispatcher their bytes are acknowledged with the next read.
+    # They are not checkpointed until an event for the vbucket is delivered.
+    def _filtered(self, vbucket, buf, pos, bodylen):
+        state = self.streams.get(vbucket)
+        if state is not None:
+            state.seqno = BY_SEQNO.unpack_from(buf, pos)[0]
+            state.events += 1
+        if self.coalescer is not None:
+            self.coalescer.seqno(vbucket, BY_SEQNO.unpack_from(buf, pos)[0])
+        if self.dispatcher is not None:
+            self.filtered += HEADER_LEN + bodylen
+
+    # Events held back to be coalesced may never be delivered, and the
+    # snapshot they belong to may not complete until the server sends more.
+    # With a dispatcher they are acknowledged when they are held, and
+    # delivered without acknowledging them again.
+    def _held(self, bodylen):
+        if self.dispatcher is not None:
+            self.filtered += HEADER_LEN + bodylen
+
+    def _stream_response(self, op, status):
+        if status == SUCCESS:
+            state = self.streams.get(op.vbucket)
+            if state is not None and len(op.result['failover_log']) > 0:
+                state.vb_uuid = op.result['failover_log'][0][0]
+                state.attempts = 0
+            if self.checkpoints is not None and \
+                    len(op.result['failover_log']) > 0:
+                self.checkpoints.opened(op.vbucket,
+                                        op.result['failover_log'][0][0],
+                                        op.start_seqno, op.snap_start,
+                                        op.snap_end, op.resume)
+        elif self.manager is None or not self.manager.stream_failed(op, status):
+            self.handler._decr_active_streams()
+
+    def _stream_end(self, response):
+        self.handler.stream_end(response)
         self.handler._decr_active_streams()
+
+    # Hands a decoded event to the handler, either directly on the I/O thread
+    # or through the dispatcher, unless it is held back to be coalesced
+    def _deliver(self, callback, bodylen, event):
+        if self.coalescer is not None and \
+                self.coalescer.add(callback, bodylen, event):
+            return
+        self._deliver_now(callback, HEADER_LEN + bodylen, event)
+
+    # size is the number of bytes to acknowledge once a dispatcher worker has
+    # run the callback
+    def _deliver_now(self, callback, size, event):
+        if self.columns is not None and len(self.columns) > 0:
+            self._flush_columns()
+        if self.handler.dict_events:
+            response = event.to_dict()
+        else:
+            response = event
+        if self.dispatcher is None:
+            if self.metrics is None:
+                callback(response)
+            else:
+                start = time.time()
+                callback(response)
+                self.metrics.callback_seconds.observe(time.time() - start)
+            if self.checkpoints is not None:
+                self.delivered.append(response)
+        else:
+            self.dispatcher.dispatch(event.vbucket, callback, response, self,
+                                     size)
+
+    # Stream progress is taken from the batch as a whole, so a stream that is
+    # reopened continues after its last batched mutation
+    def _flush_columns(self):
+        batch = self.columns
+        self.columns = MutationBatch(self.handler.copy_values)
+        for vbucket, (count, seqno) in batch.progress().items():
+            state = self.streams.get(vbucket)
+            if state is not None:
+                state.seqno = seqno
+                state.events += count
+        self.handler.mutations(batch)
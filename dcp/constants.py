@@ -19,6 +19,9 @@ CMD_DELETION         = 0x58
 CMD_EXPIRATION       = 0x59
 CMD_FLUSH            = 0x5a
 CMD_SET_VB_STATE     = 0x5b
+CMD_NOOP             = 0x5c
+CMD_BUFFER_ACK       = 0x5d
+CMD_CONTROL          = 0x5e
 
 # Memcached command opcodes
 
@@ -26,6 +29,7 @@ CMD_SET               = 0x01
 CMD_DELETE            = 0x04
 CMD_FLUSH             = 0x08
 CMD_STATS             = 0x10
+CMD_HELO              = 0x1f
 CMD_SASL_AUTH         = 0x21
 CMD_STOP_PERSISTENCE  = 0x80
 CMD_START_PERSISTENCE = 0x81
@@ -34,6 +38,24 @@ CMD_START_PERSISTENCE = 0x81
 FLAG_OPEN_CONSUMER = 0x00
 FLAG_OPEN_PRODUCER = 0x01
 
+# Datatype bits
+DATATYPE_RAW    = 0x00
+DATATYPE_JSON   = 0x01
+DATATYPE_SNAPPY = 0x02
+DATATYPE_XATTR  = 0x04
+
+# Hello features
+FEATURE_DATATYPE = 0x01
+FEATURE_SNAPPY   = 0x0a
+FEATURE_JSON     = 0x0b
+
+# Stream end flags
+STREAM_END_OK            = 0x00
+STREAM_END_CLOSED        = 0x01
+STREAM_END_STATE_CHANGED = 0x02
+STREAM_END_DISCONNECTED  = 0x03
+STREAM_END_TOO_SLOW      = 0x04
+
 # Error Codes
 SUCCESS             = 0x00
 ERR_KEY_ENOENT      = 0x01
@@ -8,3 +8,12 @@ class ConnectedException(Exception):
     def __str__(self):
         return repr(self.parameter)
 
+
+
+class TimeoutException(Exception):
+
+    def __init__(self, value):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
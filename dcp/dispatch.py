@@ -0,0 +1,128 @@
+
+import collections
+import logging
+import Queue
+import threading
+import time
+
+# Maximum number of events a worker delivers for one vbucket before giving
+# other vbuckets a turn
+DISPATCH_BATCH = 64
+
+class Dispatcher(object):
+
+    # Runs handler callbacks on a pool of worker threads instead of the I/O
+    # thread. Every vbucket has its own queue and always runs on the same
+    # worker, so events for a vbucket are delivered in order, also by
+    # handlers that hold events back per thread.
+    #
+    # When any vbucket queue reaches queue_size the dispatcher is paused and
+    # the connection manager stops reading from its sockets until that queue
+    # has drained to half its size.
+    def __init__(self, handler, workers=4, queue_size=1024):
+        self.handler = handler
+        self.queue_size = queue_size
+        self.low_water = queue_size / 2
+        self.lock = threading.Lock()
+        self.queues = dict()
+        self.scheduled = set()
+        self.full = set()
+        self.ready = list()
+        self.on_resume = None
+        self.checkpoints = None
+        self.metrics = None
+
+        self.workers = list()
+        for i in range(workers):
+            ready = Queue.Queue()
+            self.ready.append(ready)
+            worker = threading.Thread(target=self._run, args=(ready,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def is_paused(self):
+        return len(self.full) > 0
+
+    # Queues callback(response) for delivery. Once it has run, size bytes are
+    # reported as consumed on conn for flow control.
+    def dispatch(self, vbucket, callback, response, conn, size):
+        self.lock.acquire()
+        queue = self.queues.get(vbucket)
+        if queue is None:
+            queue = collections.deque()
+            self.queues[vbucket] = queue
+        queue.append((callback, response, conn, size))
+        if len(queue) >= self.queue_size:
+            self.full.add(vbucket)
+        if vbucket not in self.scheduled:
+            self.scheduled.add(vbucket)
+            self.ready[vbucket % len(self.ready)].put(vbucket)
+        self.lock.release()
+
+    def close(self):
+        for ready in self.ready:
+            ready.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = list()
+
+    # Handlers that batch events pass them on at their own pace, as they do
+    # on the I/O thread. A flush is only forced when the events have to be
+    # checkpointed, and before a worker waits for more work or exits, so
+    # nothing is held back while the stream is quiet.
+    def _run(self, ready):
+        while True:
+            try:
+                vbucket = ready.get_nowait()
+            except Queue.Empty:
+                self._flush(True)
+                vbucket = ready.get()
+            if vbucket is None:
+                self._flush(True)
+                return
+
+            self.lock.acquire()
+            queue = self.queues[vbucket]
+            batch = list()
+            while queue and len(batch) < DISPATCH_BATCH:
+                batch.append(queue.popleft())
+            self.lock.release()
+
+            consumed = dict()
+            metrics = self.metrics
+            for callback, response, conn, size in batch:
+                if metrics is not None:
+                    start = time.time()
+                try:
+                    callback(response)
+                except Exception:
+                    logging.exception('Handler failed on vbucket %d', vbucket)
+                if metrics is not None:
+                    metrics.callback_seconds.observe(time.time() - start)
+                consumed[conn] = consumed.get(conn, 0) + size
+            self._flush(self.checkpoints is not None)
+            if self.checkpoints is not None:
+                self.checkpoints.record([item[1] for item in batch])
+            for conn, size in consumed.items():
+                conn.bytes_consumed(size)
+
+            resume = False
+            self.lock.acquire()
+            if queue:
+                ready.put(vbucket)
+            else:
+                self.scheduled.discard(vbucket)
+            if vbucket in self.full and len(queue) <= self.low_water:
+                self.full.discard(vbucket)
+                resume = len(self.full) == 0
+            self.lock.release()
+
+            if resume and self.on_resume is not None:
+                self.on_resume()
+
+    def _flush(self, force):
+        try:
+            self.handler.flush(force)
+        except Exception:
+            logging.exception('Handler failed to flush')
@@ -0,0 +1,165 @@
+
+import json
+
+from constants import DATATYPE_SNAPPY, HEADER_LEN
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+# Offset of the datatype in the packet header
+DATATYPE_OFFSET = 5
+
+def decompress(value):
+    if snappy is None:
+        raise ImportError("python-snappy is needed to decompress values")
+    return snappy.uncompress(value.tobytes())
+
+
+class Event(object):
+
+    # Events are the responses passed to ResponseHandler callbacks. Fields
+    # are attributes, but they can also be read like a dict so handlers
+    # written against the old dict responses keep working. Handlers that need
+    # real dicts can set dict_events and get to_dict() instead.
+    __slots__ = ()
+    FIELDS = ()
+
+    def __getitem__(self, name):
+        if name not in self.FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self.FIELDS
+
+    def get(self, name, default=None):
+        if name not in self.FIELDS:
+            return default
+        return getattr(self, name)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def to_dict(self):
+        return dict([(name, getattr(self, name)) for name in self.FIELDS])
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.to_dict())
+
+
+class Mutation(Event):
+
+    # The frame is the raw packet. The key is only sliced out of it when it
+    # is first read and the value is a memoryview into it. Values the server
+    # sent compressed are decompressed the first time value is read, and
+    # json parses the value on first use, so handlers that only look at keys
+    # pay for neither.
+    __slots__ = ('vbucket', 'by_seqno', 'rev_seqno', 'flags', 'expiration',
+                 'lock_time', 'nru', 'frame', 'key_start', 'key_end', '_key',
+                 '_value', '_json', '_parsed')
+    FIELDS = ('vbucket', 'by_seqno', 'rev_seqno', 'flags', 'expiration',
+              'lock_time', 'nru', 'datatype', 'key', 'value')
+
+    def __init__(self, vbucket, by_seqno, rev_seqno, flags, expiration,
+                 lock_time, nru, frame, extlen, keylen):
+        self.vbucket = vbucket
+        self.by_seqno = by_seqno
+        self.rev_seqno = rev_seqno
+        self.flags = flags
+        self.expiration = expiration
+        self.lock_time = lock_time
+        self.nru = nru
+        self.frame = frame
+        self.key_start = HEADER_LEN + extlen
+        self.key_end = self.key_start + keylen
+        self._key = None
+        self._value = None
+        # The value may be JSON null, so parsing is tracked apart from the
+        # result
+        self._json = None
+        self._parsed = False
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = self.frame[self.key_start:self.key_end]
+        return self._key
+
+    @property
+    def datatype(self):
+        return ord(self.frame[DATATYPE_OFFSET])
+
+    # The value as sent by the server, which may be compressed
+    @property
+    def raw_value(self):
+        return memoryview(self.frame)[self.key_end:]
+
+    @property
+    def value(self):
+        if self._value is not None:
+            return self._value
+        value = memoryview(self.frame)[self.key_end:]
+        if ord(self.frame[DATATYPE_OFFSET]) & DATATYPE_SNAPPY:
+            self._value = value = decompress(value)
+        return value
+
+    @property
+    def json(self):
+        if not self._parsed:
+            value = self.value
+            if isinstance(value, memoryview):
+                value = value.tobytes()
+            self._json = json.loads(value)
+            self._parsed = True
+        return self._json
+
+
+class Deletion(Event):
+
+    __slots__ = ('vbucket', 'by_seqno', 'rev_seqno', 'frame', 'key_start',
+                 'key_end', '_key')
+    FIELDS = ('vbucket', 'by_seqno', 'rev_seqno', 'key')
+
+    def __init__(self, vbucket, by_seqno, rev_seqno, frame, extlen, keylen):
+        self.vbucket = vbucket
+        self.by_seqno = by_seqno
+        self.rev_seqno = rev_seqno
+        self.frame = frame
+        self.key_start = HEADER_LEN + extlen
+        self.key_end = self.key_start + keylen
+        self._key = None
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = self.frame[self.key_start:self.key_end]
+        return self._key
+
+
+class Expiration(Deletion):
+
+    __slots__ = ()
+
+
+class SnapshotMarker(Event):
+
+    __slots__ = ('vbucket', 'snap_start', 'snap_end', 'snap_type')
+    FIELDS = ('vbucket', 'snap_start', 'snap_end', 'snap_type')
+
+    def __init__(self, vbucket, snap_start, snap_end, snap_type):
+        self.vbucket = vbucket
+        self.snap_start = snap_start
+        self.snap_end = snap_end
+        self.snap_type = snap_type
+
+
+class StreamEnd(Event):
+
+    __slots__ = ('vbucket', 'flags')
+    FIELDS = ('vbucket', 'flags')
+
+    def __init__(self, vbucket, flags):
+        self.vbucket = vbucket
+        self.flags = flags
@@ -0,0 +1,27 @@
+
+import re
+
+class KeyFilter(object):
+
+    # Selects mutations, deletions and expirations by key. A key matches if
+    # it starts with any of the prefixes or any of the patterns is found in
+    # it. Keys are checked in the decode path, straight from the read
+    # buffer, so events that do not match are never built.
+    #
+    # All of the prefixes are checked in one startswith call and the
+    # patterns are compiled into a single alternation, so the cost of a
+    # check does not grow with the number of Python calls per prefix.
+    def __init__(self, prefixes=(), patterns=()):
+        self.prefixes = tuple([str(prefix) for prefix in prefixes])
+        self.pattern = None
+        if len(patterns) > 0:
+            self.pattern = re.compile('|'.join(['(?:%s)' % pattern for
+                                                pattern in patterns]))
+
+    # key is any string or buffer, normally a bytearray slice of the frame
+    def match(self, key):
+        if self.prefixes and key.startswith(self.prefixes):
+            return True
+        if self.pattern is not None and self.pattern.search(key) is not None:
+            return True
+        return False
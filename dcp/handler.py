@@ -0,0 +1,212 @@
+
+import Queue
+import threading
+import time
+
+class ResponseHandler():
+
+    # Set to True to receive plain dicts instead of dcp.events objects
+    dict_events = False
+
+    def __init__(self):
+        self.active_streams = 0
+
+    def mutation(self, response):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    def deletion(self, response):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    def expiration(self, response):
+        self.deletion(response)
+
+    def marker(self, response):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    def stream_end(self, response):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    # Called when the server had a vbucket roll back to seqno before its
+    # stream was reopened. Anything received for it after seqno is no longer
+    # valid.
+    def rollback(self, vbucket, seqno):
+        pass
+
+    # Called once the request for the stream of vbucket has failed for good
+    # with status. Nothing more is received for the vbucket.
+    def stream_failed(self, vbucket, status):
+        pass
+
+    # Called after each read from the network and on every pass of the I/O
+    # loop, and by dispatcher workers after each batch of callbacks. force is
+    # set when the events must be delivered now, because they are about to
+    # be checkpointed or the worker has run out of work. Handlers that buffer
+    # events deliver them here.
+    def flush(self, force=False):
+        pass
+
+    def has_active_streams(self):
+        assert self.active_streams >= 0
+        return self.active_streams != 0
+
+    def _incr_active_streams(self):
+        self.active_streams += 1
+
+    def _decr_active_streams(self):
+        self.active_streams -= 1
+
+class QueueHandler(ResponseHandler):
+
+    # Queues events so they can be consumed by iterating over the handler
+    # instead of implementing callbacks. Each event is a (type, response)
+    # tuple where type is one of 'mutation', 'deletion', 'expiration',
+    # 'marker' or 'stream_end'. Iteration stops once every active stream has ended.
+    #
+    # With per_vbucket set, every vbucket gets its own queue and is consumed
+    # through events(vbucket), which stops at the end of that stream, or
+    # straight away if the stream could not be opened.
+    END = object()
+
+    def __init__(self, maxsize=0, per_vbucket=False):
+        ResponseHandler.__init__(self)
+        self.maxsize = maxsize
+        self.per_vbucket = per_vbucket
+        self.lock = threading.Lock()
+        self.queues = dict()
+        self.queue = Queue.Queue(maxsize)
+
+    def mutation(self, response):
+        self._put(response['vbucket'], ('mutation', response))
+
+    def deletion(self, response):
+        self._put(response['vbucket'], ('deletion', response))
+
+    def expiration(self, response):
+        self._put(response['vbucket'], ('expiration', response))
+
+    def marker(self, response):
+        self._put(response['vbucket'], ('marker', response))
+
+    def stream_end(self, response):
+        self._put(response['vbucket'], ('stream_end', response))
+        if self.per_vbucket:
+            self._put(response['vbucket'], QueueHandler.END)
+
+    def stream_failed(self, vbucket, status):
+        if self.per_vbucket:
+            self._put(vbucket, QueueHandler.END)
+
+    def get_queue(self, vbucket):
+        self.lock.acquire()
+        queue = self.queues.get(vbucket)
+        if queue is None:
+            queue = Queue.Queue(self.maxsize)
+            self.queues[vbucket] = queue
+        self.lock.release()
+        return queue
+
+    def events(self, vbucket):
+        queue = self.get_queue(vbucket)
+        while True:
+            event = queue.get()
+            if event is QueueHandler.END:
+                return
+            yield event
+
+    def __iter__(self):
+        while True:
+            event = self.queue.get()
+            if event is QueueHandler.END:
+                if not self.has_active_streams():
+                    return
+                continue
+            yield event
+
+    def _put(self, vbucket, event):
+        if self.per_vbucket:
+            self.get_queue(vbucket).put(event)
+        else:
+            self.queue.put(event)
+
+    def _decr_active_streams(self):
+        ResponseHandler._decr_active_streams(self)
+        if not self.has_active_streams():
+            self.queue.put(QueueHandler.END)
+
+class BatchResponseHandler(ResponseHandler):
+
+    # Collects events and passes them to batch() as a list instead of making
+    # a callback per event. A batch is delivered as soon as it holds
+    # max_batch_size events, at the end of each stream, and otherwise from
+    # flush() once it is max_latency seconds old, so with the default of 0
+    # every read from the network ends with a batch.
+    #
+    # Batches are collected per thread. Dispatch workers each run a fixed set
+    # of vbuckets, so every worker delivers the events it ran and each
+    # vbucket stays in order, and a worker that runs out of work delivers
+    # what it holds. With a checkpoint store, each read or run of dispatched
+    # callbacks ends with a batch, so nothing is checkpointed before batch()
+    # has been given it.
+    def __init__(self, max_batch_size=1024, max_latency=0):
+        ResponseHandler.__init__(self)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.local = threading.local()
+
+    def batch(self, events):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    def mutation(self, response):
+        self._add(response)
+
+    def deletion(self, response):
+        self._add(response)
+
+    def expiration(self, response):
+        self._add(response)
+
+    def marker(self, response):
+        self._add(response)
+
+    def stream_end(self, response):
+        self._add(response)
+        self.flush(True)
+
+    def flush(self, force=False):
+        events = getattr(self.local, 'events', None)
+        if not events:
+            return
+        if not force and time.time() - self.local.started < self.max_latency:
+            return
+        self.local.events = list()
+        self.batch(events)
+
+    def _add(self, event):
+        local = self.local
+        events = getattr(local, 'events', None)
+        if not events:
+            events = list()
+            local.events = events
+            local.started = time.time()
+        events.append(event)
+        if len(events) >= self.max_batch_size:
+            self.flush(True)
+
+class ColumnarResponseHandler(ResponseHandler):
+
+    # Receives mutations as dcp.columns.MutationBatch objects instead of one
+    # event per mutation. A batch holds the mutations decoded from one read
+    # from the network, up to max_batch_size, and is always delivered before
+    # any deletion, marker or stream end that follows it on the connection.
+    # Other events go to the usual callbacks. Values are read in place and
+    # are only valid until mutations() returns, unless copy_values is set.
+    def __init__(self, max_batch_size=65536, copy_values=False):
+        ResponseHandler.__init__(self)
+        self.max_batch_size = max_batch_size
+        self.copy_values = copy_values
+
+    def mutations(self, batch):
+        raise NotImplementedError("Subclass must implement abstract method")
+
+    def mutation(self, response):
+        raise NotImplementedError("Mutations are delivered to mutations()")
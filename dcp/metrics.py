@@ -0,0 +1,218 @@
+
+import bisect
+import threading
+
+from operation import CountdownLatch, Stats
+
+# Upper bounds of the histogram buckets
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+TIME_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+class Histogram(object):
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        self.lock.acquire()
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.lock.release()
+
+    # Returns the cumulative count of each bucket, keyed by its upper bound
+    def snapshot(self):
+        self.lock.acquire()
+        counts = list(self.counts)
+        total = self.sum
+        count = self.count
+        self.lock.release()
+
+        buckets = list()
+        cumulative = 0
+        for bound, n in zip(self.bounds + ('+Inf',), counts):
+            cumulative += n
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'sum': total, 'count': count}
+
+
+class Metrics(object):
+
+    # Collects what is needed to tell whether the server, the network or the
+    # handler is holding a client back. Connections always count their reads,
+    # writes, frames and acknowledged bytes, and every stream counts its
+    # events. With metrics enabled, frame sizes, the time taken by each
+    # handler callback, the time the I/O loop spends waiting in poll and the
+    # time it spends on each pass are also recorded in histograms.
+    #
+    # A poll wait that dominates the loop points at the server or network, a
+    # callback time that dominates points at the handler, and paused reads or
+    # full dispatch queues mean the handler is pushing back.
+    def __init__(self, manager):
+        self.manager = manager
+        self.frame_bytes = Histogram(SIZE_BUCKETS)
+        self.callback_seconds = Histogram(TIME_BUCKETS)
+        self.poll_seconds = Histogram(TIME_BUCKETS)
+        self.loop_seconds = Histogram(TIME_BUCKETS)
+
+    # Returns the high seqno of every vbucket in the map, read from the node
+    # that owns it. Waits for the servers, so it must not be called from a
+    # handler callback running on the I/O thread.
+    def high_seqnos(self):
+        manager = self.manager
+        hosts = [(hostname, conns[0]) for hostname, conns in
+                 manager.connections_by_host.items() if len(conns) > 0]
+        latch = CountdownLatch(len(hosts))
+        ops = dict()
+        for hostname, conn in hosts:
+            op = Stats('vbucket-seqno', latch)
+            ops[hostname] = op
+            manager.add_operation_all(op, [conn])
+        latch.await()
+
+        seqnos = dict()
+        for vbucket, hostname in manager.bucket_config['vbmap'].items():
+            op = ops.get(hostname)
+            if op is None:
+                continue
+            value = op.result.get('vb_%d:high_seqno' % vbucket)
+            if value is not None:
+                seqnos[vbucket] = int(value)
+        return seqnos
+
+    # Returns the current metrics as a dict. With seqno_lag set, every stream
+    # also reports how far it is behind the server's high seqno, which takes
+    # a round trip to each node.
+    def snapshot(self, seqno_lag=False):
+        manager = self.manager
+        connections = dict()
+        for conn in list(manager.connections):
+            connections['%s/%d' % (conn.hostname, conn.index)] = {
+                'reads': conn.reads,
+                'bytes_read': conn.bytes_received,
+                'frames': conn.frames,
+                'writes': conn.writes,
+                'bytes_written': conn.bytes_sent,
+                'acked_bytes': conn.acked,
+                'unacked_bytes': conn.unacked,
+                'read_buffered': len(conn.toRead),
+                'write_buffered': len(conn.toWrite),
+            }
+
+        vbuckets = dict()
+        for vbucket, state in manager.streams.items():
+            vbuckets[vbucket] = {'events': state.events, 'seqno': state.seqno}
+        if seqno_lag:
+            for vbucket, high_seqno in self.high_seqnos().items():
+                stats = vbuckets.get(vbucket)
+                if stats is not None:
+                    stats['high_seqno'] = high_seqno
+                    stats['lag'] = max(high_seqno - stats['seqno'], 0)
+
+        snapshot = {
+            'connections': connections,
+            'vbuckets': vbuckets,
+            'active_streams': manager.handler.active_streams,
+            'reads_paused': manager.reads_paused,
+            'histograms': {
+                'frame_bytes': self.frame_bytes.snapshot(),
+                'callback_seconds': self.callback_seconds.snapshot(),
+                'poll_seconds': self.poll_seconds.snapshot(),
+                'loop_seconds': self.loop_seconds.snapshot(),
+            },
+        }
+
+        dispatcher = manager.dispatcher
+        if dispatcher is not None:
+            dispatcher.lock.acquire()
+            depths = [len(queue) for queue in dispatcher.queues.values()]
+            dispatcher.lock.release()
+            snapshot['dispatch'] = {'queued': sum(depths),
+                                    'max_queue': max(depths + [0]),
+                                    'paused': dispatcher.is_paused()}
+        return snapshot
+
+    # Returns the snapshot in the Prometheus text exposition format
+    def prometheus(self, seqno_lag=False):
+        snapshot = self.snapshot(seqno_lag)
+        lines = list()
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP dcp_%s %s' % (name, help))
+            lines.append('# TYPE dcp_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('dcp_%s%s %s' % (name, _labels(labels), value))
+
+        connections = sorted(snapshot['connections'].items())
+        for key, name, kind, help in CONNECTION_METRICS:
+            metric(name, kind, help, [({'connection': conn}, stats[key])
+                                      for conn, stats in connections])
+
+        vbuckets = sorted(snapshot['vbuckets'].items())
+        metric('vbucket_events_total', 'counter', 'Events received',
+               [({'vbucket': vb}, stats['events']) for vb, stats in vbuckets])
+        metric('vbucket_seqno', 'gauge', 'Last seqno received',
+               [({'vbucket': vb}, stats['seqno']) for vb, stats in vbuckets])
+        if seqno_lag:
+            metric('vbucket_seqno_lag', 'gauge',
+                   'Seqnos behind the server high seqno',
+                   [({'vbucket': vb}, stats['lag']) for vb, stats in vbuckets
+                    if 'lag' in stats])
+
+        metric('active_streams', 'gauge', 'Open streams',
+               [({}, snapshot['active_streams'])])
+        metric('reads_paused', 'gauge', 'Reads paused by the dispatcher',
+               [({}, int(snapshot['reads_paused']))])
+        if 'dispatch' in snapshot:
+            metric('dispatch_queued', 'gauge', 'Events waiting for a worker',
+                   [({}, snapshot['dispatch']['queued'])])
+            metric('dispatch_max_queue', 'gauge',
+                   'Events waiting in the longest vbucket queue',
+                   [({}, snapshot['dispatch']['max_queue'])])
+
+        for name, help in HISTOGRAMS:
+            histogram = snapshot['histograms'][name]
+            lines.append('# HELP dcp_%s %s' % (name, help))
+            lines.append('# TYPE dcp_%s histogram' % name)
+            for bound, count in histogram['buckets']:
+                lines.append('dcp_%s_bucket%s %s' %
+                             (name, _labels({'le': bound}), count))
+            lines.append('dcp_%s_sum %s' % (name, histogram['sum']))
+            lines.append('dcp_%s_count %s' % (name, histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+CONNECTION_METRICS = (
+    ('reads', 'reads_total', 'counter', 'Socket reads'),
+    ('bytes_read', 'read_bytes_total', 'counter', 'Bytes read'),
+    ('frames', 'frames_total', 'counter', 'Packets decoded'),
+    ('writes', 'writes_total', 'counter', 'Socket writes'),
+    ('bytes_written', 'written_bytes_total', 'counter', 'Bytes written'),
+    ('acked_bytes', 'acked_bytes_total', 'counter',
+     'Bytes acknowledged for flow control'),
+    ('unacked_bytes', 'unacked_bytes', 'gauge',
+     'Bytes consumed but not yet acknowledged'),
+    ('read_buffered', 'read_buffered_bytes', 'gauge',
+     'Bytes read but not yet decoded'),
+    ('write_buffered', 'write_buffered_bytes', 'gauge',
+     'Bytes waiting to be written'),
+)
+
+HISTOGRAMS = (
+    ('frame_bytes', 'Size of decoded packets'),
+    ('callback_seconds', 'Time spent in handler callbacks'),
+    ('poll_seconds', 'Time the I/O loop waited in poll'),
+    ('loop_seconds', 'Time the I/O loop spent on each pass'),
+)
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, value) for name, value in
+                             sorted(labels.items())])
@@ -0,0 +1,501 @@
+
+import BaseHTTPServer
+import hashlib
+import json
+import socket
+import SocketServer
+import struct
+import threading
+import time
+
+import constants as C
+from codec import (BUFFER_ACK_EXTRAS, DELETION_EXTRAS, FAILOVER_ENTRY, HEADER,
+                   MARKER_EXTRAS, MUTATION_EXTRAS, SEQNO, STREAM_END_EXTRAS,
+                   STREAM_REQ_EXTRAS)
+
+# Header and extras of the packets the producer sends, packed in one call
+MUTATION = struct.Struct(HEADER.format + MUTATION_EXTRAS.format[1:])
+DELETION = struct.Struct(HEADER.format + DELETION_EXTRAS.format[1:])
+MARKER = struct.Struct(HEADER.format + MARKER_EXTRAS.format[1:])
+STREAM_END = struct.Struct(HEADER.format + STREAM_END_EXTRAS.format[1:])
+NOOP = HEADER.pack(C.REQ_MAGIC, C.CMD_NOOP, 0, 0, 0, 0, 0, 0, 0)
+
+# Number of items generated for a stream before moving on to the next one
+CHUNK_ITEMS = 256
+
+class MockCluster(object):
+
+    # A fake cluster for benchmarks and experiments without a real server.
+    # It serves the REST endpoints the client reads the cluster map from and
+    # runs a DCP producer per node. vbucket v belongs to the (v % n)th of the
+    # n nodes that have not been failed over, until rebalance() moves it.
+    #
+    # Every stream holds items mutations, every deletion_interval-th of them
+    # a deletion, split into snapshots of snapshot_size items. Keys are
+    # unique unless key_space is set, in which case the keys of a stream
+    # repeat every key_space items. Values are value_size bytes, or value
+    # if it is given. Streams for vbuckets a node does not own fail with
+    # NOT_MY_VBUCKET, and streams that resume with an unknown vb_uuid are
+    # rolled back to 0. Stream requests are answered after stream_delay
+    # seconds, as by a slow node.
+    # The producer honours connection_buffer_size and buffer acks like a real
+    # server, and sends noops on idle connections once they are enabled.
+    def __init__(self, nodes=1, vbuckets=64, items=1000, value_size=100,
+                 deletion_interval=10, snapshot_size=1000, bucket='default',
+                 host='127.0.0.1', key_space=None, value=None,
+                 stream_delay=0):
+        self.nodes = nodes
+        self.vbuckets = vbuckets
+        self.items = items
+        self.key_space = key_space
+        self.stream_delay = stream_delay
+        self.value = value
+        if value is None:
+            self.value = 'x' * value_size
+        self.deletion_interval = deletion_interval
+        self.snapshot_size = snapshot_size
+        self.bucket = bucket
+        self.host = host
+        self.rest = None
+        self.producers = list()
+        self.threads = list()
+        self.acked = 0
+        self.noop_responses = 0
+        self.configs_not_modified = 0
+        self.streams_moved = 0
+        self.lock = threading.Lock()
+        self.handlers = list()
+        self.failed = set()
+        self.moved = dict()
+        self.rev = 1
+
+    # Starts the servers and returns the REST port
+    def start(self):
+        for i in range(self.nodes):
+            server = _ProducerServer((self.host, 0), _ProducerHandler)
+            server.cluster = self
+            server.node = i
+            self.producers.append(server)
+            self._serve(server)
+
+        self.rest = _RestServer((self.host, 0), _RestHandler)
+        self.rest.cluster = self
+        self._serve(self.rest)
+        return self.rest.server_address[1]
+
+    def stop(self):
+        for server in self.producers + [self.rest]:
+            server.shutdown()
+            server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.producers = list()
+        self.threads = list()
+
+    # Closes every open DCP connection, as a node restart would
+    def disconnect(self):
+        for handler in self._handlers():
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    # Makes every open DCP connection go silent without closing it, as a
+    # hung node would. New connections are not affected.
+    def stall(self):
+        for handler in self._handlers():
+            handler.stalled = True
+
+    # Takes node out of the cluster, as a hard failover would. Its producer
+    # stops accepting connections, its open connections are closed and its
+    # vbuckets move to the remaining nodes under a new config rev.
+    def failover(self, node):
+        server = self.producers[node]
+        server.shutdown()
+        server.server_close()
+        self.lock.acquire()
+        self.failed.add(node)
+        self.rev += 1
+        self.lock.release()
+        for handler in self._handlers():
+            if handler.server is server:
+                try:
+                    handler.request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    # Moves vbuckets, or all of them, to the next node under a new config
+    # rev, as a rebalance would. Their open streams on the old owners end
+    # with STREAM_END_STATE_CHANGED once the items already sent for them
+    # have gone out.
+    def rebalance(self, vbuckets=None):
+        if vbuckets is None:
+            vbuckets = range(self.vbuckets)
+        self.lock.acquire()
+        live = self._live()
+        for vbucket in vbuckets:
+            owner = self.owner(vbucket)
+            self.moved[vbucket] = live[(live.index(owner) + 1) % len(live)]
+        self.rev += 1
+        self.lock.release()
+
+    def _handlers(self):
+        self.lock.acquire()
+        handlers = list(self.handlers)
+        self.lock.release()
+        return handlers
+
+    def vb_uuid(self, vbucket):
+        return 0xFEED0000 + vbucket
+
+    def owner(self, vbucket):
+        live = self._live()
+        node = self.moved.get(vbucket)
+        if node in live:
+            return node
+        return live[vbucket % len(live)]
+
+    def bucket_config(self):
+        live = self._live()
+        servers = ['%s:%d' % (self.host, self.producers[i].server_address[1])
+                   for i in live]
+        # Like a cluster_run cluster, node i reports REST port rest + i.
+        # Only the first node's REST port is actually served.
+        rest = self.rest.server_address[1]
+        nodes = list()
+        for i in live:
+            nodes.append({'hostname': '%s:%d' % (self.host, rest + i),
+                          'ports': {'direct':
+                                    self.producers[i].server_address[1],
+                                    'proxy': 0}})
+        return {'name': self.bucket,
+                'saslPassword': '',
+                'rev': self.rev,
+                'nodes': nodes,
+                'vBucketServerMap': {
+                    'serverList': servers,
+                    'vBucketMap': [[live.index(self.owner(vb))] for vb in
+                                   range(self.vbuckets)]}}
+
+    def _live(self):
+        return [i for i in range(self.nodes) if i not in self.failed]
+
+    # Returns the packets for items start + 1 to end of a stream
+    def items_between(self, vbucket, opaque, start, end):
+        packets = list()
+        value = self.value
+        for seqno in xrange(start + 1, end + 1):
+            if self.snapshot_size and (seqno - 1) % self.snapshot_size == 0:
+                last = min(seqno + self.snapshot_size - 1, self.items)
+                packets.append(MARKER.pack(C.REQ_MAGIC, C.CMD_SNAPSHOT_MARKER,
+                                           0, 20, 0, vbucket, 20, opaque, 0,
+                                           seqno, last, 1))
+            key_id = seqno
+            if self.key_space:
+                key_id = seqno % self.key_space
+            key = 'key-%d-%d' % (vbucket, key_id)
+            if self.deletion_interval and seqno % self.deletion_interval == 0:
+                packets.append(DELETION.pack(C.REQ_MAGIC, C.CMD_DELETION,
+                                             len(key), 18, 0, vbucket,
+                                             18 + len(key), opaque, seqno,
+                                             seqno, 1, 0))
+                packets.append(key)
+            else:
+                packets.append(MUTATION.pack(C.REQ_MAGIC, C.CMD_MUTATION,
+                                             len(key), 31, 0, vbucket,
+                                             31 + len(key) + len(value),
+                                             opaque, seqno, seqno, 1, 0, 0,
+                                             0, 0, 0))
+                packets.append(key)
+                packets.append(value)
+        return ''.join(packets)
+
+    def _serve(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+
+class _ProducerServer(SocketServer.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _RestServer(BaseHTTPServer.HTTPServer):
+
+    allow_reuse_address = True
+
+
+class _Stream(object):
+
+    def __init__(self, vbucket, opaque, seqno, end):
+        self.vbucket = vbucket
+        self.opaque = opaque
+        self.seqno = seqno
+        self.end = end
+
+
+class _ProducerHandler(SocketServer.BaseRequestHandler):
+
+    # Requests are read on the handler's thread and streams are written by a
+    # second thread, which waits for buffer acks once the consumer's buffer
+    # is full
+    def handle(self):
+        self.cluster = self.server.cluster
+        self.lock = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.streams = list()
+        self.buffer_size = None
+        self.unacked = 0
+        self.closed = False
+        self.stalled = False
+        self.noop_enabled = False
+        self.noop_interval = None
+        self.last_sent = time.time()
+
+        self.cluster.lock.acquire()
+        self.cluster.handlers.append(self)
+        self.cluster.lock.release()
+
+        writer = threading.Thread(target=self._write_streams)
+        writer.daemon = True
+        writer.start()
+        try:
+            self._read_requests()
+        finally:
+            self.lock.acquire()
+            self.closed = True
+            self.lock.notify()
+            self.lock.release()
+            writer.join()
+            self.cluster.lock.acquire()
+            self.cluster.handlers.remove(self)
+            self.cluster.lock.release()
+
+    def _read_requests(self):
+        pending = ''
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            pending += data
+            while len(pending) >= C.HEADER_LEN:
+                magic, opcode, keylen, extlen, datatype, vbucket, bodylen, \
+                    opaque, cas = HEADER.unpack_from(pending)
+                if len(pending) < C.HEADER_LEN + bodylen:
+                    break
+                body = pending[C.HEADER_LEN:C.HEADER_LEN + bodylen]
+                pending = pending[C.HEADER_LEN + bodylen:]
+                if magic == C.REQ_MAGIC:
+                    try:
+                        self._request(opcode, keylen, extlen, vbucket, opaque,
+                                      body)
+                    except socket.error:
+                        return
+                elif opcode == C.CMD_NOOP:
+                    self.cluster.noop_responses += 1
+
+    def _request(self, opcode, keylen, extlen, vbucket, opaque, body):
+        extras = body[:extlen]
+        key = body[extlen:extlen + keylen]
+        value = body[extlen + keylen:]
+
+        if opcode == C.CMD_STREAM_REQ:
+            self._stream_request(vbucket, opaque, extras)
+        elif opcode == C.CMD_CLOSE_STREAM:
+            self.lock.acquire()
+            open_streams = len(self.streams)
+            self.streams = [stream for stream in self.streams if
+                            stream.vbucket != vbucket]
+            closed = len(self.streams) < open_streams
+            self.lock.release()
+            if closed:
+                self._respond(opcode, opaque)
+            else:
+                self._respond(opcode, opaque, C.ERR_KEY_ENOENT)
+        elif opcode == C.CMD_BUFFER_ACK:
+            size = BUFFER_ACK_EXTRAS.unpack(extras)[0]
+            self.lock.acquire()
+            self.unacked -= size
+            self.cluster.acked += size
+            self.lock.notify()
+            self.lock.release()
+        elif opcode == C.CMD_CONTROL:
+            self.lock.acquire()
+            if key == 'connection_buffer_size':
+                self.buffer_size = int(value)
+            elif key == 'enable_noop':
+                self.noop_enabled = value == 'true'
+            elif key == 'set_noop_interval':
+                self.noop_interval = float(value)
+            self.lock.notify()
+            self.lock.release()
+            self._respond(opcode, opaque)
+        elif opcode == C.CMD_HELO:
+            # Compression is not supported
+            features = struct.unpack(">%dH" % (len(value) / 2), value)
+            accepted = [f for f in features if f != C.FEATURE_SNAPPY]
+            self._respond(opcode, opaque, value=struct.pack(
+                ">%dH" % len(accepted), *accepted))
+        elif opcode == C.CMD_STATS:
+            for vb in range(self.cluster.vbuckets):
+                if self.cluster.owner(vb) == self.server.node:
+                    self._respond(opcode, opaque, key='vb_%d:high_seqno' % vb,
+                                  value=str(self.cluster.items))
+            self._respond(opcode, opaque)
+        elif opcode == C.CMD_NOOP:
+            pass
+        else:
+            self._respond(opcode, opaque)
+
+    def _stream_request(self, vbucket, opaque, extras):
+        flags, reserved, start, end, vb_uuid, snap_start, snap_end = \
+            STREAM_REQ_EXTRAS.unpack(extras)
+        cluster = self.cluster
+        if cluster.stream_delay:
+            time.sleep(cluster.stream_delay)
+        if vbucket >= cluster.vbuckets or \
+                cluster.owner(vbucket) != self.server.node:
+            self._respond(C.CMD_STREAM_REQ, opaque, C.ERR_NOT_MY_VBUCKET)
+            return
+        if start > 0 and vb_uuid != cluster.vb_uuid(vbucket):
+            self._respond(C.CMD_STREAM_REQ, opaque, C.ERR_ROLLBACK,
+                          value=SEQNO.pack(0))
+            return
+
+        self._respond(C.CMD_STREAM_REQ, opaque, value=FAILOVER_ENTRY.pack(
+            cluster.vb_uuid(vbucket), 0))
+        self.lock.acquire()
+        self.streams.append(_Stream(vbucket, opaque, start,
+                                    min(end, cluster.items)))
+        self.lock.notify()
+        self.lock.release()
+
+    def _respond(self, opcode, opaque, status=C.SUCCESS, key='', value=''):
+        packet = HEADER.pack(C.RES_MAGIC, opcode, len(key), 0, 0, status,
+                             len(key) + len(value), opaque, 0) + key + value
+        self._send(packet)
+
+    def _stream_end(self, stream, flags):
+        return STREAM_END.pack(C.REQ_MAGIC, C.CMD_STREAM_END, 0, 4, 0,
+                               stream.vbucket, 4, stream.opaque, 0, flags)
+
+    def _send(self, data):
+        if self.stalled:
+            return
+        self.write_lock.acquire()
+        try:
+            self.request.sendall(data)
+            self.last_sent = time.time()
+        finally:
+            self.write_lock.release()
+
+    # Nothing can be written while there are no streams or the consumer's
+    # buffer is full. Must be called with lock held.
+    def _idle(self):
+        return self.stalled or len(self.streams) == 0 or \
+            (self.buffer_size is not None and
+             self.unacked >= self.buffer_size)
+
+    def _noop_due(self):
+        return self._noops() and \
+            time.time() - self.last_sent >= self.noop_interval
+
+    def _noops(self):
+        return self.noop_enabled and self.noop_interval is not None and \
+            not self.stalled
+
+    # Writes the open streams a chunk at a time, in turn, and a noop
+    # whenever the connection has been idle for the noop interval
+    def _write_streams(self):
+        while True:
+            self.lock.acquire()
+            while not self.closed and self._idle() and not self._noop_due():
+                if self._noops():
+                    self.lock.wait(max(self.last_sent + self.noop_interval -
+                                       time.time(), 0.01))
+                else:
+                    self.lock.wait()
+            if self.closed:
+                self.lock.release()
+                return
+            if self._idle():
+                self.lock.release()
+                try:
+                    self._send(NOOP)
+                except socket.error:
+                    return
+                continue
+            stream = self.streams.pop(0)
+            self.lock.release()
+
+            if self.cluster.owner(stream.vbucket) != self.server.node:
+                self.cluster.streams_moved += 1
+                end = stream.end
+                data = self._stream_end(stream, C.STREAM_END_STATE_CHANGED)
+            else:
+                end = min(stream.seqno + CHUNK_ITEMS, stream.end)
+                data = self.cluster.items_between(stream.vbucket,
+                                                  stream.opaque, stream.seqno,
+                                                  end)
+                stream.seqno = end
+                if end == stream.end:
+                    data += self._stream_end(stream, C.STREAM_END_OK)
+
+            self.lock.acquire()
+            self.unacked += len(data)
+            if end < stream.end:
+                self.streams.append(stream)
+            self.lock.release()
+            try:
+                self._send(data)
+            except socket.error:
+                return
+
+
+class _RestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        cluster = self.server.cluster
+        bucket = cluster.bucket_config()
+        path = self.path.rstrip('/')
+        streaming = False
+        if path == '/pools/default':
+            data = {'nodes': bucket['nodes']}
+        elif path == '/pools/default/buckets':
+            data = [bucket]
+        elif path == '/pools/default/buckets/' + cluster.bucket:
+            data = bucket
+        elif path == '/pools/default/bucketsStreaming/' + cluster.bucket:
+            data = bucket
+            streaming = True
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps(data)
+        if streaming:
+            body += '\n\n\n\n'
+        # Like the cluster, configs are tagged so clients can revalidate them
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if not streaming and self.headers.get('If-None-Match') == etag:
+            cluster.configs_not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if not streaming:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
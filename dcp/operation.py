@@ -1,8 +1,11 @@
 import binascii
 import Queue
 import struct
+import time
 
+import codec
 import constants as C
+from dcp_exception import TimeoutException
 
 import threading
 
@@ -18,56 +21,138 @@ class CountdownLatch(object):
             self.lock.notifyAll()
         self.lock.release()
     
-    def await(self):
+    # Raises TimeoutException if the count has not reached zero after
+    # timeout seconds
+    def await(self, timeout=None):
         self.lock.acquire()
-        while self.count > 0:
-            self.lock.wait()
-        self.lock.release()
+        try:
+            if timeout is None:
+                while self.count > 0:
+                    self.lock.wait()
+                return
+            deadline = time.time() + timeout
+            while self.count > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutException("Timed out waiting for responses")
+                self.lock.wait(remaining)
+        finally:
+            self.lock.release()
+
+
+# Opaques of requests that expect a response are taken from the top of the
+# opaque space and wrap around within it, leaving the rest to the server
+OPAQUE_START = 0xFFFF0000
+
+# Packets that get no response, or answer one of the server's, do not take an
+# opaque from the counter
+UNTRACKED_OPAQUE = 0
+
+_opaque_lock = threading.Lock()
+_opaque_counter = OPAQUE_START
+
+def next_opaque():
+    global _opaque_counter
+    _opaque_lock.acquire()
+    opaque = (_opaque_counter + 1) % 2 ** 32
+    if opaque < OPAQUE_START:
+        opaque = OPAQUE_START
+    _opaque_counter = opaque
+    _opaque_lock.release()
+    return opaque
 
 
 class Operation():
 
-    opaque_counter = 0xFFFF0000
+    # Requests are sent with REQ_MAGIC, responses to the server with RES_MAGIC
+    MAGIC = C.REQ_MAGIC
+
+    # Struct the values returned by _get_extras are packed with
+    EXTRAS = None
 
-    def __init__(self, opcode, data_type, vbucket, cas, key, value):
-        Operation.opaque_counter += 1
+    def __init__(self, opcode, data_type, vbucket, cas, key, value,
+                 opaque=None):
+        if opaque is None:
+            opaque = next_opaque()
         self.opcode = opcode
         self.data_type = data_type
         self.vbucket = vbucket
-        self.opaque = Operation.opaque_counter
+        self.opaque = opaque
         self.cas = cas
         self.key = key
         self.value = value
         self.result = None
+        self.latch = None
+        # Time by which the response must arrive, set when the op is written
+        self.deadline = None
+        self._bytes = None
 
     def add_response(self, opcode, keylen, extlen, status, cas, body):
         raise NotImplementedError("Subclass must implement abstract method")
 
+    # Called when the op will not get a response, because its connection
+    # was lost or its deadline passed
     def network_error(self):
-        pass
+        if self.latch is not None:
+            self.latch.count_down()
 
-    def get_result(self):
-        self.latch.await()
+    def get_result(self, timeout=None):
+        self.latch.await(timeout)
         assert self.result is not None
         return self.result
 
+    # Returns the encoded packet. Operations do not change once created, so
+    # the packet is only encoded once.
     def bytes(self):
-        extras = self._get_extras()
-        bodylen = len(self.key) + len(extras) + len(self.value)
-        header = struct.pack(C.PKT_HEADER_FMT, C.REQ_MAGIC, self.opcode,
-                             len(self.key), len(extras), self.data_type,
-                             self.vbucket, bodylen, self.opaque, self.cas)
-        return header + extras + self.key + self.value
+        if self._bytes is None:
+            packet = bytearray(self.size())
+            self.encode_into(packet, 0)
+            self._bytes = str(packet)
+        return self._bytes
+
+    def size(self):
+        extlen = 0
+        if self.EXTRAS is not None:
+            extlen = self.EXTRAS.size
+        return C.HEADER_LEN + extlen + len(self.key) + len(self.value)
+
+    # Packs the packet into buf at offset in a single pass and returns the
+    # offset just past it. buf must have room for size() bytes.
+    def encode_into(self, buf, offset):
+        if self._bytes is not None:
+            end = offset + len(self._bytes)
+            buf[offset:end] = self._bytes
+            return end
+
+        extras = self.EXTRAS
+        extlen = 0
+        if extras is not None:
+            extlen = extras.size
+        keylen = len(self.key)
+        bodylen = extlen + keylen + len(self.value)
+        codec.HEADER.pack_into(buf, offset, self.MAGIC, self.opcode, keylen,
+                               extlen, self.data_type, self.vbucket, bodylen,
+                               self.opaque, self.cas)
+        offset += C.HEADER_LEN
+        if extras is not None:
+            extras.pack_into(buf, offset, *self._get_extras())
+            offset += extlen
+        buf[offset:offset + keylen] = self.key
+        offset += keylen
+        buf[offset:offset + len(self.value)] = self.value
+        return offset + len(self.value)
 
     def _get_extras(self):
-        raise NotImplementedError("Subclass must implement abstract method")
+        return ()
 
     def __str__(self):
-        return packet_2_str(self.bytes())
+        return binascii.hexlify(self.bytes())
 
 
 class OpenConnection(Operation):
 
+    EXTRAS = codec.OPEN_EXTRAS
+
     def __init__(self, flags, name, latch):
         Operation.__init__(self, C.CMD_OPEN, 0, 0, 0, name, '')
         self.flags = flags
@@ -84,13 +169,17 @@ class OpenConnection(Operation):
         
         self.latch.count_down()
 
+    def network_error(self):
+        self.result = False
+        self.latch.count_down()
+
     def _get_extras(self):
-        return struct.pack(">II", 0, self.flags)
+        return (0, self.flags)
 
 class Control(Operation):
 
     def __init__(self, param, value, latch):
-        Operation.__init__(self, C.CMD_OPEN, 0, 0, 0, param, value)
+        Operation.__init__(self, C.CMD_CONTROL, 0, 0, 0, param, value)
         self.latch = latch
         self.result = True
 
@@ -104,8 +193,74 @@ class Control(Operation):
 
         self.latch.count_down()
 
+    def network_error(self):
+        self.result = False
+        self.latch.count_down()
+
+class Hello(Operation):
+
+    # Negotiates optional protocol features. The result is the list of
+    # features that every connection the op was sent on accepted.
+    def __init__(self, name, features, latch):
+        value = struct.pack(">%dH" % len(features), *features)
+        Operation.__init__(self, C.CMD_HELO, 0, 0, 0, name, value)
+        self.latch = latch
+
+    def add_response(self, opcode, keylen, extlen, status, cas, body):
+        accepted = list()
+        if status == C.SUCCESS:
+            accepted = list(struct.unpack(">%dH" % (len(body) / 2), body))
+        if self.result is None:
+            self.result = accepted
+        else:
+            self.result = [f for f in self.result if f in accepted]
+
+        self.latch.count_down()
+
+    def network_error(self):
+        self.result = list()
+        self.latch.count_down()
+
+class Stats(Operation):
+
+    # Collects a group of stats into a dict. The server sends a response per
+    # stat and ends the group with one that has an empty key.
+    def __init__(self, group, latch):
+        Operation.__init__(self, C.CMD_STATS, 0, 0, 0, group, '')
+        self.latch = latch
+        self.result = dict()
+
+    def add_response(self, opcode, keylen, extlen, status, cas, body):
+        if status != C.SUCCESS or keylen == 0:
+            self.latch.count_down()
+            return
+        self.result[body[extlen:extlen + keylen]] = body[extlen + keylen:]
+
+class BufferAck(Operation):
+
+    EXTRAS = codec.BUFFER_ACK_EXTRAS
+
+    def __init__(self, size):
+        Operation.__init__(self, C.CMD_BUFFER_ACK, 0, 0, 0, '', '',
+                           UNTRACKED_OPAQUE)
+        self.ack_size = size
+
+    def add_response(self, opcode, keylen, extlen, status, cas, body):
+        pass
+
     def _get_extras(self):
-        return ''
+        return (self.ack_size,)
+
+class NoopResponse(Operation):
+
+    # Answers a noop sent by the server, which expects its own opaque back
+    MAGIC = C.RES_MAGIC
+
+    def __init__(self, opaque):
+        Operation.__init__(self, C.CMD_NOOP, 0, C.SUCCESS, 0, '', '', opaque)
+
+    def add_response(self, opcode, keylen, extlen, status, cas, body):
+        pass
 
 class CloseStream(Operation):
 
@@ -118,12 +273,11 @@ class CloseStream(Operation):
         assert extlen == 0
         return True
 
-    def _get_extras(self):
-        return ''
-
 
 class StreamRequest(Operation):
 
+    EXTRAS = codec.STREAM_REQ_EXTRAS
+
     def __init__(self, vb, flags, start_seqno, end_seqno, vb_uuid, snap_start,
                  snap_end, latch):
         Operation.__init__(self, C.CMD_STREAM_REQ, 0, vb, 0, '', '')
@@ -135,6 +289,8 @@ class StreamRequest(Operation):
         self.snap_end = snap_end
         self.latch = latch
         self.result = dict()
+        # Set when the request continues a stream that moved to another node
+        self.resume = False
 
     def add_response(self, opcode, keylen, extlen, status, cas, body):
         assert cas == 0
@@ -150,18 +306,23 @@ class StreamRequest(Operation):
             pos = 0
             bodylen = len(body)
             while bodylen > pos:
-                vb_uuid, seqno = struct.unpack(">QQ", body[pos:pos+16])
+                vb_uuid, seqno = codec.FAILOVER_ENTRY.unpack_from(body, pos)
                 self.result['failover_log'].append((vb_uuid, seqno))
                 pos += 16
+        elif status == C.ERR_ROLLBACK:
+            self.result['rollback_seqno'] = codec.SEQNO.unpack(body)[0]
         else:
             self.result['err_msg'] = body
 
         self.latch.count_down()
 
+    def network_error(self):
+        self.result['status'] = C.ERR_ECLIENT
+        self.latch.count_down()
+
     def _get_extras(self):
-        return struct.pack(">IIQQQQQ", self.flags, 0, self.start_seqno,
-                           self.end_seqno, self.vb_uuid, self.snap_start,
-                           self.snap_end)
+        return (self.flags, 0, self.start_seqno, self.end_seqno, self.vb_uuid,
+                self.snap_start, self.snap_end)
 
 
 class SaslPlain(Operation):
@@ -177,5 +338,6 @@ class SaslPlain(Operation):
             self.result = False
         self.latch.count_down()
 
-    def _get_extras(self):
-        return ''
+    def network_error(self):
+        self.result = False
+        self.latch.count_down()
@@ -0,0 +1,35 @@
+
+import select
+
+READ = select.POLLIN
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP
+
+class Poller(object):
+
+    # Wraps epoll where it is available and falls back to poll. Both take the
+    # same event masks, but epoll takes its timeout in seconds and poll in
+    # milliseconds.
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.impl = select.epoll()
+            self.scale = 1
+        else:
+            self.impl = select.poll()
+            self.scale = 1000
+
+    def register(self, fd, events):
+        self.impl.register(fd, events)
+
+    def modify(self, fd, events):
+        self.impl.modify(fd, events)
+
+    def unregister(self, fd):
+        self.impl.unregister(fd)
+
+    def poll(self, timeout):
+        return self.impl.poll(timeout * self.scale)
+
+    def close(self):
+        if hasattr(self.impl, 'close'):
+            self.impl.close()
@@ -0,0 +1,225 @@
+
+import logging
+import multiprocessing
+import Queue
+import threading
+
+from constants import SUCCESS
+from dcp_exception import ConnectedException
+from handler import ColumnarResponseHandler, ResponseHandler
+
+CALLBACKS = ('mutation', 'deletion', 'expiration', 'marker', 'stream_end')
+
+class ForwardingHandler(ResponseHandler):
+
+    # Runs in a worker process and sends the events decoded from each read
+    # to the parent process as a single message
+    def __init__(self, pipe, lock):
+        ResponseHandler.__init__(self)
+        self.pipe = pipe
+        self.lock = lock
+        self.events = list()
+
+    def mutation(self, response):
+        self.events.append(('mutation', response))
+
+    def deletion(self, response):
+        self.events.append(('deletion', response))
+
+    def expiration(self, response):
+        self.events.append(('expiration', response))
+
+    def marker(self, response):
+        self.events.append(('marker', response))
+
+    def stream_end(self, response):
+        self.events.append(('stream_end', response))
+
+    def flush(self, force=False):
+        if len(self.events) == 0:
+            return
+        events = self.events
+        self.events = list()
+        self.lock.acquire()
+        self.pipe.send(('events', events))
+        self.lock.release()
+
+
+def _worker_main(pipe, options, host, port, bucket, user, pwd):
+    from dcp import DcpClient
+
+    lock = threading.Lock()
+    client = DcpClient(**options)
+    try:
+        client.connect(host, port, bucket, user, pwd,
+                       ForwardingHandler(pipe, lock))
+    except Exception, e:
+        pipe.send(('error', str(e)))
+        return
+    lock.acquire()
+    pipe.send(('connected', None))
+    lock.release()
+
+    while True:
+        command, args = pipe.recv()
+        if command == 'add_streams':
+            result = client.add_streams(args)
+        elif command == 'close':
+            client.close()
+            result = None
+        lock.acquire()
+        pipe.send((command, result))
+        lock.release()
+        if command == 'close':
+            return
+
+
+class _Worker(object):
+
+    def __init__(self, process, pipe):
+        self.process = process
+        self.pipe = pipe
+        self.results = Queue.Queue()
+        self.reader = None
+
+
+class ProcessPoolClient(object):
+
+    # Spreads the vbuckets of a bucket over several worker processes, each
+    # running its own DcpClient, so decoding is not limited by a single
+    # interpreter lock. vbucket v is owned by worker v % processes. Events
+    # are sent back over a pipe and the handler callbacks run in the parent,
+    # on one thread per worker, so the handler must be thread safe. Events
+    # for a vbucket still arrive in order. Keyword options are passed to each
+    # worker's DcpClient.
+    def __init__(self, processes=2, **options):
+        self.lock = threading.Lock()
+        # Guards the handler's active stream count, which is changed by the
+        # caller and by every reader thread. add_streams holds lock while it
+        # waits for the readers, so they cannot take that one.
+        self.streams_lock = threading.Lock()
+        self.processes = processes
+        self.options = options
+        self.handler = None
+        self.workers = list()
+
+    def connect(self, host, port, bucket, user, pwd, handler):
+        if isinstance(handler, ColumnarResponseHandler):
+            raise ValueError("Columnar handlers run on the I/O thread")
+        self.lock.acquire()
+        if len(self.workers) > 0:
+            self.lock.release()
+            raise ConnectedException("Connection already established")
+
+        self.handler = handler
+        for i in range(self.processes):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker_main,
+                                              args=(child, self.options, host,
+                                                    port, bucket, user, pwd))
+            process.daemon = True
+            process.start()
+            worker = _Worker(process, parent)
+            worker.reader = threading.Thread(target=self._read,
+                                             args=(worker,))
+            worker.reader.daemon = True
+            worker.reader.start()
+            self.workers.append(worker)
+
+        errors = list()
+        for worker in self.workers:
+            status, value = worker.results.get()
+            if status == 'error':
+                errors.append(value)
+        self.lock.release()
+
+        if len(errors) > 0:
+            self.close()
+            raise ConnectedException(errors[0])
+
+    def add_stream(self, vbucket, flags, start_seqno, end_seqno, vb_uuid,
+                   snap_start, snap_end):
+        return self.add_streams([(vbucket, flags, start_seqno, end_seqno,
+                                  vb_uuid, snap_start, snap_end)])[vbucket]
+
+    def add_streams(self, specs):
+        self.lock.acquire()
+        if len(self.workers) == 0:
+            self.lock.release()
+            raise ConnectedException("Not connected")
+
+        shards = dict()
+        for spec in specs:
+            worker = self.workers[spec[0] % len(self.workers)]
+            shards.setdefault(worker, list()).append(tuple(spec))
+            self._incr_active_streams()
+        for worker, shard in shards.items():
+            worker.pipe.send(('add_streams', shard))
+
+        results = dict()
+        for worker in shards:
+            status, value = worker.results.get()
+            results.update(value)
+        for vbucket, result in results.items():
+            if result['status'] != SUCCESS:
+                self._decr_active_streams()
+                self.handler.stream_failed(vbucket, result['status'])
+
+        self.lock.release()
+        return results
+
+    def close(self):
+        self.lock.acquire()
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.pipe.send(('close', None))
+                worker.results.get()
+            worker.process.join()
+            worker.reader.join()
+        self.workers = list()
+        self.lock.release()
+
+    def _read(self, worker):
+        callbacks = dict()
+        for name in CALLBACKS:
+            callbacks[name] = getattr(self.handler, name)
+        dict_events = self.handler.dict_events
+
+        while True:
+            try:
+                kind, value = worker.pipe.recv()
+            except (EOFError, IOError):
+                worker.results.put(('closed', None))
+                return
+
+            if kind != 'events':
+                worker.results.put((kind, value))
+                if kind in ('close', 'error'):
+                    return
+                continue
+
+            for name, response in value:
+                if dict_events:
+                    response = response.to_dict()
+                try:
+                    callbacks[name](response)
+                except Exception:
+                    logging.exception('Handler failed on vbucket %d',
+                                      response['vbucket'])
+                if name == 'stream_end':
+                    self._decr_active_streams()
+            self.handler.flush(True)
+
+    def _incr_active_streams(self):
+        self.streams_lock.acquire()
+        try:
+            self.handler._incr_active_streams()
+        finally:
+            self.streams_lock.release()
+
+    def _decr_active_streams(self):
+        self.streams_lock.acquire()
+        try:
+            self.handler._decr_active_streams()
+        finally:
+            self.streams_lock.release()
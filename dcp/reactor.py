@@ -0,0 +1,261 @@
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+import poller
+
+# Seconds an event loop waits in poll when nothing happens
+POLL_TIMEOUT = 0.25
+
+class Reactor(object):
+
+    # Runs the I/O of any number of DcpClients on a fixed number of event
+    # loop threads, so a process streaming many buckets or clusters does not
+    # need a polling thread per client. Every client is placed on the loop
+    # with the fewest clients and all of its connections are polled there,
+    # so the callbacks of one client still all run on one thread. Clients
+    # that are not given a reactor get one of their own.
+    def __init__(self, threads=1):
+        self.lock = threading.Lock()
+        self.loops = [EventLoop() for i in range(threads)]
+
+    # Places a ConnectionManager on a loop and returns the loop
+    def register(self, manager):
+        self.lock.acquire()
+        loop = min(self.loops, key=lambda loop: len(loop.managers))
+        loop.add_manager(manager)
+        self.lock.release()
+        return loop
+
+    # Stops polling the connections of manager. Once this returns, its loop
+    # is not running any of its code.
+    def unregister(self, manager):
+        self.lock.acquire()
+        for loop in self.loops:
+            loop.remove_manager(manager)
+        self.lock.release()
+
+    def close(self):
+        for loop in self.loops:
+            loop.close()
+
+
+class EventLoop(threading.Thread):
+
+    # Each pass polls every connection of the loop's managers, reads and
+    # writes the ones that are ready and then lets every manager do its own
+    # work. A read takes at most a bounded number of bytes from a socket, so
+    # a busy connection cannot hold up the others, and the managers take
+    # turns going first.
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.managers = list()
+        self.connections_by_fd = dict()
+        self.turn = 0
+
+        # Held for each pass, except while waiting in poll
+        self.lock = threading.RLock()
+
+        # Connections with queued writes are handed to the loop through
+        # self.pending and the wakeup pipe, so writes go out immediately
+        # rather than on the next poll timeout.
+        self.pending_lock = threading.Lock()
+        self.pending = set()
+        self.writing = set()
+
+        self.poller = poller.Poller()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller.register(self.wakeup_r, poller.READ)
+
+        self.daemon = True
+        self.running = True
+        self.start()
+
+    def add_manager(self, manager):
+        self.lock.acquire()
+        self.managers.append(manager)
+        self.lock.release()
+
+    def remove_manager(self, manager):
+        self.lock.acquire()
+        try:
+            if manager not in self.managers:
+                return
+            for conn in self.connections_by_fd.values():
+                if conn.manager is manager:
+                    self.remove(conn)
+            self.pending_lock.acquire()
+            self.pending = set([conn for conn in self.pending if
+                                conn.manager is not manager])
+            self.pending_lock.release()
+            self.managers.remove(manager)
+        finally:
+            self.lock.release()
+
+    def add(self, conn):
+        fd = conn.socket.fileno()
+        self.connections_by_fd[fd] = conn
+        self.poller.register(fd, self._events(conn))
+
+    def remove(self, conn):
+        fd = conn.socket.fileno()
+        if fd in self.connections_by_fd:
+            self.poller.unregister(fd)
+            del self.connections_by_fd[fd]
+        self.writing.discard(conn)
+
+    # Updates the events polled for conn
+    def modify(self, conn):
+        if conn.closed:
+            return
+        fd = conn.socket.fileno()
+        if fd in self.connections_by_fd:
+            self.poller.modify(fd, self._events(conn))
+
+    # Only the first connection queued since the loop last took the pending
+    # set needs to wake it up, so bursts of writes share one wakeup.
+    def schedule_write(self, conn):
+        self.pending_lock.acquire()
+        wake = len(self.pending) == 0
+        self.pending.add(conn)
+        self.pending_lock.release()
+        if wake:
+            self.wakeup()
+
+    # Does nothing once the loop is closed
+    def wakeup(self):
+        wakeup_w = self.wakeup_w
+        if wakeup_w is None:
+            return
+        try:
+            os.write(wakeup_w, '\0')
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def run(self):
+        while self.running:
+            self.lock.acquire()
+            for manager in self.managers:
+                manager._before_poll()
+            self.lock.release()
+
+            start = time.time()
+            try:
+                events = self.poller.poll(POLL_TIMEOUT)
+            except (IOError, OSError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            polled = time.time()
+
+            self.lock.acquire()
+            try:
+                self._run_once(events, polled)
+                for manager in self.managers:
+                    if manager.metrics is not None:
+                        manager.metrics.poll_seconds.observe(polled - start)
+                        manager.metrics.loop_seconds.observe(time.time() -
+                                                             polled)
+            finally:
+                self.lock.release()
+
+    def close(self):
+        self.running = False
+        self.wakeup()
+        self.join()
+        self.poller.close()
+        wakeup_w, self.wakeup_w = self.wakeup_w, None
+        os.close(self.wakeup_r)
+        os.close(wakeup_w)
+
+    def _run_once(self, events, polled):
+        for fd, event in events:
+            if fd == self.wakeup_r:
+                self._drain_wakeup()
+                continue
+
+            # Connections removed since the poll may still have events
+            conn = self.connections_by_fd.get(fd)
+            if conn is None:
+                continue
+
+            if event & poller.WRITE:
+                self._socket_write(conn)
+            if event & (poller.READ | poller.ERROR):
+                try:
+                    alive = conn.socket_read()
+                except socket.error, e:
+                    alive = False
+                except Exception:
+                    # Keep one client's failure from stopping the others
+                    logging.exception('Failed to process data from %s',
+                                      conn.hostname)
+                    alive = True
+                if not alive:
+                    logging.info('Connection lost for %s', conn.hostname)
+                    conn.manager._connection_lost(conn)
+
+        if len(self.pending) > 0:
+            self.pending_lock.acquire()
+            pending, self.pending = self.pending, set()
+            self.pending_lock.release()
+            for conn in pending:
+                self._socket_write(conn)
+
+        managers = self.managers
+        if len(managers) > 0:
+            self.turn = (self.turn + 1) % len(managers)
+            managers = managers[self.turn:] + managers[:self.turn]
+        for manager in managers:
+            try:
+                manager._after_poll()
+            except Exception:
+                logging.exception('Failed to run connection manager')
+
+    # A socket is polled for writability only while it has bytes the kernel
+    # did not take
+    def _socket_write(self, conn):
+        if conn.closed:
+            return
+        fd = conn.socket.fileno()
+        if fd not in self.connections_by_fd:
+            return
+        try:
+            conn.socket_write()
+        except socket.error, e:
+            logging.info('Connection lost for %s', conn.hostname)
+            conn.manager._connection_lost(conn)
+            return
+        if len(conn.toWrite) > 0:
+            if conn not in self.writing:
+                self.writing.add(conn)
+                self.poller.modify(fd, self._events(conn))
+        elif conn in self.writing:
+            self.writing.remove(conn)
+            self.poller.modify(fd, self._events(conn))
+
+    def _events(self, conn):
+        events = 0
+        if not conn.manager.reads_paused:
+            events |= poller.READ
+        if conn in self.writing:
+            events |= poller.WRITE
+        return events
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
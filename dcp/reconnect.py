@@ -0,0 +1,183 @@
+
+import logging
+import threading
+import time
+
+from constants import (ERR_ECLIENT, ERR_ETMPFAIL, ERR_ROLLBACK,
+                       STREAM_END_DISCONNECTED)
+from events import StreamEnd
+from operation import CountdownLatch, StreamRequest
+from topology import MAX_ATTEMPTS, MAX_RETRY_DELAY, RETRY_DELAY
+
+class Reconnector(object):
+
+    # Restores the connections of a DcpClient that are lost, either because
+    # the socket failed or closed or because nothing arrived on it within
+    # the idle timeout. A new connection to the same node is opened with
+    # backoff, set up like the original one, and the streams that were
+    # routed to the lost connection are requested again from the last seqno
+    # and snapshot that were received.
+    #
+    # Streams that the server rolls back while they are reopened continue
+    # from the rollback seqno, after the handler's rollback() and the
+    # checkpoint store have been told. Streams that cannot be reopened, and
+    # all of the streams of a node that cannot be reached after MAX_ATTEMPTS
+    # tries, end with STREAM_END_DISCONNECTED.
+    def __init__(self, client):
+        self.client = client
+        self.connection = client.connection
+        self.lock = threading.Condition()
+        self.lost = list()
+        self.requests = set()
+        self.running = True
+
+        self.connection.reconnector = self
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Called from the I/O thread once a connection is lost
+    def connection_lost(self, conn):
+        logging.warning('Connection lost for %s, reconnecting', conn.hostname)
+        self.lock.acquire()
+        self.lost.append(conn)
+        self.lock.notify()
+        self.lock.release()
+
+    # Called from the I/O thread when a stream request fails. Requests sent
+    # to reopen a stream are retried when the server asks for a rollback or
+    # is not ready, or when the new connection is lost as well. Returns True
+    # if the request is retried. Otherwise the handler gets a stream end,
+    # unless the topology manager is going to look for the vbucket on
+    # another node.
+    def stream_failed(self, operation, status):
+        self.lock.acquire()
+        ours = operation in self.requests
+        self.lock.release()
+        if not ours:
+            return False
+        if status in (ERR_ROLLBACK, ERR_ETMPFAIL, ERR_ECLIENT):
+            return True
+        if self.connection.topology is not None:
+            return False
+
+        logging.warning('Unable to reopen stream for vbucket %d, status %d',
+                        operation.vbucket, status)
+        handler = self.connection.handler
+        response = StreamEnd(operation.vbucket, STREAM_END_DISCONNECTED)
+        if handler.dict_events:
+            response = response.to_dict()
+        try:
+            handler.stream_end(response)
+        except Exception:
+            logging.exception('Handler failed on vbucket %d',
+                              operation.vbucket)
+        return False
+
+    def close(self):
+        self.lock.acquire()
+        self.running = False
+        self.lock.notify()
+        self.lock.release()
+        self.thread.join()
+        self.connection.reconnector = None
+
+    def _run(self):
+        while True:
+            self.lock.acquire()
+            while self.running and len(self.lost) == 0:
+                self.lock.wait()
+            if not self.running:
+                self.lock.release()
+                return
+            conn = self.lost.pop(0)
+            self.lock.release()
+
+            try:
+                self._reconnect(conn)
+            except Exception:
+                logging.exception('Unable to reconnect to %s', conn.hostname)
+                self.connection.end_streams(self.connection.streams_on(conn))
+
+    def _reconnect(self, lost):
+        for attempt in range(MAX_ATTEMPTS):
+            time.sleep(min(RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY))
+            if not self.running:
+                return
+            vbuckets = self.connection.streams_on(lost)
+            conn = self.connection.reconnect(lost)
+            if conn is None:
+                # The node left the cluster while it could not be reached
+                if lost not in self.connection.connections_by_host.get(
+                        lost.hostname, ()):
+                    self.connection.streams_moved(vbuckets)
+                    return
+                continue
+
+            self.client._setup_connections([conn])
+            # A connection lost again during setup is queued once more
+            if conn.closed:
+                return
+            logging.info('Reconnected to %s', conn.hostname)
+            self._resume(vbuckets)
+            return
+
+        logging.warning('Unable to reconnect to %s', lost.hostname)
+        self.connection.end_streams(self.connection.streams_on(lost))
+
+    def _resume(self, vbuckets):
+        streams = self.connection.streams
+        handler = self.connection.handler
+        checkpoints = self.client.checkpoints
+        for attempt in range(MAX_ATTEMPTS):
+            states = [streams[vbucket] for vbucket in vbuckets if
+                      vbucket in streams]
+            if len(states) == 0:
+                return
+            if attempt > 0:
+                time.sleep(min(RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY))
+
+            latch = CountdownLatch(len(states))
+            ops = list()
+            for state in states:
+                op = StreamRequest(*(state.resume_spec() + (latch,)))
+                op.resume = True
+                ops.append(op)
+            self.lock.acquire()
+            self.requests.update(ops)
+            self.lock.release()
+            self.connection.add_operations(ops)
+            latch.await()
+            self.lock.acquire()
+            self.requests.difference_update(ops)
+            self.lock.release()
+
+            vbuckets = list()
+            for op in ops:
+                status = op.result['status']
+                if status == ERR_ROLLBACK:
+                    seqno = op.result['rollback_seqno']
+                    state = streams.get(op.vbucket)
+                    if state is None:
+                        continue
+                    state.seqno = state.snap_start = state.snap_end = seqno
+                    if seqno == 0:
+                        state.vb_uuid = 0
+                    if checkpoints is not None:
+                        checkpoints.rollback(op.vbucket, op.vb_uuid, seqno)
+                    handler.rollback(op.vbucket, seqno)
+                    vbuckets.append(op.vbucket)
+                elif status == ERR_ETMPFAIL:
+                    vbuckets.append(op.vbucket)
+                elif status == ERR_ECLIENT:
+                    # Streams of a connection that was lost again are
+                    # reopened once it has been restored
+                    conn = self.connection._get_connection(op.vbucket)
+                    if conn is not None and not conn.closed:
+                        vbuckets.append(op.vbucket)
+
+        if len(vbuckets) > 0:
+            logging.warning('Unable to reopen streams for vbuckets %s',
+                            vbuckets)
+            self.connection.end_streams(vbuckets)
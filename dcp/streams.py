@@ -0,0 +1,39 @@
+
+# Returns the snapshot to request when resuming a stream at seqno. A stream
+# that stopped on a snapshot boundary, or before receiving anything from its
+# last snapshot, resumes with an empty snapshot at seqno.
+def resume_snapshot(seqno, snap_start, snap_end):
+    if seqno >= snap_end or seqno < snap_start:
+        return seqno, seqno
+    return snap_start, snap_end
+
+
+class StreamState(object):
+
+    # Progress of an open stream, kept up to date by the I/O thread so the
+    # stream can be reopened where it left off. seqno is the last seqno
+    # received, and snap_start and snap_end describe the snapshot it is in.
+    # events counts the mutations, deletions and expirations received, and
+    # connection is the one the stream was last requested on.
+    __slots__ = ('vbucket', 'flags', 'seqno', 'end_seqno', 'vb_uuid',
+                 'snap_start', 'snap_end', 'attempts', 'events', 'connection')
+
+    def __init__(self, vbucket, flags, start_seqno, end_seqno, vb_uuid,
+                 snap_start, snap_end):
+        self.vbucket = vbucket
+        self.flags = flags
+        self.seqno = start_seqno
+        self.end_seqno = end_seqno
+        self.vb_uuid = vb_uuid
+        self.snap_start = snap_start
+        self.snap_end = snap_end
+        self.attempts = 0
+        self.events = 0
+        self.connection = None
+
+    # Returns the add_stream arguments that continue this stream
+    def resume_spec(self):
+        snap_start, snap_end = resume_snapshot(self.seqno, self.snap_start,
+                                               self.snap_end)
+        return (self.vbucket, self.flags, self.seqno, self.end_seqno,
+                self.vb_uuid, snap_start, snap_end)
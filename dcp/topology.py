@@ -0,0 +1,166 @@
+
+import logging
+import threading
+import time
+
+from constants import (ERR_ETMPFAIL, ERR_NOT_MY_VBUCKET,
+                       STREAM_END_STATE_CHANGED)
+from events import StreamEnd
+from operation import CountdownLatch, StreamRequest
+
+# Number of times a moved stream is re-requested before it is ended
+MAX_ATTEMPTS = 10
+
+# Delay before re-requesting moved streams, doubled for every failed attempt
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5.0
+
+class TopologyManager(object):
+
+    # Keeps the connections of a DcpClient in line with the cluster map.
+    # When a vbucket moves to another node during a rebalance the server ends
+    # its stream with STATE_CHANGED. Instead of passing that on to the
+    # handler, the stream is requested again from the new owner, starting
+    # from the last seqno and snapshot that were received.
+    #
+    # With watch set, the bucket's streaming config is followed so new nodes
+    # are connected as soon as they join. Otherwise the config is only
+    # fetched again when a stream has moved.
+    def __init__(self, client, bucket, watch=True):
+        self.client = client
+        self.rest = client.rest
+        self.connection = client.connection
+        self.bucket = bucket
+        self.rev = self.connection.bucket_config.get('rev', 0)
+        self.update_lock = threading.Lock()
+        self.lock = threading.Condition()
+        self.moved = set()
+        self.running = True
+
+        self.connection.topology = self
+
+        self.resumer = threading.Thread(target=self._resume)
+        self.resumer.daemon = True
+        self.resumer.start()
+
+        self.watcher = None
+        if watch:
+            self.watcher = threading.Thread(target=self._watch)
+            self.watcher.daemon = True
+            self.watcher.start()
+
+    # Fetches the bucket config and applies it if it has changed
+    def refresh(self):
+        nodes, config = self.rest.refresh_bucket(self.bucket)
+        self.apply(nodes, config)
+
+    def apply(self, nodes, config):
+        self.update_lock.acquire()
+        try:
+            rev = config.get('rev', 0)
+            if rev != 0 and rev <= self.rev:
+                return
+            self.rev = rev
+            self.connection.update_topology(nodes, config,
+                                            self.client._setup_connections)
+        finally:
+            self.update_lock.release()
+
+    # Called from the I/O thread when the server ends a stream because its
+    # vbucket moved. Returns True if the stream will be requested again.
+    def stream_moved(self, vbucket):
+        self.lock.acquire()
+        running = self.running
+        if running:
+            self.moved.add(vbucket)
+            self.lock.notify()
+        self.lock.release()
+        return running
+
+    # Called when a stream request fails. Requests for moved streams that hit
+    # a node which no longer owns the vbucket, or one that is not ready yet,
+    # are tried again. Once they have failed too often the handler gets the
+    # stream end that was held back. Returns True if the request is retried.
+    def stream_failed(self, operation, status):
+        if not operation.resume:
+            return False
+        state = self.connection.streams.get(operation.vbucket)
+        if state is None:
+            return False
+
+        state.attempts += 1
+        if status in (ERR_NOT_MY_VBUCKET, ERR_ETMPFAIL) and \
+                state.attempts < MAX_ATTEMPTS and \
+                self.stream_moved(operation.vbucket):
+            return True
+
+        logging.warning('Unable to resume stream for vbucket %d, status %d',
+                        operation.vbucket, status)
+        handler = self.connection.handler
+        response = StreamEnd(operation.vbucket, STREAM_END_STATE_CHANGED)
+        if handler.dict_events:
+            response = response.to_dict()
+        try:
+            handler.stream_end(response)
+        except Exception:
+            logging.exception('Handler failed on vbucket %d',
+                              operation.vbucket)
+        return False
+
+    def close(self):
+        self.lock.acquire()
+        self.running = False
+        self.lock.notify()
+        self.lock.release()
+        self.resumer.join()
+        self.connection.topology = None
+
+    def _resume(self):
+        while True:
+            self.lock.acquire()
+            while self.running and len(self.moved) == 0:
+                self.lock.wait()
+            if not self.running:
+                self.lock.release()
+                return
+            moved, self.moved = self.moved, set()
+            self.lock.release()
+
+            states = list()
+            for vbucket in moved:
+                state = self.connection.streams.get(vbucket)
+                if state is not None:
+                    states.append(state)
+            if len(states) == 0:
+                continue
+
+            attempts = max([state.attempts for state in states])
+            time.sleep(min(RETRY_DELAY * (2 ** attempts), MAX_RETRY_DELAY))
+
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception('Unable to refresh config for %s',
+                                  self.bucket)
+
+            latch = CountdownLatch(len(states))
+            ops = list()
+            for state in states:
+                op = StreamRequest(*(state.resume_spec() + (latch,)))
+                op.resume = True
+                ops.append(op)
+            self.connection.add_operations(ops)
+
+    # Follows the streaming config of the bucket, reconnecting after the
+    # server closes the stream
+    def _watch(self):
+        while self.running:
+            try:
+                for nodes, config in self.rest.stream_bucket(self.bucket):
+                    if not self.running:
+                        return
+                    self.apply(nodes, config)
+            except Exception:
+                logging.exception('Lost config stream for %s', self.bucket)
+            if self.running:
+                time.sleep(MAX_RETRY_DELAY)
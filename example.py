@@ -1,9 +1,11 @@
 
+import argparse
 import json
 import threading
 import time
 
 from dcp import DcpClient, ResponseHandler
+from dcp.mock_cluster import MockCluster
 
 
 class MyHandler(ResponseHandler):
@@ -39,10 +41,25 @@ class MyHandler(ResponseHandler):
         return self.count
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--bucket', default='default')
+    parser.add_argument('--user', default='Administrator')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--mock', action='store_true',
+                        help='stream from a local mock cluster')
+    args = parser.parse_args()
+
+    cluster = None
+    if args.mock:
+        cluster = MockCluster(vbuckets=8)
+        args.port = cluster.start()
+
     handler = MyHandler()
     client = DcpClient()
-    client.connect('172.23.105.195', 8091, 'bucket-1', 'Administrator', 'password',
-                   handler)
+    client.connect(args.host, args.port, args.bucket, args.user,
+                   args.password, handler)
     for i in range(8):
         result = client.add_stream(i, 0, 0, 10, 0, 0, 0)
         if result['status'] != 0:
@@ -54,6 +71,8 @@ def main():
 
     print handler.get_num_items()
     client.close()
+    if cluster is not None:
+        cluster.stop()
     #print json.dumps(client.nodes, sort_keys=True, indent=2)
     #print json.dumps(client.buckets, sort_keys=True, indent=2)
 
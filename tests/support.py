@@ -0,0 +1,133 @@
+# Handlers and the base test case shared by the tests that stream from a
+# MockCluster
+
+import threading
+import time
+import unittest
+
+from dcp import DcpClient, ResponseHandler
+from dcp import constants as C
+from dcp import mock_cluster
+from dcp.handler import ColumnarResponseHandler
+from dcp.mock_cluster import MockCluster
+
+# Seconds to wait for the streams of a test to end
+WAIT = 30
+
+class Recorder(ResponseHandler):
+
+    # Counts events and the ones that repeat a seqno already received
+    def __init__(self):
+        ResponseHandler.__init__(self)
+        self.lock = threading.Lock()
+        self.events = 0
+        self.duplicates = 0
+        self.seqnos = dict()
+        self.ends = list()
+
+    def mutation(self, response):
+        self._event(response)
+
+    def deletion(self, response):
+        self._event(response)
+
+    def marker(self, response):
+        pass
+
+    def stream_end(self, response):
+        self.lock.acquire()
+        self.ends.append((response['vbucket'], response['flags']))
+        self.lock.release()
+
+    def _event(self, response):
+        self.lock.acquire()
+        vbucket = response['vbucket']
+        if response['by_seqno'] <= self.seqnos.get(vbucket, 0):
+            self.duplicates += 1
+        self.seqnos[vbucket] = response['by_seqno']
+        self.events += 1
+        self.lock.release()
+
+
+class Collector(Recorder):
+
+    # Also keeps the mutations and deletions themselves
+    def __init__(self):
+        Recorder.__init__(self)
+        self.received = list()
+
+    def _event(self, response):
+        Recorder._event(self, response)
+        self.lock.acquire()
+        self.received.append(response)
+        self.lock.release()
+
+
+class ColumnarRecorder(ColumnarResponseHandler):
+
+    def __init__(self):
+        ColumnarResponseHandler.__init__(self)
+        self.mutations_received = 0
+        self.seen = set()
+        self.ends = list()
+
+    def mutations(self, batch):
+        columns = batch.columns()
+        self.mutations_received += len(batch)
+        self.seen.update(zip(columns['vbucket'].tolist(),
+                             columns['by_seqno'].tolist()))
+
+    def deletion(self, response):
+        pass
+
+    def marker(self, response):
+        pass
+
+    def stream_end(self, response):
+        self.ends.append((response['vbucket'], response['flags']))
+
+
+class MockClusterTest(unittest.TestCase):
+
+    NODES = 2
+    VBUCKETS = 8
+    ITEMS = 20000
+    SNAPSHOT_SIZE = 500
+    # Further MockCluster options
+    CLUSTER = dict()
+
+    def setUp(self):
+        self.chunk_items = mock_cluster.CHUNK_ITEMS
+        mock_cluster.CHUNK_ITEMS = 64
+        self.cluster = MockCluster(nodes=self.NODES, vbuckets=self.VBUCKETS,
+                                   items=self.ITEMS,
+                                   snapshot_size=self.SNAPSHOT_SIZE,
+                                   **self.CLUSTER)
+        self.rest = self.cluster.start()
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            self.client.close()
+        self.cluster.stop()
+        mock_cluster.CHUNK_ITEMS = self.chunk_items
+
+    def connect(self, handler, **kwargs):
+        self.client = DcpClient(**kwargs)
+        self.client.connect('127.0.0.1', self.rest, 'default', 'user',
+                            'password', handler)
+        return self.client
+
+    def stream_all(self):
+        return self.client.add_streams([(vbucket, 0, 0, self.ITEMS, 0, 0, 0)
+                                        for vbucket in range(self.VBUCKETS)])
+
+    def wait(self, handler):
+        deadline = time.time() + WAIT
+        while handler.has_active_streams() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(handler.has_active_streams())
+
+    def all_ended(self):
+        return [(vbucket, C.STREAM_END_OK) for vbucket in
+                range(self.VBUCKETS)]
@@ -0,0 +1,52 @@
+import threading
+import time
+import unittest
+
+from dcp import dispatch
+from dcp.handler import BatchResponseHandler
+from support import MockClusterTest
+
+class BatchTest(MockClusterTest):
+
+    def test_dispatched_batches_honour_max_batch_size(self):
+        class Sizes(BatchResponseHandler):
+
+            def __init__(self):
+                BatchResponseHandler.__init__(self, max_batch_size=1000,
+                                              max_latency=0.2)
+                self.lock = threading.Lock()
+                self.sizes = list()
+                self.mutations = 0
+                self.seqnos = dict()
+                self.out_of_order = 0
+
+            def batch(self, events):
+                self.lock.acquire()
+                self.sizes.append(len(events))
+                for event in events:
+                    if 'by_seqno' not in event:
+                        continue
+                    self.mutations += 1
+                    vbucket = event['vbucket']
+                    if event['by_seqno'] <= self.seqnos.get(vbucket, 0):
+                        self.out_of_order += 1
+                    self.seqnos[vbucket] = event['by_seqno']
+                self.lock.release()
+
+        handler = Sizes()
+        self.connect(handler, dispatch_workers=4)
+        self.stream_all()
+        self.wait(handler)
+        deadline = time.time() + 1
+        while handler.mutations < self.VBUCKETS * self.ITEMS and \
+                time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(handler.mutations, self.VBUCKETS * self.ITEMS)
+        self.assertEqual(handler.out_of_order, 0)
+        # Workers that catch up with the I/O thread deliver what they hold,
+        # so not every batch is full
+        self.assertTrue(dispatch.DISPATCH_BATCH < max(handler.sizes) <= 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
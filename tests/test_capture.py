@@ -0,0 +1,35 @@
+import shutil
+import tempfile
+import unittest
+
+from dcp import CaptureWriter, Replay
+from support import MockClusterTest, Recorder
+
+class CaptureTest(MockClusterTest):
+
+    def setUp(self):
+        MockClusterTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        MockClusterTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_replay_matches_live_stream(self):
+        live = Recorder()
+        self.connect(live, capture=CaptureWriter(self.directory))
+        self.stream_all()
+        self.wait(live)
+        self.client.close()
+        self.client = None
+
+        replayed = Recorder()
+        self.assertTrue(Replay(self.directory, replayed).run() > 0)
+        self.assertFalse(replayed.has_active_streams())
+        self.assertEqual(replayed.events, live.events)
+        self.assertEqual(replayed.duplicates, 0)
+        self.assertEqual(sorted(replayed.ends), sorted(live.ends))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from dcp.checkpoint import FileCheckpointStore
+from dcp.handler import BatchResponseHandler
+from support import MockClusterTest
+
+class Batcher(BatchResponseHandler):
+
+    # Holds every event until it is forced to flush
+    def __init__(self):
+        BatchResponseHandler.__init__(self, max_latency=3600,
+                                      max_batch_size=2 ** 30)
+        self.lock = threading.Lock()
+        self.seqnos = dict()
+
+    def batch(self, events):
+        self.lock.acquire()
+        for event in events:
+            if 'by_seqno' in event:
+                self.seqnos[event['vbucket']] = event['by_seqno']
+        self.lock.release()
+
+
+class CheckpointTest(MockClusterTest):
+
+    def setUp(self):
+        MockClusterTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checkpoints.json')
+        self.store = FileCheckpointStore(self.path, flush_interval=0.05)
+
+    def tearDown(self):
+        MockClusterTest.tearDown(self)
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_checkpoints_follow_batched_events(self):
+        path = self.path
+        store = self.store
+        handler = Batcher()
+        self.connect(handler, checkpoints=store)
+        self.stream_all()
+        time.sleep(0.3)
+        store.flush()
+
+        f = open(path)
+        try:
+            checkpoints = json.load(f)
+        finally:
+            f.close()
+        # Nothing is checkpointed beyond what batch() has been given
+        handler.lock.acquire()
+        seqnos = dict(handler.seqnos)
+        handler.lock.release()
+        self.assertTrue(max([checkpoint[1] for checkpoint in
+                             checkpoints.values()]) > 0)
+        for vbucket, checkpoint in checkpoints.items():
+            self.assertTrue(checkpoint[1] <= seqnos.get(int(vbucket), 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
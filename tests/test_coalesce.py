@@ -0,0 +1,32 @@
+import unittest
+
+from support import Collector, MockClusterTest, Recorder
+
+class CoalesceTest(MockClusterTest):
+
+    KEY_SPACE = 100
+    CLUSTER = {'key_space': KEY_SPACE}
+
+    def test_last_event_per_key_in_each_snapshot(self):
+        handler = Collector()
+        self.connect(handler, coalesce_buffer_size=16 * 1024 * 1024)
+        self.stream_all()
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS /
+                         self.SNAPSHOT_SIZE * self.KEY_SPACE)
+        self.assertEqual(handler.duplicates, 0)
+        for response in handler.received:
+            position = (response['by_seqno'] - 1) % self.SNAPSHOT_SIZE
+            self.assertTrue(position >= self.SNAPSHOT_SIZE - self.KEY_SPACE)
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+
+    def test_full_buffer_passes_events_through(self):
+        handler = Recorder()
+        self.connect(handler, coalesce_buffer_size=1)
+        self.stream_all()
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+
+
+if __name__ == '__main__':
+    unittest.main()
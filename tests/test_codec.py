@@ -0,0 +1,24 @@
+import struct
+import unittest
+
+from dcp import operation
+from dcp import constants as C
+from dcp.connection import DcpConnection
+from support import Recorder
+
+class EncodeTest(unittest.TestCase):
+
+    def test_failed_pack_queues_nothing(self):
+        conn = DcpConnection('127.0.0.1', 0, Recorder())
+        conn.write(operation.NoopResponse(1))
+        queued = str(conn.toWrite.pending())
+        self.assertRaises(struct.error, conn.write_all,
+                          [operation.NoopResponse(2),
+                           operation.BufferAck(1 << 40)])
+        self.assertEqual(str(conn.toWrite.pending()), queued)
+        conn.write(operation.NoopResponse(3))
+        self.assertEqual(len(conn.toWrite), 2 * C.HEADER_LEN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+from dcp import DcpClient, columns
+from dcp import constants as C
+from dcp.checkpoint import SQLiteCheckpointStore
+from dcp.codec import HEADER
+from dcp.columns import MutationBatch
+from dcp.mock_cluster import MockCluster
+from support import ColumnarRecorder, MockClusterTest
+
+class OptionsTest(MockClusterTest):
+
+    def test_rejected_handler_leaves_client_unlocked(self):
+        for kwargs in ({'dispatch_workers': 2},
+                       {'checkpoints': SQLiteCheckpointStore(':memory:')},
+                       {'coalesce_buffer_size': 65536}):
+            client = DcpClient(**kwargs)
+            self.assertRaises(ValueError, client.connect, '127.0.0.1',
+                              self.rest, 'default', 'user', 'password',
+                              ColumnarRecorder())
+            self.assertFalse(client.lock.locked())
+            self.assertEqual(client.dispatcher, None)
+            if client.checkpoints is not None:
+                client.checkpoints.close()
+
+
+class MutationBatchTest(unittest.TestCase):
+
+    ITEMS = 10
+    VALUE = '{"a": 1}'
+
+    def setUp(self):
+        self.numpy = columns.numpy
+
+    def tearDown(self):
+        columns.numpy = self.numpy
+
+    def batch(self, copy_values=False):
+        cluster = MockCluster(items=self.ITEMS, deletion_interval=0,
+                              snapshot_size=0, value=self.VALUE)
+        self.frames = bytearray(cluster.items_between(3, 0, 0, self.ITEMS))
+        view = memoryview(self.frames)
+        batch = MutationBatch(copy_values)
+        pos = 0
+        while pos < len(self.frames):
+            header = HEADER.unpack_from(self.frames, pos)
+            batch.append(view, pos, header[2], header[3], header[6])
+            pos += C.HEADER_LEN + header[6]
+        return batch
+
+    def check(self, batch):
+        self.assertEqual(len(batch), self.ITEMS)
+        cols = batch.columns()
+        self.assertEqual(list(cols['vbucket']), [3] * self.ITEMS)
+        self.assertEqual(list(cols['by_seqno']), range(1, self.ITEMS + 1))
+        self.assertEqual(list(cols['value_length']),
+                         [len(self.VALUE)] * self.ITEMS)
+        values = memoryview(batch.values)
+        for i in range(self.ITEMS):
+            key = 'key-3-%d' % (i + 1)
+            self.assertEqual(cols['key_length'][i], len(key))
+            start = cols['key_offset'][i]
+            self.assertEqual(str(batch.data[start:start + len(key)]), key)
+            start = cols['value_offset'][i]
+            self.assertEqual(values[start:start + len(self.VALUE)].tobytes(),
+                             self.VALUE)
+            self.assertEqual(batch.key(i), key)
+            self.assertEqual(batch.value(i).tobytes(), self.VALUE)
+        self.assertEqual(batch.progress(), {3: (self.ITEMS, self.ITEMS)})
+
+    def test_array_columns(self):
+        columns.numpy = None
+        self.check(self.batch())
+
+    @unittest.skipIf(columns.numpy is None, 'NumPy is not installed')
+    def test_numpy_columns(self):
+        batch = self.batch()
+        self.assertTrue(isinstance(batch.columns()['by_seqno'],
+                                   columns.numpy.ndarray))
+        self.check(batch)
+
+    def test_values_are_read_in_place(self):
+        batch = self.batch()
+        self.frames[:] = '\0' * len(self.frames)
+        self.assertEqual(batch.value(0).tobytes(), '\0' * len(self.VALUE))
+
+    def test_copied_values_outlive_the_frames(self):
+        batch = self.batch(copy_values=True)
+        self.frames[:] = '\0' * len(self.frames)
+        self.check(batch)
+
+
+if __name__ == '__main__':
+    unittest.main()
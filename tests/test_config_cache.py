@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dcp import RestClient
+from support import MockClusterTest, Recorder
+
+class ConfigCacheTest(MockClusterTest):
+
+    def setUp(self):
+        MockClusterTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        MockClusterTest.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def refresh(self):
+        rest = RestClient('127.0.0.1', self.rest, 'user', 'password',
+                          self.directory)
+        try:
+            return rest.refresh_bucket('default')
+        finally:
+            rest.close()
+
+    def test_cached_config_is_revalidated(self):
+        nodes, config = self.refresh()
+        self.assertEqual(self.cluster.configs_not_modified, 0)
+        cached = os.listdir(self.directory)
+        self.assertEqual(len(cached), 1)
+        mode = os.stat(os.path.join(self.directory, cached[0])).st_mode
+        self.assertEqual(mode & 0777, 0600)
+
+        # A new client only gets the config confirmed
+        self.assertEqual(self.refresh(), (nodes, config))
+        self.assertEqual(self.cluster.configs_not_modified, 1)
+
+        # A changed config is fetched in full
+        self.cluster.failover(1)
+        nodes, config = self.refresh()
+        self.assertEqual(self.cluster.configs_not_modified, 1)
+        self.assertEqual(len(set(config['vbmap'].values())), 1)
+
+    def test_client_streams_from_cached_config(self):
+        self.refresh()
+        handler = Recorder()
+        self.connect(handler, config_cache=self.directory)
+        self.assertEqual(self.cluster.configs_not_modified, 1)
+        self.stream_all()
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+
+
+if __name__ == '__main__':
+    unittest.main()
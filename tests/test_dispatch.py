@@ -0,0 +1,67 @@
+import StringIO
+import sys
+import time
+import unittest
+
+from dcp import constants as C
+from dcp.codec import HEADER
+from dcp.connection import DcpConnection
+from dcp.dispatch import Dispatcher
+from support import MockClusterTest, Recorder
+
+class DispatchTest(MockClusterTest):
+
+    def test_close_while_callbacks_are_queued(self):
+        # Worker threads report their exceptions on the stderr they were
+        # started with
+        class Slow(Recorder):
+
+            def _event(self, response):
+                time.sleep(0.0001)
+                Recorder._event(self, response)
+
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.connect(Slow(), dispatch_workers=2,
+                         connection_buffer_size=20000)
+            self.stream_all()
+            time.sleep(0.2)
+            self.client.close()
+            self.client = None
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertFalse('Traceback' in output, output)
+
+
+class AckTest(unittest.TestCase):
+
+    def test_unknown_opcodes_are_acked(self):
+        class Manager(object):
+            dispatcher = Dispatcher(Recorder(), workers=1)
+            streams = dict()
+            checkpoints = None
+            key_filter = None
+            metrics = None
+            op_timeout = None
+            capture = None
+            coalesce_buffer_size = None
+
+            def schedule_write(self, conn):
+                pass
+
+        manager = Manager()
+        conn = DcpConnection('127.0.0.1', 0, Recorder(), manager=manager)
+        conn.set_flow_control(100)
+        conn.ack_threshold = 1
+        try:
+            conn.bytes_read(HEADER.pack(C.REQ_MAGIC, C.CMD_SET_VB_STATE, 0,
+                                        1, 0, 3, 1, 1, 0) + '\x01')
+        finally:
+            manager.dispatcher.close()
+        self.assertEqual(conn.acked, C.HEADER_LEN + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
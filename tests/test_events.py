@@ -0,0 +1,86 @@
+import json
+import pickle
+import unittest
+
+from dcp import constants as C
+from dcp import mock_cluster
+from dcp.events import Mutation
+from support import Collector, MockClusterTest
+
+class EventTypeTest(MockClusterTest):
+
+    ITEMS = 1000
+
+    def test_events_read_like_dicts(self):
+        handler = Collector()
+        self.connect(handler)
+        self.stream_all()
+        self.wait(handler)
+        self.assertEqual(len(handler.received), self.VBUCKETS * self.ITEMS)
+        for response in handler.received[:100]:
+            self.assertEqual(response['key'], response.key)
+            self.assertEqual(response['by_seqno'], response.by_seqno)
+            self.assertEqual(response.get('cas'), None)
+            self.assertEqual(sorted(response.keys()),
+                             sorted(response.to_dict().keys()))
+            if 'value' in response:
+                self.assertEqual(response['value'].tobytes(),
+                                 self.cluster.value)
+
+    def test_dict_events(self):
+        class DictCollector(Collector):
+            dict_events = True
+
+            def __init__(self):
+                Collector.__init__(self)
+                self.types = set()
+
+            def marker(self, response):
+                self._check(response)
+
+            def stream_end(self, response):
+                self._check(response)
+                Collector.stream_end(self, response)
+
+            def _event(self, response):
+                self._check(response)
+                Collector._event(self, response)
+
+            def _check(self, response):
+                self.lock.acquire()
+                self.types.add(type(response))
+                self.lock.release()
+
+        handler = DictCollector()
+        self.connect(handler)
+        self.stream_all()
+        self.wait(handler)
+        self.assertEqual(handler.types, set([dict]))
+        self.assertEqual(handler.duplicates, 0)
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+        self.assertTrue(all(['key' in response for response in
+                             handler.received]))
+
+
+class EventTest(unittest.TestCase):
+
+    def mutation(self, value):
+        key = 'key'
+        frame = mock_cluster.MUTATION.pack(C.REQ_MAGIC, C.CMD_MUTATION,
+                                           len(key), 31, 0, 3,
+                                           31 + len(key) + len(value), 0, 5,
+                                           5, 1, 0, 0, 0, 0, 0) + key + value
+        return Mutation(3, 5, 5, 0, 0, 0, 0, frame, 31, len(key))
+
+    def test_json_survives_pickling(self):
+        # Worker processes send events to the parent pickled
+        for value in ('{"a": 1}', 'null'):
+            event = self.mutation(value)
+            parsed = json.loads(value)
+            self.assertEqual(pickle.loads(pickle.dumps(event, 2)).json, parsed)
+            self.assertEqual(event.json, parsed)
+            self.assertEqual(pickle.loads(pickle.dumps(event, 2)).json, parsed)
+
+
+if __name__ == '__main__':
+    unittest.main()
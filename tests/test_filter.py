@@ -0,0 +1,29 @@
+import unittest
+
+from dcp import KeyFilter
+from support import Collector, MockClusterTest
+
+class KeyFilterTest(MockClusterTest):
+
+    def test_only_matching_keys_are_delivered(self):
+        # Dropped events are still acknowledged, so the streams keep going
+        # with flow control
+        for kwargs in ({}, {'dispatch_workers': 2}):
+            handler = Collector()
+            self.connect(handler, connection_buffer_size=20000,
+                         key_filter=KeyFilter(prefixes=['key-1-'],
+                                              patterns=['7$']), **kwargs)
+            self.stream_all()
+            self.wait(handler)
+            keys = [response['key'] for response in handler.received]
+            self.assertEqual(len(keys), self.ITEMS +
+                             (self.VBUCKETS - 1) * self.ITEMS / 10)
+            self.assertTrue(all([key.startswith('key-1-') or
+                                 key.endswith('7') for key in keys]))
+            self.assertEqual(sorted(handler.ends), self.all_ended())
+            self.client.close()
+            self.client = None
+
+
+if __name__ == '__main__':
+    unittest.main()
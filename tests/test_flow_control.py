@@ -0,0 +1,76 @@
+import time
+import unittest
+
+from dcp import operation
+from dcp import constants as C
+from support import MockClusterTest, Recorder
+
+class FlowControlTest(MockClusterTest):
+
+    def test_acks_match_consumed_bytes(self):
+        for kwargs in ({}, {'dispatch_workers': 2}):
+            handler = Recorder()
+            self.connect(handler, connection_buffer_size=20000, **kwargs)
+            self.stream_all()
+            self.wait(handler)
+            self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+
+            # What is left unacked is below the ack threshold, and the server
+            # was never told about more bytes than it sent. Dispatch workers
+            # ack the last events after their stream has ended.
+            connections = self.client.connection.connections
+            threshold = connections[0].ack_threshold
+            deadline = time.time() + 1
+            while time.time() < deadline and \
+                    max([producer.unacked for producer in
+                         self.cluster._handlers()]) >= threshold:
+                time.sleep(0.05)
+            for producer in self.cluster._handlers():
+                self.assertTrue(0 <= producer.unacked < threshold)
+            self.assertEqual(self.cluster.acked,
+                             sum([conn.acked for conn in connections]))
+            self.client.close()
+            self.client = None
+            self.cluster.acked = 0
+
+
+class OpaqueTest(MockClusterTest):
+
+    def setUp(self):
+        MockClusterTest.setUp(self)
+        self.counter = operation._opaque_counter
+
+    def tearDown(self):
+        operation._opaque_counter = self.counter
+        MockClusterTest.tearDown(self)
+
+    def test_counter_wraps_within_client_range(self):
+        operation._opaque_counter = 0xFFFFFFFE
+        self.assertEqual(operation.next_opaque(), 0xFFFFFFFF)
+        self.assertEqual(operation.next_opaque(), operation.OPAQUE_START)
+
+    def test_acks_do_not_take_opaques(self):
+        operation._opaque_counter = 0xFFFFFFF0
+        handler = Recorder()
+        self.connect(handler, connection_buffer_size=20000)
+        self.stream_all()
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+        self.assertTrue(operation._opaque_counter >= operation.OPAQUE_START)
+        for conn in self.client.connection.connections:
+            self.assertTrue(conn.acked > 0)
+            self.assertFalse(conn.writeLock.locked())
+
+    def test_streams_across_wraparound(self):
+        operation._opaque_counter = 0xFFFFFFFF - self.VBUCKETS / 2
+        handler = Recorder()
+        self.connect(handler, connection_buffer_size=20000)
+        results = self.stream_all()
+        self.assertEqual([result['status'] for result in results.values()],
+                         [C.SUCCESS] * self.VBUCKETS)
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+
+
+if __name__ == '__main__':
+    unittest.main()
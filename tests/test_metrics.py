@@ -0,0 +1,87 @@
+import threading
+import time
+import unittest
+
+from support import MockClusterTest, Recorder
+
+class MetricsTest(MockClusterTest):
+
+    BUFFER_SIZE = 20000
+
+    def test_snapshot_and_prometheus(self):
+        # The first callback holds up the only worker, so nothing is acked
+        # and the streams stop part of the way through until it is released
+        class Gated(Recorder):
+
+            def __init__(self):
+                Recorder.__init__(self)
+                self.gate = threading.Event()
+
+            def _event(self, response):
+                self.gate.wait()
+                Recorder._event(self, response)
+
+        handler = Gated()
+        self.connect(handler, metrics=True, dispatch_workers=1,
+                     dispatch_queue_size=self.VBUCKETS * self.ITEMS,
+                     connection_buffer_size=self.BUFFER_SIZE)
+        try:
+            self.stream_all()
+            deadline = time.time() + 5
+            while time.time() < deadline and not all(
+                    [producer.unacked >= self.BUFFER_SIZE for producer in
+                     self.cluster._handlers()]):
+                time.sleep(0.05)
+            # Let the client decode what the servers have sent
+            time.sleep(0.2)
+            self.check_paused_streams(self.client.metrics)
+        finally:
+            handler.gate.set()
+        self.wait(handler)
+
+        # Every mutation, deletion, marker and stream end went through a
+        # timed callback
+        histograms = self.client.metrics.snapshot()['histograms']
+        self.assertEqual(histograms['callback_seconds']['count'],
+                         self.VBUCKETS * (self.ITEMS +
+                                          self.ITEMS / self.SNAPSHOT_SIZE + 1))
+
+    def check_paused_streams(self, metrics):
+        snapshot = metrics.snapshot(seqno_lag=True)
+        vbuckets = snapshot['vbuckets']
+        self.assertEqual(sorted(vbuckets), range(self.VBUCKETS))
+        self.assertTrue(sum([stats['seqno'] for stats in
+                             vbuckets.values()]) > 0)
+        for stats in vbuckets.values():
+            self.assertEqual(stats['high_seqno'], self.ITEMS)
+            self.assertEqual(stats['lag'], self.ITEMS - stats['seqno'])
+            self.assertTrue(stats['lag'] > 0)
+        self.assertEqual(snapshot['active_streams'], self.VBUCKETS)
+
+        text = metrics.prometheus(seqno_lag=True)
+        samples = dict([line.rsplit(' ', 1) for line in text.splitlines()
+                        if not line.startswith('#')])
+        for vbucket, stats in vbuckets.items():
+            self.assertEqual(
+                int(samples['dcp_vbucket_seqno_lag{vbucket="%d"}' % vbucket]),
+                stats['lag'])
+
+        # Nothing more is read, so every frame counted by the connections is
+        # in the frame size histogram
+        time.sleep(0.1)
+        snapshot = metrics.snapshot()
+        frames = sum([stats['frames'] for stats in
+                      snapshot['connections'].values()])
+        histogram = snapshot['histograms']['frame_bytes']
+        self.assertEqual(histogram['count'], frames)
+        self.assertEqual(histogram['buckets'][-1], ('+Inf', frames))
+        counts = [count for bound, count in histogram['buckets']]
+        self.assertEqual(counts, sorted(counts))
+        text = metrics.prometheus()
+        self.assertTrue('dcp_frame_bytes_count %d\n' % frames in text)
+        self.assertTrue('dcp_frame_bytes_bucket{le="+Inf"} %d\n' % frames in
+                        text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import time
+import unittest
+
+from dcp import constants as C
+from support import MockClusterTest, Recorder
+
+class TimeoutTest(MockClusterTest):
+
+    def test_stream_request_to_stalled_node_fails(self):
+        handler = Recorder()
+        self.connect(handler, timeout=1)
+        self.cluster.stall()
+        result = self.client.add_stream(0, 0, 0, self.ITEMS, 0, 0, 0)
+        self.assertEqual(result['status'], C.ERR_ECLIENT)
+        self.assertFalse(handler.has_active_streams())
+
+    def test_late_stream_is_closed(self):
+        # The server opens the stream after the request has timed out
+        handler = Recorder()
+        self.connect(handler, timeout=1)
+        self.cluster.stream_delay = 1.5
+        result = self.client.add_stream(0, 0, 0, self.ITEMS, 0, 0, 0)
+        self.assertEqual(result['status'], C.ERR_ECLIENT)
+        time.sleep(1)
+        deadline = time.time() + 5
+        while time.time() < deadline and \
+                any([producer.streams for producer in
+                     self.cluster._handlers()]):
+            time.sleep(0.05)
+        self.assertFalse(any([producer.streams for producer in
+                              self.cluster._handlers()]))
+        self.assertEqual(handler.events, 0)
+        self.assertEqual(handler.ends, [])
+        self.assertEqual(handler.active_streams, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from dcp import ProcessPoolClient
+from dcp import constants as C
+from dcp.dcp_exception import ConnectedException
+from support import ColumnarRecorder, MockClusterTest, Recorder
+
+class ProcessPoolTest(MockClusterTest):
+
+    def test_rejected_calls_leave_client_unlocked(self):
+        client = ProcessPoolClient(processes=2)
+        self.assertRaises(ConnectedException, client.add_streams,
+                          [(0, 0, 0, self.ITEMS, 0, 0, 0)])
+        self.assertFalse(client.lock.locked())
+        self.assertRaises(ValueError, client.connect, '127.0.0.1', self.rest,
+                          'default', 'user', 'password', ColumnarRecorder())
+        self.assertFalse(client.lock.locked())
+        self.assertEqual(client.workers, [])
+
+
+class JsonProcessPoolTest(MockClusterTest):
+
+    CLUSTER = {'value': '{"a": 1}'}
+
+    def test_events_from_worker_processes(self):
+        class JsonRecorder(Recorder):
+
+            def __init__(self):
+                Recorder.__init__(self)
+                self.documents = list()
+
+            def mutation(self, response):
+                document = response.json
+                self.lock.acquire()
+                self.documents.append(document)
+                self.lock.release()
+                Recorder.mutation(self, response)
+
+        handler = JsonRecorder()
+        self.client = ProcessPoolClient(processes=2)
+        self.client.connect('127.0.0.1', self.rest, 'default', 'user',
+                            'password', handler)
+        results = self.stream_all()
+        self.assertEqual([result['status'] for result in results.values()],
+                         [C.SUCCESS] * self.VBUCKETS)
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+        self.assertEqual(handler.duplicates, 0)
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+        self.assertEqual(len(handler.documents),
+                         self.VBUCKETS * self.ITEMS * 9 / 10)
+        self.assertTrue(all([document == {'a': 1} for document in
+                             handler.documents]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import time
+import unittest
+
+from dcp import QueueHandler
+from dcp import constants as C
+from support import MockClusterTest
+
+class QueueHandlerTest(MockClusterTest):
+
+    def test_iteration_ends_with_the_streams(self):
+        handler = QueueHandler()
+        self.connect(handler)
+        self.stream_all()
+        kinds = dict()
+        for kind, response in handler:
+            kinds[kind] = kinds.get(kind, 0) + 1
+        self.assertEqual(kinds, {
+            'mutation': self.VBUCKETS * self.ITEMS * 9 / 10,
+            'deletion': self.VBUCKETS * self.ITEMS / 10,
+            'marker': self.VBUCKETS * self.ITEMS / self.SNAPSHOT_SIZE,
+            'stream_end': self.VBUCKETS})
+
+    def test_per_vbucket_events_are_in_order(self):
+        handler = QueueHandler(per_vbucket=True)
+        self.connect(handler)
+        self.stream_all()
+        for vbucket in range(self.VBUCKETS):
+            seqnos = [response['by_seqno'] for kind, response in
+                      handler.events(vbucket) if 'by_seqno' in response]
+            self.assertEqual(seqnos, range(1, self.ITEMS + 1))
+        self.assertFalse(handler.has_active_streams())
+
+    def test_per_vbucket_events_end_when_the_request_fails(self):
+        handler = QueueHandler(per_vbucket=True)
+        self.connect(handler)
+        self.cluster.failover(1)
+        time.sleep(0.2)
+        result = self.client.add_stream(1, 0, 0, self.ITEMS, 0, 0, 0)
+        self.assertNotEqual(result['status'], C.SUCCESS)
+        self.assertEqual(list(handler.events(1)), [])
+        self.assertFalse(handler.has_active_streams())
+
+
+if __name__ == '__main__':
+    unittest.main()
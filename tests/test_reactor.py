@@ -0,0 +1,67 @@
+import threading
+import time
+import unittest
+
+from dcp import DcpClient, Reactor
+from support import MockClusterTest, Recorder
+
+class ReactorTest(MockClusterTest):
+
+    ITEMS = 5000
+    CLIENTS = 4
+
+    def test_clients_share_the_event_loops(self):
+        # Also records the threads the callbacks ran on
+        class ThreadRecorder(Recorder):
+
+            def __init__(self):
+                Recorder.__init__(self)
+                self.threads = set()
+
+            def _event(self, response):
+                self.threads.add(threading.current_thread())
+                Recorder._event(self, response)
+
+        reactor = Reactor(threads=2)
+        clients = list()
+        try:
+            for i in range(self.CLIENTS):
+                client = DcpClient(reactor=reactor,
+                                   connection_buffer_size=20000)
+                client.connect('127.0.0.1', self.rest, 'default', 'user',
+                               'password', ThreadRecorder())
+                clients.append(client)
+            handlers = [each.connection.handler for each in clients]
+
+            # Clients are spread evenly over the loops
+            for loop in reactor.loops:
+                self.assertEqual(len(loop.managers), self.CLIENTS / 2)
+            for client in clients:
+                self.assertTrue(client.connection.loop in reactor.loops)
+
+            for client in clients:
+                client.add_streams([(vbucket, 0, 0, self.ITEMS, 0, 0, 0)
+                                    for vbucket in range(self.VBUCKETS)])
+            time.sleep(0.05)
+            closed = clients.pop(0)
+            loop = closed.connection.loop
+            closed.close()
+            self.assertEqual(len(loop.managers), self.CLIENTS / 2 - 1)
+            self.assertTrue(all([each.is_alive() for each in
+                                 reactor.loops]))
+
+            for client, handler in zip(clients, handlers[1:]):
+                self.wait(handler)
+                self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+                self.assertEqual(handler.duplicates, 0)
+                self.assertEqual(sorted(handler.ends), self.all_ended())
+                self.assertEqual(handler.threads,
+                                 set([client.connection.loop]))
+        finally:
+            for client in clients:
+                client.close()
+            reactor.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
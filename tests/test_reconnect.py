@@ -0,0 +1,145 @@
+import time
+import unittest
+
+from dcp import topology
+from dcp import constants as C
+from support import MockClusterTest, Recorder
+
+class ReconnectTest(MockClusterTest):
+
+    def test_resume_after_disconnect(self):
+        for kwargs in ({}, {'dispatch_workers': 2}):
+            handler = Recorder()
+            self.connect(handler, connection_buffer_size=20000,
+                         reconnect=True, **kwargs)
+            self.stream_all()
+            time.sleep(0.05)
+            self.cluster.disconnect()
+            self.wait(handler)
+            self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+            self.assertEqual(handler.duplicates, 0)
+            self.assertEqual(sorted(handler.ends), self.all_ended())
+            self.client.close()
+            self.client = None
+
+    def test_resume_after_repeated_disconnects(self):
+        # Connections are also lost while they are being set up again
+        handler = Recorder()
+        self.connect(handler, connection_buffer_size=20000, reconnect=True)
+        self.stream_all()
+        deadline = time.time() + 0.4
+        while time.time() < deadline:
+            self.cluster.disconnect()
+            time.sleep(0.01)
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+        self.assertEqual(handler.duplicates, 0)
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+
+    def test_coalesced_resume_after_disconnect(self):
+        # Every key is unique, so nothing held back may be dropped
+        handler = Recorder()
+        self.connect(handler, connection_buffer_size=20000, reconnect=True,
+                     coalesce_buffer_size=16 * 1024 * 1024)
+        self.stream_all()
+        time.sleep(0.05)
+        self.cluster.disconnect()
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+        self.assertEqual(handler.duplicates, 0)
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+
+    def test_streams_end_without_reconnect(self):
+        handler = Recorder()
+        self.connect(handler, connection_buffer_size=20000)
+        self.stream_all()
+        time.sleep(0.05)
+        self.cluster.disconnect()
+        self.wait(handler)
+        self.assertEqual(sorted(handler.ends),
+                         [(vbucket, C.STREAM_END_DISCONNECTED) for vbucket in
+                          range(self.VBUCKETS)])
+
+    def test_resume_after_failover(self):
+        self.failover_and_wait()
+
+    def test_coalesced_resume_after_failover(self):
+        self.failover_and_wait(coalesce_buffer_size=16 * 1024 * 1024)
+
+    def failover_and_wait(self, **kwargs):
+        # Pick up the failover config without waiting out the default delay
+        delay = topology.MAX_RETRY_DELAY
+        topology.MAX_RETRY_DELAY = 0.5
+        try:
+            handler = Recorder()
+            self.connect(handler, connection_buffer_size=20000,
+                         reconnect=True, follow_topology=True, **kwargs)
+            self.stream_all()
+            time.sleep(0.05)
+            self.cluster.failover(1)
+            self.wait(handler)
+        finally:
+            topology.MAX_RETRY_DELAY = delay
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+        self.assertEqual(handler.duplicates, 0)
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+
+
+class KeepaliveTest(MockClusterTest):
+
+    def test_noops_keep_quiet_connections_open(self):
+        self.connect(Recorder(), noop_interval=1)
+        time.sleep(4)
+        self.assertTrue(self.cluster.noop_responses > 0)
+        for conn in self.client.connection.connections:
+            self.assertFalse(conn.closed)
+
+    def test_stalled_streams_end(self):
+        handler = Recorder()
+        self.connect(handler, connection_buffer_size=20000, noop_interval=1)
+        self.stream_all()
+        time.sleep(0.05)
+        self.cluster.stall()
+        self.wait(handler)
+        self.assertEqual(sorted(handler.ends),
+                         [(vbucket, C.STREAM_END_DISCONNECTED) for vbucket in
+                          range(self.VBUCKETS)])
+
+    def test_resume_after_stall(self):
+        handler = Recorder()
+        self.connect(handler, connection_buffer_size=20000, noop_interval=1,
+                     reconnect=True)
+        self.stream_all()
+        time.sleep(0.05)
+        self.cluster.stall()
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+        self.assertEqual(handler.duplicates, 0)
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+
+    def test_paused_reads_are_not_idle(self):
+        # The first callback holds up the only worker for longer than the
+        # idle timeout while reads are paused and even noops cannot arrive
+        class Slow(Recorder):
+
+            def __init__(self):
+                Recorder.__init__(self)
+                self.slept = False
+
+            def _event(self, response):
+                if not self.slept:
+                    self.slept = True
+                    time.sleep(4)
+                Recorder._event(self, response)
+
+        handler = Slow()
+        self.connect(handler, dispatch_workers=1, dispatch_queue_size=16,
+                     noop_interval=1)
+        self.stream_all()
+        self.wait(handler)
+        self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import struct
+import time
+import unittest
+
+from dcp import topology
+from dcp import constants as C
+from dcp.codec import HEADER
+from dcp.connection import DcpConnection
+from dcp.streams import StreamState
+from support import ColumnarRecorder, MockClusterTest, Recorder
+
+class TopologyTest(MockClusterTest):
+
+    def test_moved_stream_end_is_acked_once(self):
+        class Manager(object):
+            dispatcher = None
+            streams = {3: StreamState(3, 0, 0, 4, 0, 0, 0)}
+            checkpoints = None
+            key_filter = None
+            metrics = None
+            op_timeout = None
+            capture = None
+            coalesce_buffer_size = None
+
+            def stream_ended(self, vbucket, flags):
+                return True
+
+            def schedule_write(self, conn):
+                pass
+
+        conn = DcpConnection('127.0.0.1', 0, Recorder(), manager=Manager())
+        conn.set_flow_control(100)
+        conn.ack_threshold = 1
+        conn.bytes_read(HEADER.pack(C.REQ_MAGIC, C.CMD_STREAM_END, 0, 4, 0,
+                                    3, 4, 1, 0) +
+                        struct.pack('>I', C.STREAM_END_STATE_CHANGED))
+        self.assertEqual(conn.acked, C.HEADER_LEN + 4)
+
+    def test_columnar_resume_after_disconnect(self):
+        handler = ColumnarRecorder()
+        self.connect(handler, connection_buffer_size=20000, reconnect=True)
+        self.stream_all()
+        time.sleep(0.05)
+        self.cluster.disconnect()
+        self.wait(handler)
+        self.assertEqual(handler.mutations_received, len(handler.seen))
+        self.assertEqual(sorted(handler.ends), self.all_ended())
+
+    def test_resume_after_rebalance(self):
+        # Pick up the new config without waiting out the default delay
+        delay = topology.MAX_RETRY_DELAY
+        topology.MAX_RETRY_DELAY = 0.5
+        try:
+            for kwargs in ({}, {'dispatch_workers': 2}):
+                handler = Recorder()
+                self.connect(handler, connection_buffer_size=20000,
+                             follow_topology=True, **kwargs)
+                self.stream_all()
+                time.sleep(0.05)
+                moved = self.cluster.streams_moved
+                self.cluster.rebalance()
+                self.wait(handler)
+                self.assertTrue(self.cluster.streams_moved > moved)
+                self.assertEqual(handler.events, self.VBUCKETS * self.ITEMS)
+                self.assertEqual(handler.duplicates, 0)
+                self.assertEqual(sorted(handler.ends), self.all_ended())
+                self.client.close()
+                self.client = None
+        finally:
+            topology.MAX_RETRY_DELAY = delay
+
+
+if __name__ == '__main__':
+    unittest.main()